@@ -0,0 +1,132 @@
+"""Codecs for build archives.
+
+A codec determines how the tar stream for a build is compressed locally
+and decompressed on the remote host. Compression is done by piping the
+tar stream through an external program, which allows multi-threaded
+compressors like ``pigz`` and ``zstd`` to use all available cores.
+
+The permissions of files in archives are normalized to ``ug=rwX,o-rwx``
+and archives are extracted with their permissions preserved, so the
+files in a build don't need to be chmod-ed after they're extracted.
+
+"""
+import shutil
+import subprocess
+import tarfile
+from collections import OrderedDict
+
+from runcommands.util import abort
+
+
+__all__ = [
+    'CODECS',
+    'Codec',
+    'get_codec',
+    'write_archive',
+]
+
+
+class Codec:
+
+    """Archive codec.
+
+    Args:
+        name: Name used to select the codec (e.g., ``deploy --codec``)
+        extension: File name extension for archives
+        compress (list): Local command that reads a tar stream on stdin
+            and writes the compressed stream to stdout; if this isn't
+            specified, the tar stream won't be compressed
+        decompress (str): Remote command that decompresses a file (or
+            stdin) to stdout; this must be specified if ``compress`` is
+
+    """
+
+    def __init__(self, name, extension, compress=None, decompress=None):
+        self.name = name
+        self.extension = extension
+        self.compress = compress
+        self.decompress = decompress
+
+    def check(self):
+        """Make sure the compressor is installed locally."""
+        if self.compress and shutil.which(self.compress[0]) is None:
+            abort(1, '{0} must be installed to use the {1} codec'.format(
+                self.compress[0], self.name))
+
+    def extract_command(self, archive_path=None):
+        """Get remote command to extract archive (or stdin if no path)."""
+        if self.decompress is None:
+            return 'tar xpf {source}'.format(source=archive_path or '-')
+        if archive_path:
+            return '{self.decompress} {archive_path} | tar xpf -'.format_map(locals())
+        return '{self.decompress} | tar xpf -'.format_map(locals())
+
+    def __repr__(self):
+        return 'Codec({self.name})'.format_map(locals())
+
+
+CODECS = OrderedDict((codec.name, codec) for codec in (
+    Codec('gzip', 'tgz', ['gzip', '-c'], 'gzip -dc'),
+    Codec('pigz', 'tgz', ['pigz', '-c'], 'gzip -dc'),
+    Codec('zstd', 'tar.zst', ['zstd', '-c', '-q', '-T0'], 'zstd -dc'),
+    Codec('none', 'tar'),
+))
+
+
+def get_codec(name):
+    if isinstance(name, Codec):
+        return name
+    try:
+        return CODECS[name]
+    except KeyError:
+        abort(1, 'Unknown codec: {name}; expected one of: {names}'.format(
+            name=name, names=', '.join(CODECS)))
+
+
+def write_archive(path, arcname, out_file, codec='gzip'):
+    """Write a tarball of ``path`` to ``out_file`` using ``codec``.
+
+    Args:
+        path: The directory to archive
+        arcname: The name ``path`` will have in the archive
+        out_file: A file object with a file descriptor (e.g., a regular
+            file or the stdin pipe of a subprocess)
+        codec: A :class:`Codec` or the name of one
+
+    Returns:
+        int: The exit code of the compressor (0 when not compressing)
+
+    """
+    codec = get_codec(codec)
+
+    if codec.compress is None:
+        with tarfile.open(fileobj=out_file, mode='w|') as tarball:
+            tarball.add(path, arcname, filter=normalize_mode)
+        return 0
+
+    codec.check()
+    compressor = subprocess.Popen(codec.compress, stdin=subprocess.PIPE, stdout=out_file)
+    try:
+        with tarfile.open(fileobj=compressor.stdin, mode='w|') as tarball:
+            tarball.add(path, arcname, filter=normalize_mode)
+    except BrokenPipeError:
+        # The compressor (or whatever it's writing to) went away; its
+        # exit code is returned below.
+        pass
+    finally:
+        try:
+            compressor.stdin.close()
+        except BrokenPipeError:
+            pass
+    return compressor.wait()
+
+
+def normalize_mode(tarinfo):
+    """Set mode of archive member to the equivalent of ``ug=rwX,o-rwx``."""
+    if tarinfo.issym():
+        return tarinfo
+    if tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o770
+    else:
+        tarinfo.mode = 0o660
+    return tarinfo
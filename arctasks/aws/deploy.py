@@ -8,7 +8,7 @@ from runcommands.commands import local, remote
 from runcommands.util import abort, printer
 
 from arctasks.static import build_static
-from arctasks.remote import copy_file, rsync
+from arctasks.remote import copy_file, fix_permissions, mark_changes, rsync
 
 from .provision import provision
 
@@ -40,6 +40,9 @@ def deploy(config, version=None, provision_=False, create_cert=False, overwrite=
     restart_uwsgi_ = restart_uwsgi_ or restart_all
     restart_nginx_ = restart_nginx_ or restart_all
 
+    # Paths written after this are fixed up by fix_permissions() below
+    mark_changes(config, '{deploy.permissions_marker}')
+
     if provision_:
         provision(config, create_cert=create_cert)
     else:
@@ -122,8 +125,9 @@ def deploy(config, version=None, provision_=False, create_cert=False, overwrite=
         if static:
             remote(config, 'ln -sfn {deploy.dir}/staticfiles.json', cd='{deploy.static_dir}')
 
-    # Set permissions
-    remote(config, 'chmod -R ug=rwX,o=rX {deploy.root}')
+    # Set permissions of paths written during this deployment
+    fix_permissions(
+        config, '{deploy.root}', mode='ug=rwX,o=rX', since='{deploy.permissions_marker}')
 
     # Copying the uWSGI config file will cause the app's uWSGI process
     # to restart automatically.
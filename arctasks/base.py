@@ -5,9 +5,10 @@ import sys
 import urllib.request
 
 from runcommands import command
-from runcommands.commands import local
 from runcommands.util import abort, abs_path, printer
 
+from .trace import local
+
 
 @command
 def clean(config):
@@ -0,0 +1,363 @@
+"""Local cache for downloaded artifacts.
+
+Artifacts (e.g., the virtualenv tarball) are cached on disk and shared
+across projects. Each cached artifact is stored along with its ETag and
+Last-Modified headers, which are used to revalidate it with a
+conditional request before it's reused, and its SHA-256 checksum, which
+is used to verify it each time it's used.
+
+When the cache grows beyond its max size, the least recently used
+artifacts are evicted.
+
+Source distributions built from local packages are also cached, keyed
+by the git tree hash of each package plus a fingerprint of any
+uncommitted changes, so unchanged packages don't have to be rebuilt on
+every deploy.
+
+Whole builds are cached too (as archives), so deploying the same source
+tree to the same env again doesn't require rebuilding it.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from runcommands.util import abort, printer
+
+from . import git
+from .util import file_hash
+
+
+__all__ = [
+    'ArtifactCache',
+    'BuildCache',
+    'SdistCache',
+]
+
+
+class ArtifactCache:
+
+    """Cache for downloaded artifacts.
+
+    Args:
+        root: Directory to store artifacts in; will be created if
+            necessary
+        max_size: Max total size of cached artifacts in bytes
+        offline: When set, artifacts will never be fetched or
+            revalidated; fetching an artifact that isn't cached will
+            fail immediately
+
+    """
+
+    def __init__(self, root, max_size=512 * 1024 * 1024, offline=False):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, offline=False):
+        """Create cache using ``cache.*`` config."""
+        return cls(
+            os.path.join(config.cache.dir, 'artifacts'),
+            max_size=config.cache.max_size,
+            offline=offline)
+
+    def fetch(self, url, checksum=None):
+        """Get local path to artifact at ``url``, fetching it if needed.
+
+        Args:
+            url: The URL of the artifact
+            checksum: Expected SHA-256 checksum of the artifact, if
+                known; when the cached artifact matches this, it won't
+                be revalidated
+
+        Returns:
+            str: Path to the cached artifact; it should be copied
+                before being modified
+
+        """
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            path, meta = self._load(url)
+
+            if meta is not None and checksum:
+                if meta['sha256'] == checksum:
+                    printer.info('Using cached {url}'.format_map(locals()))
+                    return self._touch(path, meta)
+                # The cached artifact doesn't match the expected
+                # checksum, so it has to be fetched again.
+                meta = None
+
+            if self.offline:
+                if meta is None:
+                    abort(1, 'Offline and {url} is not cached'.format_map(locals()))
+                printer.info('Offline; using cached {url}'.format_map(locals()))
+                return self._touch(path, meta)
+
+            headers = {}
+            if meta is not None:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+            try:
+                with urlopen(Request(url, headers=headers)) as response:
+                    printer.info('Fetching {url}...'.format_map(locals()))
+                    meta = self._store(url, path, response, checksum)
+            except HTTPError as exc:
+                if exc.code == 304 and meta is not None:
+                    printer.info('Using cached {url} (not modified)'.format_map(locals()))
+                    return self._touch(path, meta)
+                abort(1, 'Could not fetch {url}: {exc}'.format_map(locals()))
+            except URLError as exc:
+                if meta is None:
+                    abort(1, 'Could not fetch {url}: {exc}'.format_map(locals()))
+                printer.warning(
+                    'Could not revalidate {url} ({exc}); using cached copy'.format_map(locals()))
+                return self._touch(path, meta)
+
+            self._evict(keep=path)
+            return path
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        path = os.path.join(self.root, key)
+        return path, '{path}.json'.format(path=path)
+
+    def _load(self, url):
+        """Load metadata for cached artifact, verifying its checksum.
+
+        Returns the path to the artifact and its metadata; the metadata
+        will be ``None`` if the artifact isn't cached or is corrupt.
+
+        """
+        path, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return path, None
+        if not os.path.isfile(path) or file_hash(path) != meta.get('sha256'):
+            printer.warning('Cached copy of {url} is missing or corrupt'.format_map(locals()))
+            self._remove(path)
+            return path, None
+        return path, meta
+
+    def _store(self, url, path, response, checksum):
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.fetch-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in iter(lambda: response.read(2 ** 16), b''):
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            if checksum and sha256 != checksum:
+                abort(1, 'Checksum mismatch for {url}: expected {checksum}; got {sha256}'
+                         .format_map(locals()))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': sha256,
+            'size': size,
+        }
+        self._touch(path, meta)
+        return meta
+
+    def _touch(self, path, meta):
+        meta['last_used'] = time.time()
+        _, meta_path = self._paths(meta['url'])
+        with open(meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        return path
+
+    def _remove(self, path):
+        for p in (path, '{path}.json'.format(path=path)):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def _evict(self, keep=None):
+        """Remove least recently used artifacts until under max size."""
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.root, name)) as meta_file:
+                    meta = json.load(meta_file)
+            except (OSError, ValueError):
+                continue
+            path = os.path.join(self.root, name[:-5])
+            entries.append((meta.get('last_used', 0), meta.get('size', 0), path, meta['url']))
+
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path, url in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            printer.info('Evicting {url} from artifact cache'.format_map(locals()))
+            self._remove(path)
+            total_size -= size
+
+
+class SdistCache:
+
+    """Cache for source distributions of local packages.
+
+    Args:
+        root: Directory to store sdists in; will be created if necessary
+
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    @classmethod
+    def from_config(cls, config):
+        """Create cache using ``cache.*`` config."""
+        return cls(os.path.join(config.cache.dir, 'sdists'))
+
+    def key(self, path):
+        """Get cache key for package at ``path``.
+
+        The key is derived from the package's git tree hash, a
+        fingerprint of its uncommitted changes, and the Python version
+        (since that's what runs ``setup.py``).
+
+        Returns ``None`` if ``path`` isn't in git, in which case its
+        sdist can't be cached.
+
+        """
+        tree_hash = git.tree_hash(path)
+        if tree_hash is None:
+            return None
+        dirty = git.dirty_fingerprint(path)
+        key = '\0'.join((tree_hash, dirty, sys.version))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Get paths of cached sdist files for ``key``.
+
+        Returns ``None`` if nothing is cached for ``key``.
+
+        """
+        if key is None:
+            return None
+        path = os.path.join(self.root, key)
+        if not os.path.isdir(path):
+            return None
+        names = sorted(os.listdir(path))
+        if not names:
+            return None
+        os.utime(path)
+        return [os.path.join(path, name) for name in names]
+
+    def put(self, key, dist_dir):
+        """Move the sdist files in ``dist_dir`` into the cache.
+
+        Returns paths of the cached sdist files.
+
+        """
+        path = os.path.join(self.root, key)
+        os.makedirs(self.root, exist_ok=True)
+        try:
+            os.rename(dist_dir, path)
+        except OSError:
+            # Another deploy cached the same sdist in the meantime.
+            shutil.rmtree(dist_dir)
+        return self.get(key)
+
+    def make_temp_dir(self):
+        """Make a temporary directory to build an sdist into.
+
+        It's created in the cache directory so it can be moved into
+        place atomically by :meth:`put`.
+
+        """
+        os.makedirs(self.root, exist_ok=True)
+        return tempfile.mkdtemp(dir=self.root, prefix='.build-')
+
+
+class BuildCache:
+
+    """Cache for build archives.
+
+    Archives are stored per codec, since they're pushed as is.
+
+    Args:
+        root: Directory to store archives in; will be created if
+            necessary
+        max_entries: Max number of archives to keep; the least recently
+            used archives are evicted first
+
+    """
+
+    def __init__(self, root, max_entries=10):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_entries = max_entries
+
+    @classmethod
+    def from_config(cls, config):
+        """Create cache using ``build_cache.*`` config."""
+        return cls(config.build_cache.dir, max_entries=config.build_cache.max_entries)
+
+    def path(self, key, codec):
+        name = '{key}.{codec.name}.{codec.extension}'.format_map(locals())
+        return os.path.join(self.root, name)
+
+    def get(self, key, codec):
+        """Get path of cached archive for ``key``, if there is one."""
+        path = self.path(key, codec)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, key, codec, write):
+        """Add archive for ``key`` to the cache.
+
+        Args:
+            write (callable): Called with a file object to write the
+                archive to; it should return a false value on success
+
+        """
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(key, codec)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.build-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                failed = write(temp_file)
+            if not failed:
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._evict()
+        return None if failed else path
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.root, name)
+            entries.append((os.stat(path).st_mtime, path))
+        for _, path in sorted(entries, reverse=True)[self.max_entries:]:
+            os.remove(path)
@@ -2,7 +2,8 @@ from runcommands.commands import *
 
 from .base import clean, install, lint, npm_install, retrieve, virtualenv
 from .db import createdb, load_prod_data, reset_db
-from .deploy import builds, clean_builds, deploy, link, restart, push_static
+from .deploy import (
+    benchmark_codecs, builds, clean_builds, deploy, deploy_stats, link, restart, push_static)
 from .django import (
     coverage, dbshell, makemigrations, migrate, runserver, mod_wsgi_express, shell, test)
 from .python import show_upgraded_packages
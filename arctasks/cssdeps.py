@@ -0,0 +1,223 @@
+"""Dependency tracking for incremental CSS builds.
+
+A LESS or SCSS source only needs to be compiled when it or one of the
+files it imports (directly or transitively) has changed, when the
+options it's compiled with have changed, or when its output is missing
+or has been modified since it was compiled.
+
+Imports are found by parsing ``@import`` statements. The content hash
+and imports of each file are cached along with the file's size and
+mtime so that files that haven't changed don't have to be reread.
+Sources with imports that can't be resolved (e.g., because they use
+variable interpolation) are always compiled.
+
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+from .util import file_hash
+
+
+__all__ = [
+    'CSSBuildCache',
+]
+
+
+_comment_re = re.compile(r'/\*.*?\*/|(?:^|(?<=\s))//[^\n]*', re.DOTALL | re.MULTILINE)
+_import_re = re.compile(
+    r'@(?:import|use|forward)\s*(?:\([^)]*\)\s*)?'
+    r'(?P<names>(?:"[^"]*"|\'[^\']*\'|url\([^)]*\)|[^;{}"\'])+);')
+_name_re = re.compile(r'''url\(\s*["']?(?P<url>[^"')]+?)["']?\s*\)|["'](?P<name>[^"']+)["']''')
+
+
+def find_imports(contents):
+    """Find names of files imported in ``contents`` (LESS or SCSS)."""
+    contents = _comment_re.sub('', contents)
+    names = []
+    for match in _import_re.finditer(contents):
+        for name_match in _name_re.finditer(match.group('names')):
+            names.append(name_match.group('url') or name_match.group('name'))
+    return names
+
+
+def is_external(name):
+    return name.startswith(('http://', 'https://', '//', 'data:'))
+
+
+def import_candidates(name, syntax):
+    """Get file names the compiler will try for the import ``name``."""
+    directory, base_name = os.path.split(name)
+    _, ext = os.path.splitext(base_name)
+    if syntax == 'less':
+        return [name] if ext in ('.less', '.css') else [name + '.less', name]
+    if ext in ('.scss', '.sass', '.css'):
+        return [name, os.path.join(directory, '_' + base_name)]
+    candidates = []
+    for ext in ('.scss', '.sass', '.css'):
+        candidates.extend((
+            os.path.join(directory, base_name + ext),
+            os.path.join(directory, '_' + base_name + ext),
+        ))
+    for ext in ('.scss', '.sass', '.css'):
+        candidates.extend((
+            os.path.join(name, '_index' + ext),
+            os.path.join(name, 'index' + ext),
+        ))
+    return candidates
+
+
+def resolve_import(name, directory, syntax, include_paths=()):
+    """Resolve the import ``name`` in a file in ``directory``.
+
+    Names starting with ``~`` are looked up in ``node_modules``
+    directories (starting in ``directory`` and working up). Other names
+    are looked up relative to ``directory`` and then in each of the
+    ``include_paths``.
+
+    Returns:
+        str: The absolute path of the imported file or ``None`` if it
+            can't be found
+
+    """
+    if '@{' in name or '#{' in name:
+        return None
+    if name.startswith('~'):
+        name = name[1:]
+        search_paths = []
+        current = os.path.abspath(directory)
+        while True:
+            search_paths.append(os.path.join(current, 'node_modules'))
+            parent = os.path.dirname(current)
+            if parent == current:
+                break
+            current = parent
+    else:
+        search_paths = [directory]
+        search_paths.extend(include_paths)
+    candidates = import_candidates(name, syntax)
+    for search_path in search_paths:
+        for candidate in candidates:
+            path = os.path.join(search_path, candidate)
+            if os.path.isfile(path):
+                return os.path.abspath(path)
+    return None
+
+
+class CSSBuildCache:
+
+    """Persistent cache of CSS sources, their imports, and their outputs.
+
+    Args:
+        path: JSON file the cache is stored in
+
+    Typical usage::
+
+        cache = CSSBuildCache(path)
+        fingerprint = cache.fingerprint(source, 'scss', options)
+        if not cache.is_current(source, destination, fingerprint):
+            # compile source to destination
+            cache.update(source, destination, fingerprint)
+        cache.save()
+
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = {}
+        self.files = data.get('files', {})
+        self.outputs = data.get('outputs', {})
+
+    def save(self):
+        with self.lock:
+            data = {'files': self.files, 'outputs': self.outputs}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = '{self.path}.tmp'.format_map(locals())
+            with open(temp_path, 'w') as fp:
+                json.dump(data, fp, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def file_info(self, path):
+        """Get the content hash and imports of the file at ``path``."""
+        st = os.stat(path)
+        with self.lock:
+            entry = self.files.get(path)
+        if entry is not None and (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime):
+            return entry
+        with open(path, 'rb') as fp:
+            contents = fp.read()
+        entry = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'sha256': hashlib.sha256(contents).hexdigest(),
+            'imports': find_imports(contents.decode('utf-8', errors='replace')),
+        }
+        with self.lock:
+            self.files[path] = entry
+        return entry
+
+    def fingerprint(self, source, syntax, options, include_paths=()):
+        """Get fingerprint of ``source``, its imports, and ``options``.
+
+        Args:
+            source: LESS or SCSS file
+            syntax: "less" or "scss"
+            options: Compile options (anything that can be serialized
+                to JSON)
+            include_paths: Additional directories imports are looked
+                up in
+
+        Returns:
+            str: The fingerprint or ``None`` if any of the imports
+                can't be resolved
+
+        """
+        hashes = {}
+        to_visit = [os.path.abspath(source)]
+        while to_visit:
+            path = to_visit.pop()
+            if path in hashes:
+                continue
+            info = self.file_info(path)
+            hashes[path] = info['sha256']
+            directory = os.path.dirname(path)
+            for name in info['imports']:
+                if is_external(name):
+                    continue
+                resolved = resolve_import(name, directory, syntax, include_paths)
+                if resolved is None:
+                    return None
+                to_visit.append(resolved)
+        data = json.dumps([sorted(hashes.items()), syntax, options], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def is_current(self, source, destination, fingerprint):
+        """Is ``destination`` up to date with respect to ``source``?"""
+        if fingerprint is None or not os.path.isfile(destination):
+            return False
+        with self.lock:
+            entry = self.outputs.get(os.path.abspath(source))
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        if entry['destination'] != os.path.abspath(destination):
+            return False
+        return entry['sha256'] == file_hash(destination)
+
+    def update(self, source, destination, fingerprint):
+        """Record that ``source`` was compiled to ``destination``."""
+        if fingerprint is None:
+            return
+        entry = {
+            'fingerprint': fingerprint,
+            'destination': os.path.abspath(destination),
+            'sha256': file_hash(destination),
+        }
+        with self.lock:
+            self.outputs[os.path.abspath(source)] = entry
@@ -1,27 +1,61 @@
+import copy
+import hashlib
 import json
 import os
 import posixpath
+import shlex
 import shutil
+import sqlite3
 import ssl
 import string
+import subprocess
 import sys
 import tarfile
 import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser, ExtendedInterpolation
 from datetime import datetime
 from urllib.error import HTTPError, URLError
-from urllib.request import urlopen, urlretrieve
+from urllib.request import urlopen
 
 from runcommands import command
-from runcommands.commands import show_config, local, remote
-from runcommands.util import abort, confirm, load_object, printer
+from runcommands.commands import show_config
+from runcommands.util import (
+    abort, args_to_str, cached_property, confirm, load_object, printer)
 
 from . import django
 from . import git
+from .archive import CODECS, get_codec, write_archive
+from .cache import ArtifactCache, BuildCache, SdistCache
 from .base import clean, install
-from .remote import manage as remote_manage, rsync, copy_file
+from .remote import (
+    RemoteBatch, manage as remote_manage, copy_file, fix_permissions, mark_changes, rsync,
+    rsync_bytes_sent, ssh_command, stream_tree)
+from .manifest import BuildManifest
+from .pipeline import Pipeline
+from .state import DeployState
 from .static import build_static, collectstatic
-from .util import abs_path
+from .steps import run_steps, show_step_timings
+from .trace import TraceHistory, Tracer, local, remote, traced
+from .util import abs_path, cpu_count, file_hash, sdist_hash
+
+
+# File transfers run during deployment are recorded in the deployment
+# trace (see Deployer.run); local and remote commands are traced by
+# .trace.
+rsync = traced(
+    rsync, 'rsync', host=True,
+    get_bytes=lambda config, args, kwargs, result: rsync_bytes_sent(result))
+copy_file = traced(
+    copy_file, 'copy_file', host=True,
+    get_bytes=lambda config, args, kwargs, result: os.path.getsize(
+        abs_path(args[0], format_kwargs=config)))
+stream_tree = traced(stream_tree, 'stream_tree', host=True)
+# Static files are collected in process (no command is run)
+collectstatic = traced(collectstatic, 'collectstatic')
 
 
 class Deployer:
@@ -59,45 +93,131 @@ class Deployer:
         if version is not None:
             config = config.copy(version=version)
 
+        if options.get('ssh_mux', True):
+            # The ssh-mux remote runner is registered by .remote
+            config = config.copy({'remote.strategy': 'ssh-mux'})
+
         self.options = self.init_options(config, options)
         self.config = config
         self.build_dir = config.path.build.root
+        self.build_manifest = BuildManifest(
+            self.build_dir, '{0}.manifest.json'.format(self.build_dir.rstrip(os.sep)))
+        self.artifact_cache = ArtifactCache.from_config(config, offline=options['offline'])
+        self.sdist_cache = SdistCache.from_config(config)
+        self.build_cache = BuildCache.from_config(config)
+        self.env_files_dir = config.path.build.env_root
         self.current_branch = git.current_branch()
 
         self.remote_build_root = config.remote.build.root
         self.remote_build_dir = config.remote.build.dir
+        self.hosts = list(self.options['hosts'] or [config.remote.host])
 
+        self.codec = get_codec(self.options['codec'])
         archive_directory = os.path.dirname(self.build_dir)
-        archive_file_name = '{config.version}.tgz'.format_map(locals())
+        archive_file_name = '{config.version}.{self.codec.extension}'.format_map(locals())
         self.archive_path = os.path.join(archive_directory, archive_file_name)
 
+        state_file_name = '{config.version}.deploy-state.json'.format_map(locals())
+        state_path = os.path.join(archive_directory, state_file_name)
+        if self.options['resume']:
+            self.state = DeployState.load(state_path)
+        else:
+            self.state = DeployState(state_path)
+        self.remote_state_path = posixpath.join(self.remote_build_dir, '.deploy-state.json')
+        self.remote_state_loaded = set()
+        # Local steps whose outputs existed before local preprocessing
+        # started (see step_outputs_exist)
+        self.existing_outputs = set()
+        # (scope, name) of steps that were actually run (not skipped);
+        # shared with the deployers for each host
+        self.steps_run = set()
+
+        self.tracer = Tracer()
+        trace_file_name = '{config.version}.trace.json'.format_map(locals())
+        self.trace_path = os.path.join(archive_directory, trace_file_name)
+        self.trace_history = TraceHistory(config.trace.history_file)
+
+        # Hosts that outputs have already been pushed to during local
+        # preprocessing (in pipelined push mode).
+        self.pipelined_hosts = set()
+
     def init_options(self, config, options):
         remove_distributions = list(options.get('remove_distributions') or ())
         options['remove_distributions'] = [config.distribution] + remove_distributions
         options['build_static'] = options['static'] and options['build_static']
+        options.setdefault('hosts', ())
+        options.setdefault('parallel_hosts', 4)
+        options.setdefault('activate_mode', 'all')
+        options.setdefault('resume', False)
+        options.setdefault('clean_build', False)
+        options.setdefault('build_cache', True)
+        options.setdefault('ssh_mux', True)
         return options
 
     def run(self):
-        """Deploy."""
+        """Deploy.
+
+        Deployment steps and the commands they run are traced (see
+        :meth:`save_trace`).
+
+        """
         self.show_info()
         self.confirm()
-        self.do_local_preprocessing()
-        if self.options['push']:
-            self.push()
-        self.do_remote_commands()
+        with self.tracer.activate():
+            try:
+                with self.tracer.span('deploy', 'deploy') as info:
+                    self.do_local_preprocessing()
+                    self.do_remote_commands()
+            finally:
+                self.save_trace(info['status'])
         if git.current_branch() != self.current_branch:
             git.run(['checkout', self.current_branch])
 
+    def save_trace(self, status):
+        """Write the deployment trace and add it to the history.
+
+        The trace is written in the Chrome trace event format to
+        ``build/{version}.trace.json`` and added to the SQLite database
+        at ``trace.history_file`` (see :func:`deploy_stats`).
+
+        """
+        config = self.config
+        tracer = self.tracer
+        trace_path = self.trace_path
+        duration = sum(span['duration'] for span in tracer.get_spans('deploy'))
+        tracer.write_chrome_trace(trace_path)
+        printer.info('Deployment trace written to {trace_path}'.format_map(locals()))
+        try:
+            self.trace_history.add(
+                tracer, config.package, config.env, config.version, duration, status)
+        except sqlite3.Error as exc:
+            printer.warning(
+                'Could not add trace to deployment history: {exc}'.format_map(locals()))
+
+    def for_host(self, host):
+        """Get a copy of this deployer that targets ``host``."""
+        deployer = copy.copy(self)
+        deployer.__dict__.pop('active_path', None)
+        deployer.config = self.config.copy({'remote.host': host})
+        deployer.hosts = [host]
+        return deployer
+
+    @cached_property
+    def active_path(self):
+        """Path to the active build on the remote host (or None)."""
+        _, active_path = get_active_version(self.config, echo=False, hide='all')
+        return active_path or None
+
     def show_info(self):
         """Show some info about what's being deployed."""
         config = self.config
         options = self.options
 
-        result = remote(
-            config, 'readlink {remote.path.env}', echo=False, hide='all', abort_on_failure=False)
-        active_path = result.stdout.strip()
+        active_path = self.active_path
 
-        printer.header('Preparing to deploy {name} to {env} ({remote.host})'.format_map(config))
+        hosts = ', '.join(self.hosts)
+        printer.header('Preparing to deploy {config.name} to {config.env} ({hosts})'
+                       .format_map(locals()))
         if active_path:
             active_version = posixpath.basename(active_path)
             printer.error('Active version: {} ({})'.format(active_version, active_path))
@@ -121,35 +241,419 @@ class Deployer:
     # Local
 
     def do_local_preprocessing(self):
-        """Prepare for deployment."""
+        """Prepare for deployment.
+
+        If the same source tree has already been built for the env, the
+        cached build is used and only the env-specific files are
+        generated (see :meth:`get_build_cache_key`).
+
+        """
         config = self.config
         options = self.options
 
         if options['version']:
             git.run(['checkout', options['version']])
+
+        build_cache_key = self.get_build_cache_key() if options['build_cache'] else None
+        if build_cache_key is not None:
+            cached_build = self.build_cache.get(build_cache_key, self.codec)
+            if cached_build is not None:
+                with self.tracer.span('use_cached_build', 'step'):
+                    self.use_cached_build(cached_build)
+                return
+
+        if options['version']:
             printer.header('Attempting to create a clean local install for version...')
             clean(config)
             install(config)
+            # clean() removes the build directory along with the state
+            # file, so the local steps recorded in the state are no
+            # longer valid.
+            self.state.set_scope('local', {})
 
-        self.make_build_dir()
-        if self.options['build_static']:
-            self.build_static()
-        self.make_dists()
-        self.copy_files()
-        self.create_archive()
+        self.existing_outputs = {
+            name for name in self.local_steps if self.step_outputs_exist(name)}
 
-    def make_build_dir(self):
-        """Make the local build directory."""
+        # Fingerprint the source before anything is built.
+        self.source_hash
+
+        if options['push'] and options['push_mode'] == 'pipelined':
+            timings = self.run_local_steps_pipelined()
+        else:
+            timings = run_steps(self.local_steps, self.run_local_step, jobs=options['jobs'])
+        timings = [t for t in timings if self.local_step_enabled(t[0])]
+        show_step_timings(timings, 'Local preprocessing step timings:')
+
+        if build_cache_key is not None:
+            self.cache_build(build_cache_key)
+
+    def run_local_steps_pipelined(self):
+        """Run local steps, pushing their outputs as they complete.
+
+        As soon as each local step completes, its outputs are pushed to
+        all hosts in the background while the remaining steps run (see
+        :meth:`push_step_outputs`). Whatever wasn't pushed this way is
+        pushed by :meth:`push_pipelined`.
+
+        """
+        printer.header('Pushing build outputs to hosts as they are completed...')
+        deployers = {host: self.for_host(host) for host in self.hosts}
+        pipeline = Pipeline(
+            self.hosts,
+            lambda host, name: deployers[host].push_step_outputs(name),
+            start=lambda host: deployers[host].prepare_pipelined_push(),
+            jobs=self.options['parallel_hosts'])
+        try:
+            timings = run_steps(
+                self.local_steps, self.run_local_step, jobs=self.options['jobs'],
+                on_complete=pipeline.add)
+        except BaseException:
+            pipeline.cancel()
+            raise
+        failures = pipeline.finish()
+        for host, exc in failures.items():
+            printer.warning(
+                'Could not push build outputs to {host} ahead of time ({exc}); '
+                'they will be pushed in the push step'.format_map(locals()))
+        return timings
+
+    def get_build_cache_key(self):
+        """Get the key for the current build in the build cache.
+
+        The key is derived from the env, the git tree of HEAD, the sdist
+        cache keys of local dependencies, the options that affect what's
+        in the build, and the config values listed in
+        ``build_cache.config_keys``. Env-specific files aren't part of
+        the build (see :meth:`copy_env_files`), but the static files are
+        collected using the env's Django settings (which can change
+        STATIC_ROOT and the static files manifest), so builds aren't
+        shared between envs.
+
+        Returns ``None`` if the build can't be cached because there are
+        uncommitted changes.
+
+        """
+        config = self.config
+        options = self.options
+        tree_hash = git.tree_hash()
+        if tree_hash is None or git.dirty_fingerprint():
+            printer.info('Not using build cache because there are uncommitted changes')
+            return None
+        deps = [self.sdist_cache.key(path) for path in options['deps']]
+        if None in deps:
+            return None
+        inputs = [
+            config.env,
+            tree_hash,
+            config.version,
+            deps,
+            {name: options[name] for name in ('static', 'build_static', 'provision')},
+            {key: config._get_dotted(key, None) for key in config.build_cache.config_keys},
+        ]
+        inputs = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+    def use_cached_build(self, path):
+        """Use the cached build archive at ``path``.
+
+        The archive is extracted into the build directory (which is
+        used by the stream and delta push modes and to determine which
+        wheels need to be built). For the archive push mode, the
+        archive itself is used as is.
+
+        """
+        printer.header('Using cached build: {path}'.format_map(locals()))
         build_dir = self.build_dir
         if os.path.isdir(build_dir):
-            printer.header(
-                'Removing existing build directory: {build_dir}...'.format_map(locals()))
             shutil.rmtree(build_dir)
-        printer.header('Creating build directory: {build_dir}'.format_map(locals()))
-        os.makedirs(build_dir)
-        os.makedirs(os.path.join(build_dir, 'dist'))
-        os.makedirs(os.path.join(build_dir, 'static'))
-        os.makedirs(os.path.join(build_dir, 'wsgi'))
+        # The build dir now doesn't match the manifest, so it will be
+        # recreated from scratch the next time it's built.
+        self.build_manifest.reset()
+        archive_dir = os.path.dirname(build_dir)
+        os.makedirs(archive_dir, exist_ok=True)
+        local(self.config, self.codec.extract_command(path), cd=archive_dir, hide='all')
+        if self.options['push_mode'] == 'archive':
+            if os.path.exists(self.archive_path):
+                os.remove(self.archive_path)
+            try:
+                os.link(path, self.archive_path)
+            except OSError:
+                shutil.copy(path, self.archive_path)
+        self.copy_env_files()
+
+    def cache_build(self, key):
+        """Add the current build to the build cache.
+
+        Only builds pushed in the archive push mode are cached, since
+        the archive that was pushed can be copied into the cache as is.
+        The other push modes don't create an archive, and creating one
+        just to cache it would slow down every deployment.
+
+        """
+        if not (self.local_step_enabled('create_archive') and os.path.isfile(self.archive_path)):
+            return
+        path = self.build_cache.put(
+            key, self.codec, lambda out_file: _copy_file_object(self.archive_path, out_file))
+        if path is not None:
+            printer.info('Cached build: {path}'.format_map(locals()))
+
+    # Local steps; each step is mapped to the steps it depends on. Steps
+    # that don't depend on each other are run concurrently. Steps are
+    # looked up by name, so subclasses can override individual steps or
+    # add steps by extending this mapping (in which case any new steps
+    # that must complete before the archive is created should be added
+    # to the dependencies of ``gc_build_dir``).
+    local_steps = OrderedDict((
+        ('make_build_dir', ()),
+        ('build_static', ('make_build_dir',)),
+        # build_static writes compiled CSS and JS into the project's
+        # source tree, which make_dists packages; the sdists of local
+        # dependencies don't include them, so they're made concurrently
+        ('make_dists', ('build_static',)),
+        ('make_dep_dists', ('make_build_dir',)),
+        ('copy_files', ('make_build_dir',)),
+        ('gc_build_dir', ('build_static', 'make_dists', 'make_dep_dists', 'copy_files')),
+        ('create_archive', ('gc_build_dir',)),
+        ('copy_env_files', ()),
+    ))
+
+    def run_local_step(self, name):
+        """Run the local step ``name`` if it's enabled."""
+        if self.local_step_enabled(name):
+            self.run_step(name)
+
+    def local_step_enabled(self, name):
+        """Is the local step ``name`` enabled?
+
+        By default, a step is enabled unless there's a corresponding
+        option that's been turned off (e.g., ``--no-build-static``). The
+        archive is only created when it's going to be pushed.
+
+        """
+        if name == 'create_archive':
+            return self.options['push_mode'] == 'archive'
+        return self.options.get(name, True)
+
+    # Checkpoints
+
+    def run_step(self, name, host=None):
+        """Run step ``name``, recording it in the deployment state.
+
+        Local steps are recorded in the "local" scope; remote steps are
+        recorded in the scope of the ``host`` they're run on. When
+        resuming, the step is skipped if it was already completed with
+        the same inputs (see :meth:`get_step_input_hash`), unless its
+        local outputs were missing or one of the steps it depends on was
+        run in this deployment.
+
+        """
+        scope = 'local' if host is None else host
+        input_hash = self.get_step_input_hash(name, host)
+        if host is None:
+            outputs_exist = name in self.existing_outputs
+        else:
+            outputs_exist = self.step_outputs_exist(name, host)
+        dependencies_run = any(
+            ('local' if dependency_host is None else dependency_host, dependency) in self.steps_run
+            for (dependency, dependency_host) in self.get_step_dependencies(name, host))
+        resume = self.options['resume'] and outputs_exist and not dependencies_run
+        if resume and self.state.is_done(scope, name, input_hash):
+            if host is None:
+                message = 'Skipping {name}; unchanged since last run'
+            else:
+                message = 'Skipping {name} on {host}; unchanged since last run'
+            printer.info(message.format_map(locals()))
+            if host is None:
+                self.build_manifest.claim_step(name)
+            return
+        with self.tracer.span(name, 'step', host=host):
+            getattr(self, name)()
+        self.steps_run.add((scope, name))
+        if input_hash is not None:
+            self.state.mark_done(scope, name, input_hash)
+
+    def get_step_input_hash(self, name, host=None):
+        """Get hash of the inputs to step ``name``.
+
+        The inputs to a step are the project source (the git tree plus
+        any uncommitted changes), the options that affect the step, and
+        the inputs to the steps it depends on. For local steps, those are
+        its dependencies in :attr:`local_steps`; each remote step depends
+        on the preceding remote step, and ``push`` depends on all local
+        steps.
+
+        Returns ``None`` if the inputs can't be determined (e.g., if the
+        project isn't in git), in which case the step will always be
+        run.
+
+        """
+        source_hash = self.source_hash
+        if source_hash is None:
+            return None
+
+        if host is None:
+            enabled = self.local_step_enabled(name)
+        else:
+            enabled = self.options.get(name, True)
+
+        inputs = [name, source_hash, enabled, self.get_step_inputs(name)]
+        for dependency, dependency_host in self.get_step_dependencies(name, host):
+            dependency_hash = self.get_step_input_hash(dependency, dependency_host)
+            if dependency_hash is None:
+                return None
+            inputs.append(dependency_hash)
+
+        inputs = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+    def get_step_dependencies(self, name, host=None):
+        """Get the steps that step ``name`` depends on.
+
+        Returns:
+            list: ``(name, host)`` for each dependency; ``host`` is
+                ``None`` for local steps
+
+        """
+        if host is None:
+            dependencies = self.local_steps.get(name, ())
+        elif name == 'push':
+            dependencies = tuple(self.local_steps)
+        else:
+            index = self.remote_commands.index(name) if name in self.remote_commands else 0
+            dependencies = self.remote_commands[index - 1:index]
+        return [
+            (dependency, None if dependency in self.local_steps else host)
+            for dependency in dependencies]
+
+    def step_outputs_exist(self, name, host=None):
+        """Check whether the local outputs of step ``name`` exist.
+
+        This is checked for each local step when local preprocessing
+        starts (after any ``clean``) rather than when the step is run,
+        since ``make_build_dir`` recreates the build directory. Local
+        steps are always run when the build directory (or, for
+        ``create_archive``, the archive) was missing.
+
+        """
+        if host is not None:
+            return True
+        if name == 'create_archive':
+            return os.path.isfile(self.archive_path)
+        if name == 'copy_env_files':
+            return os.path.isdir(self.env_files_dir)
+        return os.path.isdir(self.build_dir)
+
+    def get_step_inputs(self, name):
+        """Get step-specific inputs for step ``name``.
+
+        These are the options and files that affect the step beyond the
+        project source. Subclasses that add steps or change what a step
+        does should extend this.
+
+        """
+        config = self.config
+        options = self.options
+        if name == 'make_dep_dists':
+            return [self.sdist_cache.key(path) for path in options['deps']]
+        if name == 'copy_env_files':
+            paths = (config.local_settings_file.split('#')[0], 'commands.cfg')
+            return [file_hash(path) for path in paths if os.path.isfile(path)]
+        if name == 'create_archive':
+            return self.codec.name
+        if name == 'push':
+            return [options['push_mode'], self.codec.name, options['static']]
+        if name == 'provision':
+            return options['venv_mode']
+        if name == 'install':
+            return options['remove_distributions']
+        if name == 'warm_up':
+            return dict(config.warmup)
+        return None
+
+    @cached_property
+    def source_hash(self):
+        """Hash of the project source, including uncommitted changes."""
+        tree_hash = git.tree_hash()
+        if tree_hash is None:
+            return None
+        return [tree_hash, git.dirty_fingerprint(), self.config.version]
+
+    def load_remote_state(self):
+        """Load state for this deployer's host from the remote host.
+
+        The state stored on the remote host is authoritative for that
+        host (e.g., if the build directory has been removed, none of its
+        remote steps will be considered done).
+
+        """
+        host = self.hosts[0]
+        result = remote(
+            self.config, ('cat', self.remote_state_path), echo=False, hide='all',
+            abort_on_failure=False)
+        steps = {}
+        if result.succeeded:
+            try:
+                steps = json.loads(result.stdout)
+            except ValueError:
+                printer.warning('Could not parse deploy state on {host}'.format_map(locals()))
+        self.state.set_scope(host, steps)
+
+    def save_remote_state(self):
+        """Save state for this deployer's host to the remote host."""
+        host = self.hosts[0]
+        steps = json.dumps(self.state.get_scope(host), sort_keys=True)
+        remote_state_path = self.remote_state_path
+        remote(self.config, (
+            'test -d', posixpath.dirname(remote_state_path),
+            '&& echo', shlex.quote(steps), '>', remote_state_path,
+        ), echo=False, hide='all', abort_on_failure=False, inject_config=False)
+
+    def make_build_dir(self):
+        """Make the local build directory.
+
+        An existing build directory is updated in place: files are
+        written through the build manifest, so only files that have
+        changed are rewritten, and stale files are removed afterwards
+        by :meth:`gc_build_dir`.
+
+        If the ``clean_build`` option is set or there's no manifest for
+        an existing build directory (e.g., because it was created by an
+        older version of ARC Tasks), it's removed and recreated.
+
+        """
+        build_dir = self.build_dir
+        manifest = self.build_manifest
+        if os.path.isdir(build_dir):
+            if self.options['clean_build'] or not manifest.exists():
+                printer.header(
+                    'Removing existing build directory: {build_dir}...'.format_map(locals()))
+                shutil.rmtree(build_dir)
+                manifest.reset()
+            else:
+                printer.header(
+                    'Updating existing build directory: {build_dir}'.format_map(locals()))
+        else:
+            manifest.reset()
+        if not os.path.isdir(build_dir):
+            printer.header('Creating build directory: {build_dir}'.format_map(locals()))
+        os.makedirs(build_dir, exist_ok=True)
+        os.makedirs(os.path.join(build_dir, 'dist'), exist_ok=True)
+        os.makedirs(os.path.join(build_dir, 'static'), exist_ok=True)
+        os.makedirs(os.path.join(build_dir, 'wsgi'), exist_ok=True)
+
+    def gc_build_dir(self):
+        """Remove stale files from the build directory.
+
+        Stale files are files that were written in a previous build but
+        not in this one (e.g., sdists for an old version of a package).
+
+        """
+        removed = self.build_manifest.gc()
+        self.build_manifest.save()
+        if removed:
+            num_removed = len(removed)
+            printer.info(
+                'Removed {num_removed} stale file(s) from build directory'.format_map(locals()))
 
     def build_static(self):
         """Process static files and collect them.
@@ -160,48 +664,149 @@ class Deployer:
         """
         printer.header('Building static files...')
         static_root = self.config.path.build.static_root
-        build_static(self.config, collect=False)
-        collectstatic(self.config, static_root=static_root, hide='stdout')
+        self.build_manifest.step('build_static').tree(static_root)
+        build_static(
+            self.config, collect=False, force=self.options['clean_build'],
+            jobs=self.options['jobs'])
+        collectstatic(
+            self.config, static_root=static_root, incremental=not self.options['clean_build'],
+            manifest_file='{0}.static.json'.format(self.build_dir.rstrip(os.sep)),
+            hide='stdout')
 
     def make_dists(self):
-        printer.header('Making source distributions...')
+        """Make sdist for the project.
+
+        sdists are cached by git tree hash plus a fingerprint of any
+        uncommitted changes, so packages that haven't changed since
+        they were last built aren't rebuilt.
+
+        """
+        printer.header('Making source distribution...')
+        self.make_sdists('make_dists', ('.',))
+
+    def make_dep_dists(self):
+        """Make sdists for local dependencies and get ARC Tasks.
+
+        This doesn't depend on the project's static files being built,
+        so it runs concurrently with :meth:`build_static`. Dependencies
+        that need to be built are built concurrently.
+
+        """
+        printer.header('Making source distributions for dependencies...')
+        config = self.config
+        outputs = self.build_manifest.step('make_dep_dists')
+        self.make_sdists('make_dep_dists', self.options['deps'])
+        arctasks_path = self.artifact_cache.fetch(config.arctasks.download_url)
+        outputs.copy(
+            arctasks_path, os.path.join(config.path.build.dist, 'psu.oit.arc.tasks-0.0.0.tar.gz'))
+
+    def make_sdists(self, step, paths):
+        """Make sdists for ``paths``, recording them as outputs of ``step``."""
         config = self.config
         options = self.options
         dist_dir = config.path.build.dist
-        make_dist(config, '.', dist_dir=dist_dir)
-        for path in options['deps']:
-            make_dist(config, path, dist_dir)
-        urlretrieve(
-            'https://github.com/PSU-OIT-ARC/arctasks/archive/master.tar.gz',
-            os.path.join(dist_dir, 'psu.oit.arc.tasks-0.0.0.tar.gz'))
+        outputs = self.build_manifest.step(step)
+
+        to_build = []
+        for path in paths:
+            key = self.sdist_cache.key(path)
+            cached = self.sdist_cache.get(key)
+            if cached:
+                printer.info('Using cached sdist for {path}'.format_map(locals()))
+                for cached_path in cached:
+                    name = os.path.basename(cached_path)
+                    outputs.copy(cached_path, os.path.join(dist_dir, name))
+            else:
+                to_build.append((path, key))
+
+        if to_build:
+            jobs = min(options['jobs'] or cpu_count(), len(to_build))
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(self.make_dist, step, path, key) for (path, key) in to_build]
+            for future in futures:
+                future.result()
+
+    def make_dist(self, step, path, key):
+        """Make sdist for ``path``, caching it if possible."""
+        config = self.config
+        dist_dir = config.path.build.dist
+        outputs = self.build_manifest.step(step)
+        if key is None:
+            temp_dir = tempfile.mkdtemp()
+        else:
+            temp_dir = self.sdist_cache.make_temp_dir()
+        try:
+            make_dist(config, path, temp_dir)
+            if key is None:
+                dist_paths = [os.path.join(temp_dir, name) for name in os.listdir(temp_dir)]
+            else:
+                dist_paths = self.sdist_cache.put(key, temp_dir)
+            for dist_path in dist_paths:
+                outputs.copy(dist_path, os.path.join(dist_dir, os.path.basename(dist_path)))
+        finally:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
 
     def copy_files(self):
+        """Copy files that are the same for all envs into the build."""
         config = self.config
         build_dir = self.build_dir
+        outputs = self.build_manifest.step('copy_files')
 
-        copy_file_local(config, 'local.base.cfg', build_dir)
-        copy_file_local(config, config.local_settings_file, os.path.join(build_dir, 'local.cfg'))
-        copy_file_local(config, config.wsgi_file, os.path.join(build_dir, 'wsgi'))
+        copy_file_local(config, 'local.base.cfg', build_dir, outputs=outputs)
+        copy_file_local(config, config.wsgi_file, os.path.join(build_dir, 'wsgi'), outputs=outputs)
 
         # Copy requirements file. If a frozen requirements files exists,
         # copy that; if it doesn't, copy a default requirements file.
         destination_path = os.path.join(build_dir, 'requirements.txt')
         if os.path.isfile('requirements-frozen.txt'):
-            copy_file_local(config, 'requirements-frozen.txt', destination_path)
+            copy_file_local(config, 'requirements-frozen.txt', destination_path, outputs=outputs)
         else:
             path = 'arctasks:templates/requirements.txt.template'
-            copy_file_local(config, path, destination_path, template=True)
+            copy_file_local(config, path, destination_path, template=True, outputs=outputs)
+
+        # Copy RunCommands commands
+        if os.path.exists('commands.py'):
+            copy_file_local(config, 'commands.py', build_dir, outputs=outputs)
+
+        if self.options['provision']:
+            # Download (or get cached) and copy virtualenv
+            tarball_path = self.artifact_cache.fetch(
+                config.virtualenv.download_url, checksum=config.virtualenv.sha256)
+            virtualenv_dir = os.path.join(build_dir, 'virtualenv')
+            if not outputs.tree(virtualenv_dir, key=file_hash(tarball_path)):
+                extract_dir = os.path.join(build_dir, config.virtualenv.base_name)
+                for path in (virtualenv_dir, extract_dir):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                with tarfile.open(tarball_path, 'r') as tarball:
+                    tarball.extractall(build_dir)
+                os.rename(extract_dir, virtualenv_dir)
+
+    def copy_env_files(self):
+        """Copy env-specific files into the env files directory.
+
+        These files aren't part of the build (so the build can be reused
+        across envs); they're overlaid on the build when it's pushed.
+
+        """
+        config = self.config
+        env_dir = self.env_files_dir
+        if os.path.isdir(env_dir):
+            shutil.rmtree(env_dir)
+        os.makedirs(env_dir)
+
+        copy_file_local(config, config.local_settings_file, os.path.join(env_dir, 'local.cfg'))
 
         # Copy scripts
         kwargs = dict(template=True, mode=0o770)
-        copy_file_local(config, '{remote.build.manage_template}', build_dir, **kwargs)
-        copy_file_local(config, '{remote.build.restart_template}', build_dir, **kwargs)
-        copy_file_local(config, '{remote.build.runcommands_template}', build_dir, **kwargs)
-
-        # Copy RunCommands commands & config
-        if os.path.exists('commands.py'):
-            copy_file_local(config, 'commands.py', build_dir)
+        copy_file_local(config, '{remote.build.manage_template}', env_dir, **kwargs)
+        copy_file_local(config, '{remote.build.restart_template}', env_dir, **kwargs)
+        copy_file_local(config, '{remote.build.runcommands_template}', env_dir, **kwargs)
+        copy_file_local(config, '{remote.build.warmup_template}', env_dir, **kwargs)
 
+        # Copy RunCommands config
         if os.path.exists('commands.cfg'):
             commands_config = ConfigParser(interpolation=ExtendedInterpolation())
             with open('commands.cfg') as commands_file:
@@ -213,66 +818,256 @@ class Deployer:
             }
             extra_config = {k: json.dumps(v) for (k, v) in extra_config.items()}
             commands_config['DEFAULT'].update(extra_config)
-            temp_fd, temp_file = tempfile.mkstemp(text=True)
-            with os.fdopen(temp_fd, 'w') as t:
-                commands_config.write(t)
-            copy_file_local(config, temp_file, os.path.join(build_dir, 'commands.cfg'))
-
-        if self.options['provision']:
-            # Download and copy virtualenv
-            tarball_path = os.path.join(build_dir, 'virtualenv.tgz')
-            urlretrieve(config.virtualenv.download_url, tarball_path)
-            with tarfile.open(tarball_path, 'r') as tarball:
-                tarball.extractall(build_dir)
-            os.remove(tarball_path)
-            os.rename(
-                os.path.join(build_dir, config.virtualenv.base_name),
-                os.path.join(build_dir, 'virtualenv'))
+            with open(os.path.join(env_dir, 'commands.cfg'), 'w') as commands_file:
+                commands_config.write(commands_file)
 
     def create_archive(self):
-        printer.header('Creating archive...')
-        with tarfile.open(self.archive_path, mode='w:gz') as tarball:
-            tarball.add(self.build_dir, self.config.version)
+        printer.header('Creating archive ({self.codec.name})...'.format_map(locals()))
+        # The archive may be a hard link to a cached build, which must
+        # not be overwritten.
+        if os.path.exists(self.archive_path):
+            os.remove(self.archive_path)
+        with open(self.archive_path, 'wb') as archive_file:
+            return_code = write_archive(
+                self.build_dir, self.config.version, archive_file, self.codec)
+        if return_code:
+            message = 'Archive compression failed with exit code {return_code}'
+            abort(2, message.format_map(locals()))
 
     def push(self):
-        printer.header('Pushing archive...')
+        """Push the build to the remote host.
+
+        How the build is pushed depends on the ``push_mode`` option:
+
+            - archive: Copy the archive created by :meth:`create_archive`
+              to the remote host, then extract it there
+            - stream: Stream a tarball of the build directory straight
+              into ``tar x`` on the remote host over a single SSH
+              connection (no archive is created)
+            - delta: rsync the build directory to the remote host,
+              hard linking files that are unchanged from the active
+              build (via ``--link-dest``) so only changed files are
+              transferred (no archive is created)
+            - pipelined: Like delta, but the outputs of each local step
+              are pushed as soon as the step completes, while the
+              remaining local steps are still running; this finishes
+              by syncing the entire build directory
+
+        """
         config = self.config
         options = self.options
-        build_root = self.remote_build_root
         build_dir = self.remote_build_dir
 
-        if self.options['overwrite']:
-            remote(config, ('rm -rf', build_dir), host='hrimfaxi.oit.pdx.edu')
+        # In pipelined mode, the build dir may already have been removed
+        # before outputs were pushed to it.
+        if options['overwrite'] and self.hosts[0] not in self.pipelined_hosts:
+            remote(config, ('rm -rf', build_dir))
 
-        copy_file(self.config, self.archive_path, self.config.remote.build.root, quiet=True)
+        if self.hosts[0] not in self.pipelined_hosts:
+            mark_changes(config, '{remote.build.permissions_marker}', run_as='{service.user}')
 
-        remote(config, (
-            'tar xvf', os.path.basename(self.archive_path),
-        ), cd=build_root, hide='stdout')
+        push_mode = options['push_mode']
+        getattr(self, 'push_{push_mode}'.format_map(locals()))()
+        self.push_env_files()
 
         if options['static']:
             remote(config, (
                 'rsync -rlqtvz --exclude staticfiles.json static/ {remote.path.static}',
             ), cd=build_dir)
 
+    def push_env_files(self):
+        """Overlay env-specific files on the pushed build."""
+        printer.header('Pushing env files...')
+        env_dir = os.path.join(self.env_files_dir, '')
+        rsync(self.config, env_dir, self.remote_build_dir, quiet=True, stats=True)
+
+    def push_archive(self):
+        printer.header('Pushing archive...')
+        config = self.config
+        build_root = self.remote_build_root
+
+        copy_file(self.config, self.archive_path, self.config.remote.build.root, quiet=True)
+
+        archive_name = os.path.basename(self.archive_path)
+        remote(config, self.codec.extract_command(archive_name), cd=build_root, hide='stdout')
+
+    def push_stream(self):
+        printer.header('Streaming build...')
+        stream_tree(
+            self.config, self.build_dir, self.remote_build_root, self.config.version,
+            codec=self.codec)
+
+    def push_delta(self, header='Pushing changes relative to active build...'):
+        printer.header(header)
+        build_dir = os.path.join(self.build_dir, '')
+        # Files in the build dir are written fresh for each version, so
+        # their mtimes never match those in the active build; times
+        # aren't preserved so that unchanged files are linked by content.
+        rsync(
+            self.config, build_dir, self.remote_build_dir, checksum=True,
+            link_dest=self.get_link_dest(), times=False, quiet=True, stats=True)
+
+    def push_pipelined(self):
+        # Step outputs have already been pushed; this syncs anything
+        # that wasn't, the same way a delta push would.
+        self.push_delta(header='Syncing build...')
+
+    def get_link_dest(self):
+        """Get the active build dir to hard link unchanged files from."""
+        active_path = self.active_path
+        if active_path == self.remote_build_dir:
+            active_path = None
+        if active_path is None:
+            printer.warning('No other active build to compare against; pushing entire build')
+        else:
+            printer.info('Comparing against {active_path}'.format_map(locals()))
+        return active_path
+
+    def prepare_pipelined_push(self):
+        """Prepare the remote host for :meth:`push_step_outputs`."""
+        host = self.hosts[0]
+        if self.options['overwrite']:
+            remote(self.config, ('rm -rf', self.remote_build_dir), echo=False, hide='all')
+        mark_changes(
+            self.config, '{remote.build.permissions_marker}', run_as='{service.user}')
+        self.pipelined_hosts.add(host)
+        self.pipelined_link_dest = self.get_link_dest()
+
+    def push_step_outputs(self, name):
+        """Push the outputs of the local step ``name``."""
+        host = self.hosts[0]
+        if name == 'copy_env_files':
+            self.push_env_files()
+            return
+        paths = self.build_manifest.outputs(name)
+        if not paths:
+            return
+        with tempfile.NamedTemporaryFile('w', prefix='arctasks-push-') as files_from:
+            files_from.write('\n'.join(paths) + '\n')
+            files_from.flush()
+            rsync(
+                self.config, os.path.join(self.build_dir, ''), self.remote_build_dir,
+                checksum=True, link_dest=self.pipelined_link_dest, times=False,
+                files_from=files_from.name, quiet=True, echo=False, stats=True)
+        printer.info('Pushed outputs of {name} to {host}'.format_map(locals()))
+
     # Remote
 
     remote_commands = (
+        'push',
         'provision',
         'wheels',
         'install',
+        'compile',
         'migrate',
+        'warm_up',
         'make_active',
         'set_permissions',
     )
 
+    # Remote commands that are only run on the first host (e.g., because
+    # they affect shared resources such as the database).
+    run_once_commands = ('migrate',)
+
     def do_remote_commands(self):
-        """Build the new deployment environment."""
-        for remote_command in self.remote_commands:
-            if self.options[remote_command]:
-                getattr(self, remote_command)()
+        """Build the new deployment environment on each host.
+
+        When deploying to multiple hosts, consecutive remote commands
+        are run on all of the hosts concurrently (up to the
+        ``parallel_hosts`` option at a time), with each host running
+        through the commands independently. Commands listed in
+        :attr:`run_once_commands` are run only on the first host, once
+        all hosts have completed the preceding commands.
+
+        ``make_active`` is run in a final, coordinated phase once all
+        hosts are ready: either on all hosts at once or one host at a
+        time, depending on the ``activate_mode`` option (see
+        :meth:`activate`).
+
+        """
+        commands = [name for name in self.remote_commands if self.options[name]]
+        chain = []
+        for name in commands:
+            if name in self.run_once_commands or name == 'make_active':
+                self.on_hosts(chain)
+                chain = []
+                if name == 'make_active':
+                    self.activate()
+                else:
+                    self.on_hosts([name], self.hosts[:1])
+            else:
+                chain.append(name)
+        self.on_hosts(chain)
+
+    def on_hosts(self, commands, hosts=None):
+        """Run ``commands`` on ``hosts`` concurrently.
+
+        Each host runs through the commands in order. If any host fails,
+        the deployment is aborted once the other hosts have finished the
+        command they're running.
+
+        """
+        hosts = self.hosts if hosts is None else hosts
+        if not commands:
+            return
+
+        def run_commands(deployer):
+            host = deployer.hosts[0]
+            if self.options['resume'] and host not in self.remote_state_loaded:
+                deployer.load_remote_state()
+                self.remote_state_loaded.add(host)
+            try:
+                for name in commands:
+                    deployer.run_step(name, host)
+            finally:
+                deployer.save_remote_state()
+
+        if len(hosts) == 1:
+            run_commands(self.for_host(hosts[0]))
+            return
+
+        names = ', '.join(commands)
+        printer.header('Running {names} on {num_hosts} hosts...'.format(
+            names=names, num_hosts=len(hosts)))
+        jobs = min(self.options['parallel_hosts'] or len(hosts), len(hosts))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = OrderedDict(
+                (host, executor.submit(run_commands, self.for_host(host))) for host in hosts)
+        failed = [host for (host, future) in futures.items() if future.exception() is not None]
+        if failed:
+            failed = ', '.join(failed)
+            abort(1, 'Deployment failed on: {failed}'.format_map(locals()))
+
+    def activate(self):
+        """Make the new version active on all hosts.
+
+        In "all" mode (the default), the new version is made active on
+        all hosts at once and then checked (see :func:`restart`). In
+        "rolling" mode, the new version is made active on one host at a
+        time and checked after each host, so a failure will leave the
+        remaining hosts running the previous version.
+
+        """
+        if self.options['activate_mode'] == 'rolling' and len(self.hosts) > 1:
+            for host in self.hosts:
+                printer.info('Activating new version on {host}...'.format_map(locals()))
+                self.on_hosts(['make_active'], [host])
+                self.check_active(final=host == self.hosts[-1])
+        else:
+            self.on_hosts(['make_active'])
+            self.check_active()
 
     def provision(self):
+        """Create the virtualenv for the build.
+
+        By default, a fresh virtualenv is created. When the
+        ``venv_mode`` option is "clone", the active build's virtualenv
+        is cloned instead (see :meth:`clone_venv`); if that's not
+        possible, a fresh virtualenv is created.
+
+        """
+        if self.options['venv_mode'] == 'clone' and self.clone_venv():
+            return
         printer.header('Provisioning...')
         remote(self.config, (
             'test -d {remote.build.venv} ||',
@@ -281,27 +1076,127 @@ class Deployer:
             '{remote.build.venv}'
         ))
 
+    def clone_venv(self):
+        """Clone the active build's virtualenv into the new build.
+
+        Files are hard linked where possible. Scripts and ``.pth`` files
+        are then rewritten with paths pointing into the new virtualenv
+        (which also ensures they're no longer shared with the active
+        build). pip replaces files rather than modifying them in place,
+        so installing into the clone doesn't affect the active build.
+
+        Since the clone already contains the active build's packages,
+        :meth:`install` only has to install what's changed.
+
+        Returns ``True`` if the virtualenv was cloned (or already
+        exists) or ``False`` if there's no active virtualenv to clone.
+
+        """
+        config = self.config
+        active_path = self.active_path
+        venv = config.remote.build.venv
+
+        if active_path is None or active_path == self.remote_build_dir:
+            printer.warning('No other active build; not cloning virtualenv')
+            return False
+
+        active_venv = posixpath.join(active_path, '.env')
+        result = remote(config, ('test -d', active_venv), echo=False, abort_on_failure=False)
+        if result.failed:
+            printer.warning('Active build has no virtualenv; not cloning virtualenv')
+            return False
+
+        printer.header('Cloning virtualenv from {active_venv}...'.format_map(locals()))
+        with RemoteBatch(config) as batch:
+            batch.add((
+                'test -d', venv, '||',
+                'cp -al', active_venv, venv, '||',
+                '{ rm -rf', venv, '&& cp -a', active_venv, venv, '; }',
+            ), inject_config=False)
+            batch.add((
+                'find', posixpath.join(venv, 'bin'), posixpath.join(venv, 'lib'), '-type f',
+                "\\( -path '{venv}/bin/*' -o -name '*.pth' -o -name '*.egg-link' \\)".format(
+                    venv=venv),
+                '-exec grep -lIZ . {} +',
+                '| xargs -0 -r sed -i "s|{active_venv}|{venv}|g"'.format_map(locals()),
+            ), inject_config=False)
+        return True
+
     def wheels(self):
-        """Build and cache packages (as wheels)."""
+        """Build and cache packages (as wheels).
+
+        A stamp containing hashes of the build's requirements and
+        distributions is saved in ``remote.pip.wheel_dir`` after wheels
+        are built. When the stamp for the current build matches the
+        saved stamp, building wheels is skipped entirely. When only
+        some distributions have changed, only those are rebuilt.
+
+        """
         printer.header('Building wheels...')
         config = self.config
         options = self.options
         wheel_dir = config.remote.pip.wheel_dir
+        stamp_path = posixpath.join(wheel_dir, '.arctasks-stamp.json')
+        stamp = self.get_wheel_stamp()
+
+        result = remote(
+            config, ('cat', stamp_path), echo=False, hide='all', abort_on_failure=False)
+        try:
+            previous_stamp = json.loads(result.stdout) if result else None
+        except ValueError:
+            previous_stamp = None
+
+        if stamp == previous_stamp:
+            printer.info('Requirements and distributions unchanged; skipping wheel build')
+            return
+
+        if previous_stamp and previous_stamp.get('requirements') == stamp['requirements']:
+            previous_dists = previous_stamp.get('dists', {})
+            changed_dists = sorted(
+                file_name for (file_name, dist_hash) in stamp['dists'].items()
+                if previous_dists.get(file_name) != dist_hash)
+            printer.info('Requirements unchanged; rebuilding changed distributions only')
+            dists_to_remove = [file_name.rsplit('-', 1)[0] for file_name in changed_dists]
+            to_build = [posixpath.join(config.remote.build.dist, f) for f in changed_dists]
+        else:
+            dists_to_remove = options['remove_distributions']
+            to_build = ['-r {remote.build.dir}/requirements.txt']
+
         paths_to_remove = []
-        for dist in options['remove_distributions']:
+        for dist in dists_to_remove:
             path = '/'.join((wheel_dir, '{dist}*'.format(dist=dist.replace('-', '_'))))
             paths_to_remove.append(path)
-        remote(config, ('rm -f', paths_to_remove))
-        remote(config, (
-            'LANG=en_US.UTF-8',
-            '{remote.build.pip} wheel',
-            '--wheel-dir {remote.pip.wheel_dir}',
-            '--cache-dir {remote.pip.cache_dir}',
-            '--find-links {remote.build.dist}',
-            '--find-links {remote.pip.find_links}',
-            '--disable-pip-version-check',
-            '-r {remote.build.dir}/requirements.txt',
-        ))
+
+        stamp = json.dumps(stamp, separators=(',', ':'), sort_keys=True)
+
+        with RemoteBatch(config) as batch:
+            if paths_to_remove:
+                batch.add(('rm -f', paths_to_remove))
+            if to_build:
+                batch.add((
+                    'LANG=en_US.UTF-8',
+                    '{remote.build.pip} wheel',
+                    '--wheel-dir {remote.pip.wheel_dir}',
+                    '--cache-dir {remote.pip.cache_dir}',
+                    '--find-links {remote.build.dist}',
+                    '--find-links {remote.pip.find_links}',
+                    '--disable-pip-version-check',
+                    to_build,
+                ))
+            batch.add(('echo', shlex.quote(stamp), '>', stamp_path), inject_config=False)
+
+    def get_wheel_stamp(self):
+        """Get hashes of the build's requirements and distributions."""
+        build_dir = self.build_dir
+        dist_dir = self.config.path.build.dist
+        requirements_hash = file_hash(os.path.join(build_dir, 'requirements.txt'))
+        dist_hashes = {}
+        for file_name in os.listdir(dist_dir):
+            dist_hashes[file_name] = sdist_hash(os.path.join(dist_dir, file_name))
+        return {
+            'requirements': requirements_hash,
+            'dists': dist_hashes,
+        }
 
     def install(self):
         """Install new version in deployment environment."""
@@ -309,27 +1204,132 @@ class Deployer:
         config = self.config
         options = self.options
 
-        uninstall_commands = []
-        for dist in options['remove_distributions']:
-            uninstall_commands.append(
-                '{config.remote.build.pip} uninstall -y {dist}'.format_map(locals()))
-        if uninstall_commands:
-            remote(config, '; '.join(uninstall_commands), abort_on_failure=False)
+        with RemoteBatch(config) as batch:
+            for dist in options['remove_distributions']:
+                batch.add(('{remote.build.pip} uninstall -y', dist), abort_on_failure=False)
+            batch.add((
+                '{remote.build.pip} install',
+                '--no-index',
+                '--find-links {remote.pip.wheel_dir}',
+                '--disable-pip-version-check',
+                '--no-compile',
+                '-r {remote.build.dir}/requirements.txt',
+            ))
+
+    def compile(self):
+        """Byte-compile the build's virtualenv and WSGI module.
 
-        remote(config, (
-            '{remote.build.pip} install',
-            '--no-index',
-            '--find-links {remote.pip.wheel_dir}',
-            '--disable-pip-version-check',
-            '--no-compile',
-            '-r {remote.build.dir}/requirements.txt',
-        ))
+        Packages are installed with ``--no-compile``, so without this
+        the first requests after the new version is made active would
+        have to compile every module (in every worker process).
+
+        All cores on the remote host are used. On Python 3.5+, this is
+        done with ``compileall -j0``; on older versions, the files are
+        distributed across ``compileall`` processes via ``xargs -P``.
+
+        Modules that fail to compile (e.g., Python 2-only modules that
+        are never imported) aren't considered fatal.
+
+        """
+        printer.header('Byte-compiling...')
+        config = self.config
+        paths = '{remote.build.venv} {remote.build.wsgi_dir}'
+        python = '{remote.build.python}'
+        cmd = ' '.join((
+            "if {python} -c 'import sys; sys.exit(sys.version_info < (3, 5))'; then",
+            '{python} -m compileall -q -j0 {paths};',
+            "else find {paths} -name '*.py' -print0 |",
+            'xargs -0 -r -n 200 -P "$(nproc)" {python} -m compileall -q;',
+            'fi',
+        )).format(python=python, paths=paths)
+        start_time = time.monotonic()
+        result = remote(config, cmd, timeout=None, abort_on_failure=False)
+        elapsed = time.monotonic() - start_time
+        if result.failed:
+            printer.warning('Some modules could not be compiled (see above)')
+        printer.info('Byte-compiled in {elapsed:.1f}s'.format_map(locals()))
 
     def migrate(self):
         """Run database migrations."""
         printer.header('Running migrations...')
         remote_manage(self.config, 'migrate')
 
+    def warm_up(self):
+        """Warm up the new version before making it active.
+
+        The WSGI application is loaded from the new build and each of
+        the ``warmup.urls`` is requested by calling the application
+        directly, ``warmup.concurrency`` at a time, so the new code is
+        loaded and exercised before any live requests reach it.
+
+        If any URL takes longer than ``warmup.max_latency`` seconds or
+        more than ``warmup.max_errors`` URLs fail, the deployment is
+        aborted and the new version is *not* made active.
+
+        """
+        printer.header('Warming up new version...')
+        config = self.config
+        warmup = config.warmup
+        urls = tuple(warmup.urls)
+        if not urls:
+            printer.warning('No warm-up URLs configured; skipping warm-up')
+            return
+
+        marker = 'WARMUP-{0}:'.format(uuid.uuid4().hex)
+        result = remote(config, (
+            'LOCAL_SETTINGS_FILE="{remote.build.local_settings_file}"',
+            '{remote.build.python}',
+            '{remote.build.warmup}',
+            '--host', get_canonical_host(config),
+            '--concurrency', str(warmup.concurrency),
+            '--marker', marker,
+            tuple(shlex.quote(url) for url in urls),
+        ), hide='all', abort_on_failure=False)
+
+        results = []
+        load_time = None
+        for line in result.stdout_lines:
+            line = line.strip()
+            if line.startswith(marker):
+                data = json.loads(line[len(marker):])
+                if 'load' in data:
+                    load_time = data['load']
+                else:
+                    results.append(data)
+
+        if result.failed or load_time is None:
+            print(result.stdout)
+            print(result.stderr)
+            abort(1, 'Warm-up failed; new version was not made active')
+
+        printer.info('Loaded WSGI application in {load_time:.3f}s'.format_map(locals()))
+        longest = max(len(item['url']) for item in results)
+        errors = []
+        slow = []
+        for item in results:
+            url = item['url']
+            status = item['status'] or 'ERR'
+            latency = item['latency']
+            print('{url:<{longest}} {status:>4} {latency:>8.3f}s'.format_map(locals()))
+            if item['error'] or item['status'] is None or item['status'] >= 500:
+                errors.append(item)
+                if item['error']:
+                    print(item['error'])
+            if latency > warmup.max_latency:
+                slow.append(item)
+
+        num_errors = len(errors)
+        num_slow = len(slow)
+        max_errors = warmup.max_errors
+        max_latency = warmup.max_latency
+        if num_errors > max_errors or num_slow:
+            abort(1, (
+                'Warm-up thresholds exceeded ({num_errors} error(s), max {max_errors}; '
+                '{num_slow} URL(s) slower than {max_latency}s); '
+                'new version was not made active'
+            ).format_map(locals()))
+        printer.success('Warm-up complete')
+
     def make_active(self):
         """Make the new version the active version.
 
@@ -337,39 +1337,68 @@ class Deployer:
         build directory created by :func:`provision`.
 
         Note that this will cause mod_wsgi to restart automatically due
-        to its restart-on-touch functionality. The call to `restart` is
-        redundant, but it's left in for clarity.
+        to its restart-on-touch functionality. Running the restart
+        script is redundant, but it's left in for clarity.
 
         """
         printer.header('Linking new version and restarting...')
         config = self.config
-        link(config, config.version)
-        restart(config)
+        # Link and run the restart script in one round trip.
+        with RemoteBatch(config) as batch:
+            for cmd in get_link_commands(config):
+                batch.add(cmd)
+            batch.add(restart_command)
 
-    def set_permissions(self):
-        """Explicitly, recursively chmod remote build directories.
+    def check_active(self, final=True):
+        """Check the site after the new version is made active.
 
-        Permissions are updated after restarting because this could take
-        a while. The chmod command is run in the background because we don't
-        want to sit around waiting, and we assume it will succeed.
+        The site is probed only on the ``final`` check (i.e., once the
+        new version is active on all hosts).
 
         """
-        printer.header('Setting permissions in background...')
+        options = self.options
+        probe = final and options['probe']
+        baseline = final and options['baseline']
+        with self.tracer.span('check_active', 'step', host=', '.join(self.hosts)):
+            restart(self.config, run_script=False, probe=probe, baseline=baseline)
 
-        def chmod(mode, where, options='-R', host='hrimfaxi.oit.pdx.edu'):
-            args = (options, mode, where)
-            local(self.config, (
-                'ssh -f', host,
-                'sudo -u {service.user} sh -c "nohup chmod', args, '>/dev/null 2>&1 &"',
-            ))
+    def set_permissions(self):
+        """Set permissions of new and changed remote files.
 
-        chmod('ug=rwX,o-rwx', '{remote.build.dir} {remote.path.log_dir} {remote.path.static}')
+        Files in the build are given the correct permissions when they're
+        pushed, so this only needs to fix up files written on the remote
+        host during deployment (e.g., installed packages, compiled
+        modules, log files, and static files). Only paths written since
+        the permissions marker was created (at the start of the push
+        step) are updated. If the build wasn't pushed during this
+        deployment, all paths are updated.
+
+        """
+        printer.header('Setting permissions of new and changed files...')
+        fix_permissions(
+            self.config,
+            ('{remote.build.dir}', '{remote.path.log_dir}', '{remote.path.static}'),
+            mode='ug=rwX,o-rwx',
+            since='{remote.build.permissions_marker}',
+            run_as='{service.user}')
 
 
-@command(default_env='stage', timed=True)
+@command(
+    default_env='stage',
+    timed=True,
+    choices={
+        'push_mode': ('archive', 'stream', 'delta', 'pipelined'),
+        'codec': tuple(CODECS),
+        'venv_mode': ('fresh', 'clone'),
+        'activate_mode': ('all', 'rolling'),
+    })
 def deploy(config, version=None, deployer_class=None, provision=True, overwrite=False, push=True,
-           static=True, build_static=True, deps=(), remove_distributions=(), wheels=True,
-           install=True, push_config=True, migrate=False, make_active=True, set_permissions=True):
+           push_mode='archive', codec='gzip', venv_mode='fresh', static=True, build_static=True,
+           deps=(), remove_distributions=(), wheels=True, install=True, compile=True,
+           push_config=True, migrate=False, warm_up=True, make_active=True, set_permissions=True,
+           probe=False, baseline=False, hosts=(), parallel_hosts=4, activate_mode='all',
+           resume=False, clean_build=False, build_cache=True, jobs=0, offline=False,
+           ssh_mux=True):
     """Deploy a new version.
 
     All of the command options are used to construct a :class:`Deployer`,
@@ -378,6 +1407,91 @@ def deploy(config, version=None, deployer_class=None, provision=True, overwrite=
     class must accept a ``config`` arg plus arbitrary keyword args (which
     it is free to ignore).
 
+    By default, the build is archived locally, then the archive is
+    copied to the remote host and extracted. Pass ``--push-mode stream``
+    to stream the build directly into ``tar x`` on the remote host
+    instead, or ``--push-mode delta`` to transfer only the files that
+    differ from the active build (unchanged files are hard linked from
+    the active build on the remote host). ``--push-mode pipelined`` is
+    like delta, but the outputs of each local preprocessing step (sdists,
+    config files, static files, etc) are pushed as soon as the step
+    completes, so pushing overlaps with building.
+
+    ``--codec`` selects how the build is compressed for the archive and
+    stream push modes: gzip (the default), pigz (parallel gzip), zstd
+    (multi-threaded), or none (fastest on local networks). The matching
+    decompressor must be installed on the remote host. To choose a codec
+    per env, set ``defaults.arctasks.deploy.deploy.codec`` in the env's
+    config section. See :func:`benchmark_codecs` for help choosing.
+
+    Pass ``--venv-mode clone`` to create the build's virtualenv by
+    cloning the active build's virtualenv (using hard links) rather
+    than creating a fresh one. Only packages that have changed will
+    then need to be installed.
+
+    Downloaded artifacts (the ARC Tasks tarball and the virtualenv
+    tarball) are cached locally in ``cache.dir`` and revalidated before
+    being reused. Pass ``--offline`` to use cached artifacts without
+    revalidating them (this will fail if they aren't cached).
+
+    After installation, the build is byte-compiled on the remote host
+    using all of its cores so that the first requests after the new
+    version is made active don't have to; pass ``--no-compile`` to skip
+    this.
+
+    Before the new version is made active, its WSGI application is
+    loaded on the remote host and the ``warmup.urls`` are requested
+    from it concurrently. If warm-up is too slow or there are too many
+    errors (see ``warmup.max_latency`` and ``warmup.max_errors``), the
+    deployment is aborted without making the new version active. Pass
+    ``--no-warm-up`` to skip this.
+
+    After the new version is made active, pass ``--probe`` to measure
+    its latency and error rate, and ``--baseline`` to compare those to
+    the previously deployed version's (see :func:`restart`).
+
+    To deploy to multiple hosts, pass ``--host`` for each host (by
+    default, the build is deployed to ``remote.host`` only). The build
+    is pushed, installed, etc on all hosts concurrently, up to
+    ``--parallel-hosts`` at a time. Migrations are run on the first host
+    only. Once all hosts are ready, the new version is made active on
+    all of them at once or, with ``--activate-mode rolling``, on one
+    host at a time.
+
+    A single SSH connection to each host is shared by all of the remote
+    commands and file transfers run during the deployment (using the
+    "ssh-mux" ``remote.strategy``); pass ``--no-ssh-mux`` to use the
+    configured strategy instead.
+
+    Completed steps are recorded along with a hash of their inputs in
+    ``build/{version}.deploy-state.json`` and, for remote steps, in
+    ``.deploy-state.json`` in the remote build directory. If a
+    deployment fails, rerun it with ``--resume`` to skip the steps that
+    were already completed with the same inputs.
+
+    The local build directory is updated in place: only files that have
+    changed since the last build are rewritten and stale files are
+    removed. Pass ``--clean-build`` to remove and recreate it instead.
+
+    Builds are cached locally, so deploying a source tree that has
+    already been built for the env (e.g., redeploying a version after a
+    failed deployment) skips local preprocessing entirely. Env
+    specific files (local.cfg, commands.cfg, and scripts) are kept out
+    of the build and overlaid on it when it's pushed. Only builds pushed
+    in the archive push mode are added to the cache (a cached build can
+    be pushed in any mode), and builds with uncommitted changes aren't
+    cached. Pass ``--no-build-cache`` to always rebuild.
+
+    Each deployment step and each command it runs is traced. The trace
+    is written to ``build/{version}.trace.json`` (in the Chrome trace
+    event format) and added to the deployment history database; run
+    :func:`deploy_stats` to see how the deployment compares to previous
+    deployments.
+
+    Independent local preprocessing steps are run concurrently; pass
+    ``--jobs 1`` to run them one at a time. By default, the number of
+    concurrent steps is limited to the number of CPUs.
+
     """
     if deployer_class is None:
         deployer_class = deploy.deployer_class
@@ -388,16 +1502,32 @@ def deploy(config, version=None, deployer_class=None, provision=True, overwrite=
         provision=provision,
         overwrite=overwrite,
         push=push,
+        push_mode=push_mode,
+        codec=codec,
+        venv_mode=venv_mode,
         static=static,
         build_static=build_static,
         deps=deps,
         remove_distributions=remove_distributions,
         wheels=wheels,
         install=install,
+        compile=compile,
         push_config=push_config,
         migrate=migrate,
+        warm_up=warm_up,
         make_active=make_active,
         set_permissions=set_permissions,
+        probe=probe,
+        baseline=baseline,
+        hosts=hosts,
+        parallel_hosts=parallel_hosts,
+        activate_mode=activate_mode,
+        resume=resume,
+        clean_build=clean_build,
+        build_cache=build_cache,
+        jobs=jobs,
+        offline=offline,
+        ssh_mux=ssh_mux,
     )
     try:
         deployer.run()
@@ -409,6 +1539,154 @@ deploy.deployer_class = Deployer
 deploy.set_deployer_class = lambda class_: setattr(deploy, 'deployer_class', class_)
 
 
+@command(default_env='stage')
+def benchmark_codecs(config, codecs=tuple(CODECS), build_dir='{path.build.root}', transfer=True):
+    """Compare archive codecs for the current build.
+
+    Each codec is used to compress the build directory (which must
+    already exist; run ``deploy`` or ``deploy --no-push`` first). The
+    time taken to compress and the compression ratio relative to the
+    uncompressed tarball are shown for each codec.
+
+    Unless ``--no-transfer`` is passed, each compressed archive is also
+    sent to the remote host (and discarded there) to measure transfer
+    time for the env.
+
+    """
+    build_dir = abs_path(build_dir, format_kwargs=config)
+    if not os.path.isdir(build_dir):
+        abort(1, 'Build directory not found: {build_dir}'.format_map(locals()))
+
+    codecs = [get_codec(name) for name in codecs]
+    for codec in codecs:
+        codec.check()
+
+    arcname = os.path.basename(build_dir)
+    results = []
+    uncompressed_size = None
+
+    printer.header('Benchmarking codecs for {build_dir}...'.format_map(locals()))
+
+    # The uncompressed size is needed to compute ratios, so the "none"
+    # codec is always run first.
+    codecs = [get_codec('none')] + [c for c in codecs if c.name != 'none']
+
+    for codec in codecs:
+        with tempfile.TemporaryFile() as archive_file:
+            start_time = time.monotonic()
+            return_code = write_archive(build_dir, arcname, archive_file, codec)
+            compress_time = time.monotonic() - start_time
+            if return_code:
+                abort(2, 'Compression with {codec.name} failed'.format_map(locals()))
+
+            size = os.fstat(archive_file.fileno()).st_size
+            if uncompressed_size is None:
+                uncompressed_size = size
+            ratio = size / uncompressed_size if uncompressed_size else 1
+
+            if transfer:
+                archive_file.seek(0)
+                ssh_args = ssh_command(config, 'cat >/dev/null', run_as=config.remote.user)
+                start_time = time.monotonic()
+                subprocess.check_call(ssh_args, stdin=archive_file)
+                transfer_time = time.monotonic() - start_time
+            else:
+                transfer_time = None
+
+        results.append((codec.name, compress_time, size, ratio, transfer_time))
+        printer.info('{codec.name} done'.format_map(locals()))
+
+    print('{0:<6} {1:>10} {2:>12} {3:>7} {4:>10} {5:>10}'.format(
+        'codec', 'compress', 'size (MB)', 'ratio', 'transfer', 'total'))
+    for name, compress_time, size, ratio, transfer_time in results:
+        if transfer_time is None:
+            transfer_str = total_str = '-'
+        else:
+            transfer_str = '{0:.3f}s'.format(transfer_time)
+            total_str = '{0:.3f}s'.format(compress_time + transfer_time)
+        print('{0:<6} {1:>9.3f}s {2:>12.2f} {3:>7.3f} {4:>10} {5:>10}'.format(
+            name, compress_time, size / 1024 / 1024, ratio, transfer_str, total_str))
+
+
+@command(default_env='stage')
+def deploy_stats(config, window=10, threshold=1.25, version=None):
+    """Show how the deployment steps of the last deployment compare to
+    previous deployments of the project to the env.
+
+    Each step's duration is compared to its median duration over the
+    previous ``window`` successful deployments; steps that are more
+    than ``threshold`` times slower than their median are flagged. The
+    durations of the step in recent deployments are shown as a trend
+    (oldest first).
+
+    Pass ``--version`` to show the last deployment of a specific
+    version instead of the last deployment.
+
+    Deployments are recorded by :func:`deploy` in the SQLite database at
+    ``trace.history_file``. A trace of each deployment is also written
+    to ``build/{version}.trace.json``, which can be loaded into
+    chrome://tracing or https://ui.perfetto.dev.
+
+    """
+    history = TraceHistory(config.trace.history_file)
+    deploys = history.deploys(config.package, config.env, limit=-1)
+    if version is not None:
+        while deploys and deploys[-1]['version'] != version:
+            deploys.pop()
+    if not deploys:
+        printer.warning('No deployments of {config.package} to {config.env} found in {0}'
+                        .format(history.path, **locals()))
+        return
+
+    latest = deploys[-1]
+    previous = [d for d in deploys[:-1] if d['status'] == 0][-window:]
+    started = datetime.fromtimestamp(latest['started']).strftime('%Y-%m-%d %H:%M')
+    num_previous = len(previous)
+    status = 'succeeded' if latest['status'] == 0 else 'failed'
+    printer.header(
+        'Deployment of {latest[version]} to {config.env} at {started} ({status}) compared to '
+        'median of previous {num_previous} deployment(s):'.format_map(locals()))
+
+    rows = list(latest['steps']) + [('TOTAL', latest['duration'])]
+    longest = max(len(name) for (name, _) in rows)
+    print('{0:<{longest}} {1:>9} {2:>9} {3:>7}  {4}'.format(
+        'step', 'time', 'median', 'ratio', 'trend', longest=longest))
+    slower = []
+    for name, duration in rows:
+        if name == 'TOTAL':
+            durations = [d['duration'] for d in previous]
+        else:
+            durations = [dict(d['steps'])[name] for d in previous if name in dict(d['steps'])]
+        median = _median(durations) if durations else None
+        ratio = duration / median if median else None
+        trend = ' '.join('{0:.1f}'.format(d) for d in durations[-5:])
+        out = '{name:<{longest}} {duration:>8.1f}s {0:>9} {1:>7}  {trend}'.format(
+            '-' if median is None else '{0:.1f}s'.format(median),
+            '-' if ratio is None else '{0:.2f}x'.format(ratio),
+            **locals())
+        if ratio is not None and ratio > threshold:
+            slower.append(name)
+            printer.warning(out)
+        else:
+            print(out)
+
+    if slower:
+        slower = ', '.join(slower)
+        printer.warning(
+            'Slower than {threshold:.2f}x median: {slower}'.format_map(locals()))
+    elif previous:
+        printer.success('No steps were slower than {threshold:.2f}x median'.format_map(locals()))
+
+
+def _median(values):
+    # Same as statistics.median, which requires Python 3.4+
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
 def get_active_version(config, **kwargs):
     kwargs.setdefault('abort_on_failure', False)
     kwargs.setdefault('hide', 'stdout')
@@ -553,7 +1831,12 @@ def clean_builds(config, keep=3):
 )
 def link(config, version, staticfiles_manifest=True, old_style=None):
     config = config.copy(version=version)
+    for cmd in get_link_commands(config, staticfiles_manifest, old_style):
+        remote(config, cmd)
 
+
+def get_link_commands(config, staticfiles_manifest=True, old_style=None):
+    """Get the remote commands that link the build for ``config.version``."""
     cmd = [
         'test -d {remote.build.dir}',
         'ln -sfn {remote.build.dir} {remote.path.env}',
@@ -563,15 +1846,17 @@ def link(config, version, staticfiles_manifest=True, old_style=None):
         cmd.append(
             'ln -sfn {remote.build.static}/staticfiles.json {remote.path.static}/staticfiles.json')
 
-    remote(config, ' && '.join(cmd))
+    commands = [' && '.join(cmd)]
 
     # XXX: This supports old-style deployments where the media and
     #      static directories are in the source directory.
     if old_style:
-        remote(config, (
+        commands.append(args_to_str((
             'ln -sfn {remote.path.media} {remote.build.dir}/media &&',
             'ln -sfn {remote.path.static} {remote.build.dir}/static',
-        ))
+        )))
+
+    return commands
 
 
 @command
@@ -594,19 +1879,32 @@ def push_static(config, build=True, dry_run=False, delete=False, echo=False, hid
         ))
 
 
+restart_command = '$(readlink {remote.path.env})/restart'
+
+
 @command
-def restart(config, get=True, scheme='https', path='/', show=False):
-    settings = django.get_settings(config)
-    remote(config, '$(readlink {remote.path.env})/restart')
+def restart(config, get=True, scheme='https', path='/', show=False, run_script=True,
+            probe=False, baseline=False):
+    """Restart the active version and check that it's up.
+
+    By default, a single request is sent to ``path``. Pass ``--probe``
+    to instead wait for the site to become healthy and then send
+    concurrent requests to each of the ``probe.paths``, showing p50,
+    p95, and p99 latencies and error rates. Probe results are stored
+    locally for each env.
+
+    Pass ``--baseline`` to compare the probe results to those from the
+    last probe of a different version (implies ``--probe``).
+
+    """
+    probe = probe or baseline
+    if run_script:
+        remote(config, restart_command)
+    if probe:
+        run_probe(config, scheme, baseline)
+        get = False
     if get:
-        host = getattr(settings, 'DOMAIN_NAME', None)
-        if host is None:
-            host = settings.ALLOWED_HOSTS[0]
-            host = host.lstrip('.')
-        else:
-            printer.warning(
-                'The DOMAIN_NAME setting is deprecated; '
-                'set the first entry in ALLOWED_HOSTS to the canonical host instead')
+        host = get_canonical_host(config)
         if not path.startswith('/'):
             path = '/{path}'.format(path=path)
         url = '{scheme}://{host}{path}'.format_map(locals())
@@ -623,24 +1921,73 @@ def restart(config, get=True, scheme='https', path='/', show=False):
             print(data.decode('utf-8'))
 
 
+def run_probe(config, scheme='https', baseline=False):
+    from .probe import ProbeHistory, probe, show_comparison, show_stats
+    settings = config.probe
+    host = get_canonical_host(config)
+    base_url = '{scheme}://{host}'.format_map(locals())
+    stats = probe(
+        base_url, paths=tuple(settings.paths), requests=settings.requests,
+        concurrency=settings.concurrency, timeout=settings.timeout, wait=settings.wait)
+    show_stats(stats)
+    history = ProbeHistory(settings.history_file)
+    if baseline:
+        baseline_entry = history.baseline(config.version)
+        if baseline_entry is None:
+            printer.warning('No baseline found for comparison')
+        elif show_comparison(stats, baseline_entry, settings.regression_threshold):
+            printer.warning('Possible performance regression (see above)')
+    history.add(config.version, stats)
+
+
 # Utilities
 
 
-def copy_file_local(config, path, destination_path, template=False, template_type=None, mode=None):
+def get_canonical_host(config):
+    """Get canonical host from the first entry in ALLOWED_HOSTS."""
+    settings = django.get_settings(config)
+    host = getattr(settings, 'DOMAIN_NAME', None)
+    if host is None:
+        host = settings.ALLOWED_HOSTS[0]
+        host = host.lstrip('.')
+    else:
+        printer.warning(
+            'The DOMAIN_NAME setting is deprecated; '
+            'set the first entry in ALLOWED_HOSTS to the canonical host instead')
+    return host
+
+
+def copy_file_local(config, path, destination_path, template=False, template_type=None, mode=None,
+                    outputs=None):
+    """Copy local file, optionally as a template.
+
+    If ``outputs`` is passed (see :meth:`.BuildManifest.step`), the
+    file will be written through the build manifest and only if its
+    contents have changed.
+
+    """
     path = abs_path(path, format_kwargs=config)
     destination_path = abs_path(destination_path, format_kwargs=config)
 
+    if outputs is not None:
+        if os.path.isdir(destination_path):
+            name = os.path.basename(path)
+            if template:
+                name, ext = os.path.splitext(name)
+                if ext != '.template':
+                    name = os.path.basename(path)
+            destination_path = os.path.join(destination_path, name)
+        if template:
+            with open(path) as in_fp:
+                contents = render_template(config, in_fp.read(), template_type)
+            outputs.write(destination_path, contents, mode)
+        else:
+            outputs.copy(path, destination_path, mode)
+        return destination_path
+
     if template:
         with open(path) as in_fp:
-            contents = in_fp.read()
-
-        if template_type in (None, 'format'):
-            contents = contents.format_map(config)
-        elif template_type == 'string':
-            template = string.Template(contents)
-            contents = template.substitute(config)
-        else:
-            raise ValueError('Unrecognized template type: %s' % template_type)
+            contents = render_template(config, in_fp.read(), template_type)
 
         prefix = '%s-' % config.package
         suffix = '-%s' % os.path.basename(path)
@@ -666,6 +2013,21 @@ def copy_file_local(config, path, destination_path, template=False, template_typ
     return copy_path
 
 
+def _copy_file_object(path, out_file):
+    with open(path, 'rb') as in_file:
+        shutil.copyfileobj(in_file, out_file)
+
+
+def render_template(config, contents, template_type=None):
+    if template_type in (None, 'format'):
+        return contents.format_map(config)
+    elif template_type == 'string':
+        template = string.Template(contents)
+        return template.substitute(config)
+    else:
+        raise ValueError('Unrecognized template type: %s' % template_type)
+
+
 def make_dist(config, path, dist_dir=None):
     cmd = [sys.executable, 'setup.py sdist']
     if dist_dir:
@@ -1,9 +1,10 @@
 import os
 
 from runcommands import command
-from runcommands.commands import local
 from runcommands.util import Hide, abort, abs_path, printer
 
+from .trace import local
+
 
 def setup(config):
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', config.get('django_settings_module'))
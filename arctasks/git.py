@@ -1,3 +1,5 @@
+import hashlib
+import os
 import subprocess
 
 from runcommands.util import abort, confirm, printer
@@ -97,3 +99,53 @@ def version(short=True):
         printer.warning('HEAD is not tagged; falling back to SHA1')
         value = run(['rev-parse', '--short' if short else '', 'HEAD'], return_output=True)
     return value
+
+
+def tree_hash(path='.'):
+    """Get hash of the tree for ``path`` in HEAD.
+
+    Returns ``None`` if ``path`` isn't in a git work tree or isn't in
+    HEAD (e.g., if it hasn't been committed yet).
+
+    """
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD:./'], cwd=path, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    return output.decode('utf-8').strip()
+
+
+def dirty_fingerprint(path='.', exclude=('.egg-info',)):
+    """Get a fingerprint of uncommitted changes in ``path``.
+
+    This covers changes to tracked files (staged or not) and the
+    contents of untracked files that aren't ignored. Untracked files
+    with a path component ending with one of the ``exclude`` suffixes
+    are skipped (by default, egg-info directories, since those are
+    created by ``setup.py``).
+
+    Returns an empty string when there are no uncommitted changes.
+    ``path`` must be in a git work tree (see :func:`tree_hash`).
+
+    """
+    diff = subprocess.check_output(['git', 'diff', 'HEAD', '--binary', '--', '.'], cwd=path)
+    untracked = subprocess.check_output(
+        ['git', 'ls-files', '--others', '--exclude-standard', '-z', '--', '.'], cwd=path)
+    untracked = [
+        name for name in untracked.decode('utf-8').split('\0')
+        if name and not any(p.endswith(exclude) for p in name.split('/'))
+    ]
+
+    if not (diff or untracked):
+        return ''
+
+    digest = hashlib.sha256(diff)
+    for name in sorted(untracked):
+        digest.update(name.encode('utf-8'))
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            with open(file_path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(2 ** 16), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,246 @@
+"""Content manifest for incremental build directories.
+
+Rather than recreating the build directory from scratch for every
+deployment, files are written into it through a :class:`BuildManifest`,
+which records the checksum of each file and skips writing files whose
+contents haven't changed. Directories that are populated by external
+tools (e.g., collectstatic) are tracked as whole trees.
+
+Each file and tree is recorded along with the step that produced it.
+Files and trees that aren't produced (or explicitly kept) during a
+build are stale and are removed by :meth:`BuildManifest.gc`. Files in
+the build directory that were never written through the manifest are
+left alone.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+from .util import file_hash
+
+
+__all__ = [
+    'BuildManifest',
+]
+
+
+class BuildManifest:
+
+    """Content manifest for the build directory ``root``.
+
+    Args:
+        root: The build directory
+        path: The JSON file the manifest is stored in; this should be
+            outside of ``root``
+
+    """
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.trees = {}
+        self.claimed = set()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = {}
+        self.files = data.get('files', {})
+        self.trees = data.get('trees', {})
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def reset(self):
+        """Forget everything (e.g., after the build dir is removed)."""
+        with self.lock:
+            self.files = {}
+            self.trees = {}
+            self.claimed = set()
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    def save(self):
+        with self.lock:
+            data = {'files': self.files, 'trees': self.trees}
+            temp_path = '{self.path}.tmp'.format_map(locals())
+            with open(temp_path, 'w') as fp:
+                json.dump(data, fp, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def step(self, name):
+        """Get a view of the manifest for writing outputs of step ``name``."""
+        return StepOutputs(self, name)
+
+    def claim_step(self, name):
+        """Keep all outputs of step ``name`` from the last build.
+
+        This should be called when a step is skipped so its outputs
+        won't be considered stale.
+
+        """
+        with self.lock:
+            for rel_path, entry in self.files.items():
+                if entry['step'] == name:
+                    self.claimed.add(rel_path)
+            for rel_path, entry in self.trees.items():
+                if entry['step'] == name:
+                    self.claimed.add(rel_path)
+
+    def outputs(self, name):
+        """Get relative paths of files and trees produced (or kept) by
+        step ``name`` in the current build."""
+        with self.lock:
+            paths = [
+                rel_path
+                for entries in (self.files, self.trees)
+                for (rel_path, entry) in entries.items()
+                if entry['step'] == name and rel_path in self.claimed
+            ]
+        return sorted(paths)
+
+    def rel_path(self, path):
+        rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if rel_path.startswith(os.pardir):
+            raise ValueError('{path} is not in {self.root}'.format_map(locals()))
+        return rel_path
+
+    def copy(self, step, source, destination, mode=None):
+        """Copy ``source`` to ``destination`` if its contents differ.
+
+        Returns:
+            bool: Whether the file was written
+
+        """
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(source).st_mode)
+        digest = file_hash(source)
+        return self._write(step, destination, digest, mode, lambda fp: _copy(source, fp))
+
+    def write(self, step, destination, contents, mode=None):
+        """Write ``contents`` (str) to ``destination`` if they differ."""
+        contents = contents.encode('utf-8')
+        digest = hashlib.sha256(contents).hexdigest()
+        return self._write(step, destination, digest, mode, lambda fp: fp.write(contents))
+
+    def _write(self, step, destination, digest, mode, write):
+        rel_path = self.rel_path(destination)
+        with self.lock:
+            self.claimed.add(rel_path)
+            entry = self.files.get(rel_path)
+        changed = not self._is_current(destination, entry, digest)
+        if changed:
+            directory = os.path.dirname(destination)
+            os.makedirs(directory, exist_ok=True)
+            temp_fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            try:
+                with os.fdopen(temp_fd, 'wb') as fp:
+                    write(fp)
+                os.replace(temp_path, destination)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        if mode is not None:
+            os.chmod(destination, mode)
+        st = os.stat(destination)
+        with self.lock:
+            self.files[rel_path] = {
+                'sha256': digest,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'step': step,
+            }
+        return changed
+
+    def _is_current(self, path, entry, digest):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if entry and (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime):
+            return entry['sha256'] == digest
+        return file_hash(path) == digest
+
+    def tree(self, step, path, key=None):
+        """Claim the directory tree at ``path`` for ``step``.
+
+        The contents of the tree are managed by the caller. If ``key``
+        is specified, it's compared to the key recorded for the tree in
+        the last build.
+
+        Returns:
+            bool: Whether the tree exists with the same ``key``
+
+        """
+        rel_path = self.rel_path(path)
+        with self.lock:
+            self.claimed.add(rel_path)
+            entry = self.trees.get(rel_path)
+            self.trees[rel_path] = {'key': key, 'step': step}
+        return os.path.isdir(path) and entry is not None and entry['key'] == key
+
+    def gc(self):
+        """Remove stale files and empty stale trees.
+
+        Returns:
+            list: Relative paths of files and trees that were removed
+
+        """
+        removed = []
+        with self.lock:
+            for rel_path in sorted(set(self.files) - self.claimed):
+                path = os.path.join(self.root, rel_path)
+                if os.path.isfile(path) or os.path.islink(path):
+                    os.remove(path)
+                    _remove_empty_dirs(self.root, os.path.dirname(path))
+                del self.files[rel_path]
+                removed.append(rel_path)
+            for rel_path in sorted(set(self.trees) - self.claimed):
+                path = os.path.join(self.root, rel_path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    os.makedirs(path)
+                del self.trees[rel_path]
+                removed.append(rel_path)
+        return removed
+
+
+class StepOutputs:
+
+    """Writes outputs of a step through a :class:`BuildManifest`."""
+
+    def __init__(self, manifest, step):
+        self.manifest = manifest
+        self.step = step
+
+    def copy(self, source, destination, mode=None):
+        return self.manifest.copy(self.step, source, destination, mode)
+
+    def write(self, destination, contents, mode=None):
+        return self.manifest.write(self.step, destination, contents, mode)
+
+    def tree(self, path, key=None):
+        return self.manifest.tree(self.step, path, key)
+
+
+def _copy(source, out_file):
+    with open(source, 'rb') as in_file:
+        shutil.copyfileobj(in_file, out_file)
+
+
+def _remove_empty_dirs(root, directory):
+    root = os.path.abspath(root)
+    directory = os.path.abspath(directory)
+    while directory != root and directory.startswith(root) and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
@@ -0,0 +1,183 @@
+/*
+ * Persistent compiler worker for arctasks.nodeworker.
+ *
+ * Reads requests from stdin and writes responses to stdout, one JSON
+ * object per line. Requests are handled one at a time, in order:
+ *
+ *     {"id": 1, "compiler": "less", "args": {...}}
+ *     {"id": 1, "return_code": 0, "stdout": "...", "stderr": "..."}
+ *
+ * Anything the compilers write to stdout or stderr (including via the
+ * console) is captured and returned with the response so it can't
+ * corrupt the protocol.
+ *
+ * Compilers are loaded from the directories in $NODE_PATH the first
+ * time they're used.
+ */
+'use strict';
+
+const fs = require('fs');
+const path = require('path');
+const readline = require('readline');
+
+const writeResponse = process.stdout.write.bind(process.stdout);
+
+// Modules required by each compiler
+const compilerModules = {
+    less: ['less', 'less-plugin-autoprefix', 'less-plugin-clean-css'],
+    scss: ['node-sass', 'postcss', 'postcss-clean', 'autoprefixer'],
+    rjs: ['requirejs'],
+};
+
+const compilers = {
+    check(args) {
+        const available = args.compilers.filter(name => {
+            const modules = compilerModules[name] || [];
+            return modules.every(module => {
+                try {
+                    require.resolve(module);
+                    return true;
+                } catch (error) {
+                    return false;
+                }
+            });
+        });
+        return JSON.stringify(available);
+    },
+
+    less(args) {
+        const less = require('less');
+        const plugins = [];
+        if (args.autoprefixer_browsers) {
+            const LessPluginAutoPrefix = require('less-plugin-autoprefix');
+            const browsers = args.autoprefixer_browsers.split(',');
+            plugins.push(new LessPluginAutoPrefix({browsers: browsers}));
+        }
+        if (args.optimize) {
+            const LessPluginCleanCSS = require('less-plugin-clean-css');
+            plugins.push(new LessPluginCleanCSS());
+        }
+        const input = fs.readFileSync(args.source, 'utf8');
+        const options = {filename: path.resolve(args.source), plugins: plugins};
+        return less.render(input, options).then(output => {
+            fs.writeFileSync(args.destination, output.css);
+        });
+    },
+
+    // node-sass -> autoprefixer -> clean-css, with the intermediate CSS
+    // (and source map) kept in memory
+    scss(args) {
+        const sass = require('node-sass');
+        const postcss = require('postcss');
+        const plugins = [];
+        if (args.optimize) {
+            plugins.push(require('postcss-clean')());
+        }
+        if (args.autoprefixer_browsers) {
+            plugins.push(require('autoprefixer')({browsers: args.autoprefixer_browsers}));
+        }
+        const mapFile = `${args.destination}.map`;
+        const output = sass.renderSync({
+            file: args.source,
+            outFile: args.destination,
+            sourceMap: args.source_map ? mapFile : false,
+            omitSourceMapUrl: plugins.length > 0,
+        });
+        if (!plugins.length) {
+            fs.writeFileSync(args.destination, output.css);
+            if (args.source_map) {
+                fs.writeFileSync(mapFile, output.map);
+            }
+            return;
+        }
+        const options = {from: args.source, to: args.destination};
+        if (args.source_map) {
+            options.map = {
+                prev: output.map.toString(),
+                inline: false,
+                annotation: path.basename(mapFile),
+            };
+        }
+        return postcss(plugins).process(output.css.toString(), options).then(result => {
+            result.warnings().forEach(warning => console.error(warning.toString()));
+            fs.writeFileSync(args.destination, result.css);
+            if (result.map) {
+                fs.writeFileSync(mapFile, result.map.toString());
+            }
+        });
+    },
+
+    rjs(args) {
+        const requirejs = require('requirejs');
+        return new Promise((resolve, reject) => {
+            requirejs.optimize(args.config, resolve, reject);
+        });
+    },
+};
+
+function formatError(error) {
+    if (error && error.formatted) {
+        return error.formatted;
+    }
+    if (error && error.filename && error.line) {
+        return `${error.filename}:${error.line}:${error.column} ${error.message}`;
+    }
+    return (error && error.stack) || String(error);
+}
+
+// Output captured for the current request
+let captured = null;
+
+function capture(stream) {
+    return function (chunk, encoding, callback) {
+        if (captured !== null) {
+            captured[stream] += chunk.toString();
+        }
+        if (typeof encoding === 'function') {
+            encoding();
+        } else if (typeof callback === 'function') {
+            callback();
+        }
+        return true;
+    };
+}
+
+process.stdout.write = capture('stdout');
+process.stderr.write = capture('stderr');
+
+function handle(request) {
+    captured = {stdout: '', stderr: ''};
+    const compiler = compilers[request.compiler];
+    return new Promise(resolve => {
+        if (!compiler) {
+            throw new Error(`Unknown compiler: ${request.compiler}`);
+        }
+        resolve(compiler(request.args));
+    }).then(output => {
+        if (typeof output === 'string') {
+            captured.stdout += output;
+        }
+        return 0;
+    }, error => {
+        captured.stderr += formatError(error) + '\n';
+        return 1;
+    }).then(returnCode => {
+        const response = {
+            id: request.id,
+            return_code: returnCode,
+            stdout: captured.stdout,
+            stderr: captured.stderr,
+        };
+        captured = null;
+        writeResponse(JSON.stringify(response) + '\n');
+    });
+}
+
+let queue = Promise.resolve();
+
+readline.createInterface({input: process.stdin}).on('line', line => {
+    if (line.trim()) {
+        const request = JSON.parse(line);
+        queue = queue.then(() => handle(request));
+    }
+});
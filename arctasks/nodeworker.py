@@ -0,0 +1,275 @@
+"""Persistent Node processes for compiling static files.
+
+Starting Node and loading a compiler and its plugins often takes longer
+than compiling a small file. A :class:`NodeWorker` runs the compilers
+used by :mod:`arctasks.static` (less, node-sass, postcss, and r.js) in a
+single long-lived Node process (see ``node_worker.js``) that reads
+requests from its stdin and writes responses to its stdout, one JSON
+object per line::
+
+    {"id": 1, "compiler": "less", "args": {"source": ..., ...}}
+    {"id": 1, "return_code": 0, "stdout": "...", "stderr": "..."}
+
+Compilers and plugins are loaded from the ``node_modules`` directories
+that contain the ``.bin`` directories in ``config.bin.dirs``.
+
+A :class:`NodeWorkerPool` starts workers as needed, one for each source
+being compiled concurrently. Compilers the workers can't load (or all
+compilers, if Node isn't installed) are reported as unsupported so the
+caller can fall back to running the compiler's CLI.
+
+"""
+import itertools
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+
+from runcommands.runners.commands import get_default_local_prepend_path
+from runcommands.runners.result import Result
+from runcommands.util import printer
+
+from .trace import span
+from .util import cpu_count
+
+
+__all__ = [
+    'NodeWorker',
+    'NodeWorkerError',
+    'NodeWorkerPool',
+]
+
+
+COMPILERS = ('less', 'scss', 'rjs')
+
+SCRIPT = os.path.join(os.path.dirname(__file__), 'node_worker.js')
+
+
+# The active pool (see NodeWorkerPool.activate)
+_current = None
+
+
+def active_pool():
+    return _current
+
+
+class NodeWorkerError(Exception):
+
+    pass
+
+
+class NodeWorker:
+
+    """A long-lived Node process that compiles static files.
+
+    Requests are handled one at a time; use a :class:`NodeWorkerPool`
+    to compile multiple sources concurrently.
+
+    """
+
+    def __init__(self, config):
+        bin_path = get_default_local_prepend_path(config) or ''
+        bin_dirs = [d for d in bin_path.split(os.pathsep) if d]
+        path = os.pathsep.join(bin_dirs + [os.environ.get('PATH', os.defpath)])
+        node = shutil.which('node', path=path)
+        if node is None:
+            raise NodeWorkerError('node not found on $PATH')
+        module_dirs = [os.path.dirname(d) for d in bin_dirs if os.path.basename(d) == '.bin']
+        if os.environ.get('NODE_PATH'):
+            module_dirs.append(os.environ['NODE_PATH'])
+        env = dict(os.environ, PATH=path, NODE_PATH=os.pathsep.join(module_dirs))
+        try:
+            self.process = subprocess.Popen(
+                [node, SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+                universal_newlines=True)
+        except OSError as exc:
+            raise NodeWorkerError('could not start {node}: {exc}'.format(node=node, exc=exc))
+        self.ids = itertools.count(1)
+
+    def request(self, compiler, **args):
+        """Run ``compiler`` with ``args`` in the worker.
+
+        Returns:
+            Result: The exit code and captured output of the compiler
+
+        Raises:
+            NodeWorkerError: The worker exited
+
+        """
+        request_id = next(self.ids)
+        request = json.dumps({'id': request_id, 'compiler': compiler, 'args': args})
+        try:
+            self.process.stdin.write(request + '\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (OSError, ValueError):
+            line = ''
+        if not line:
+            return_code = self.process.poll()
+            raise NodeWorkerError(
+                'Node worker exited unexpectedly (exit code {return_code})'.format_map(locals()))
+        response = json.loads(line)
+        assert response['id'] == request_id
+        return Result(
+            response['return_code'],
+            [response['stdout'].encode('utf-8')],
+            [response['stderr'].encode('utf-8')],
+            'utf-8')
+
+    def check(self, compilers=COMPILERS):
+        """Get the subset of ``compilers`` the worker can load."""
+        result = self.request('check', compilers=list(compilers))
+        if result.failed:
+            raise NodeWorkerError(result.stderr.strip())
+        return json.loads(result.stdout)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+
+
+class NodeWorkerPool:
+
+    """Starts up to ``size`` workers as needed.
+
+    Args:
+        size (int): Max number of workers; 0 means use the number of
+            CPUs
+
+    Typical usage::
+
+        with NodeWorkerPool(config).activate() as pool:
+            if pool.supports('less'):
+                result = pool.request('less', source=..., destination=...)
+
+    Workers are stopped when the ``with`` block exits.
+
+    """
+
+    def __init__(self, config, size=0):
+        self.config = config
+        self.size = size or cpu_count()
+        self.workers = []
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.available = None
+
+    @contextmanager
+    def activate(self):
+        """Make this the active pool for the ``with`` block."""
+        global _current
+        previous, _current = _current, self
+        try:
+            yield self
+        finally:
+            _current = previous
+            self.close()
+
+    def supports(self, compiler):
+        """Can the workers run ``compiler``?
+
+        The first call starts a worker to find out which compilers it
+        can load; if that fails, no compilers are supported.
+
+        """
+        with self.lock:
+            if self.available is None:
+                self.available = set()
+                try:
+                    worker = self._start()
+                    self.available.update(worker.check())
+                except NodeWorkerError as exc:
+                    printer.warning('Node worker unavailable ({exc}); using CLI'.format(exc=exc))
+                else:
+                    self.idle.put(worker)
+                    unavailable = ', '.join(sorted(set(COMPILERS) - self.available))
+                    if unavailable:
+                        printer.warning(
+                            'Node worker cannot load: {unavailable}; using CLI for those'
+                            .format_map(locals()))
+        return compiler in self.available
+
+    def request(self, compiler, **args):
+        """Run ``compiler`` in an idle worker.
+
+        If a worker can't be started or the worker dies, a failed result
+        is returned (and the worker is discarded).
+
+        """
+        worker = None
+        try:
+            worker = self._acquire()
+            result = worker.request(compiler, **args)
+        except NodeWorkerError as exc:
+            if worker is not None:
+                with self.lock:
+                    self.workers.remove(worker)
+                worker.close()
+            message = '{exc}\n'.format(exc=exc).encode('utf-8')
+            return Result(1, [], [message], 'utf-8')
+        self.idle.put(worker)
+        return result
+
+    def command(self, compiler, description, **args):
+        """Get a callable that runs ``compiler`` in a worker.
+
+        This can be passed to :func:`arctasks.static.run_compilers` in
+        place of a shell command.
+
+        """
+        return WorkerCommand(self, compiler, description, args)
+
+    def _acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                if len(self.workers) < self.size:
+                    return self._start()
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def _start(self):
+        worker = NodeWorker(self.config)
+        self.workers.append(worker)
+        return worker
+
+    def close(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
+
+
+class WorkerCommand:
+
+    def __init__(self, pool, compiler, description, args):
+        self.pool = pool
+        self.compiler = compiler
+        self.description = description
+        self.args = args
+
+    def __call__(self):
+        with span(str(self), 'local', command=self.description) as info:
+            result = self.pool.request(self.compiler, **self.args)
+            info['status'] = result.return_code
+        return result
+
+    def __str__(self):
+        return 'node-worker: {self.compiler} {self.description}'.format_map(locals())
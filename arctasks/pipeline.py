@@ -0,0 +1,101 @@
+"""Run tasks for a set of targets in the background.
+
+This is used to overlap network work with CPU work--for example, to
+push the outputs of each local build step to the remote hosts while the
+remaining steps are still running::
+
+    pipeline = Pipeline(hosts, push_outputs, start=prepare_host)
+    run_steps(steps, run_step, on_complete=pipeline.add)
+    failures = pipeline.finish()
+
+Each target has its own queue, and tasks for a target are run one at a
+time, in the order they were added. Tasks for different targets are run
+concurrently, up to ``jobs`` targets at a time.
+
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from runcommands.util import printer
+
+
+__all__ = [
+    'Pipeline',
+]
+
+
+class Pipeline:
+
+    """Run tasks for each of ``targets`` in the background.
+
+    Args:
+        targets: Targets to run tasks for (e.g., host names)
+        run_task (callable): Called with a target and the args passed to
+            :meth:`add`
+        start (callable): Called with each target before its first task
+        jobs (int): Max number of targets to run tasks for at once; 0
+            means no limit
+
+    If a task fails for a target, the remaining tasks for that target
+    are skipped; the failure is reported by :meth:`finish`.
+
+    """
+
+    def __init__(self, targets, run_task, start=None, jobs=0):
+        self.targets = list(targets)
+        self.run_task = run_task
+        self.semaphore = threading.Semaphore(jobs or len(self.targets) or 1)
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+        self.executors = OrderedDict(
+            (target, ThreadPoolExecutor(max_workers=1)) for target in self.targets)
+        self.futures = []
+        if start is not None:
+            for target in self.targets:
+                self._submit(target, start, (target,))
+
+    def add(self, *args):
+        """Add a task to the queue of each target."""
+        for target in self.targets:
+            self._submit(target, self.run_task, (target,) + args)
+
+    def _submit(self, target, func, args):
+        def run():
+            with self.lock:
+                if target in self.failures:
+                    return
+            with self.semaphore:
+                try:
+                    func(*args)
+                except (Exception, SystemExit) as exc:
+                    with self.lock:
+                        self.failures[target] = exc
+
+        self.futures.append(self.executors[target].submit(run))
+
+    def finish(self):
+        """Wait for all tasks to complete.
+
+        Returns:
+            OrderedDict: Target => exception for each target that failed
+
+        """
+        start_time = time.monotonic()
+        pending = sum(1 for future in self.futures if not future.done())
+        if pending:
+            printer.info('Waiting for {pending} background task(s)...'.format_map(locals()))
+        for executor in self.executors.values():
+            executor.shutdown()
+        if pending:
+            elapsed = time.monotonic() - start_time
+            printer.info('Background tasks finished in {elapsed:.1f}s'.format_map(locals()))
+        return self.failures
+
+    def cancel(self):
+        """Cancel tasks that haven't started and wait for running tasks."""
+        for future in self.futures:
+            future.cancel()
+        for executor in self.executors.values():
+            executor.shutdown()
@@ -0,0 +1,205 @@
+"""Probe the health and latency of a deployed site.
+
+Requests are sent concurrently from a thread pool. Since only the
+standard library is available, each request is made with
+:func:`urlopen`.
+
+"""
+import json
+import math
+import os
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from runcommands.util import abort, printer
+
+
+__all__ = [
+    'ProbeHistory',
+    'probe',
+    'show_comparison',
+    'show_stats',
+]
+
+
+# Certificates aren't verified (e.g., so staging sites with self-signed
+# certificates can be probed). Python < 3.4.3 doesn't verify them and
+# urlopen() doesn't accept a context.
+try:
+    _urlopen_kwargs = {'context': ssl._create_unverified_context()}
+except AttributeError:
+    _urlopen_kwargs = {}
+
+
+def probe(base_url, paths=('/',), requests=20, concurrency=10, timeout=10, wait=60):
+    """Wait for site to become healthy, then measure its latency.
+
+    Args:
+        base_url: Scheme and host (e.g., ``https://example.com``)
+        paths: Paths to request
+        requests: Number of requests to send to *each* path
+        concurrency: Max number of requests in flight at once
+        timeout: Timeout for each request in seconds
+        wait: Max time to wait for the site to become healthy (i.e.,
+            for the first path to return a non-error response)
+
+    Returns:
+        dict: Stats for all requests (under the ``'all'`` key) and for
+            each path
+
+    """
+    url = base_url + paths[0]
+    printer.info('Waiting for {url} to become healthy...'.format_map(locals()))
+    deadline = time.monotonic() + wait
+    attempts = 0
+    while True:
+        attempts += 1
+        latency, error = _fetch(url, timeout)
+        if error is None:
+            break
+        if time.monotonic() > deadline:
+            abort(1, '{url} is not healthy after {attempts} attempts: {error}'
+                     .format_map(locals()))
+        printer.warning('{url} is not healthy yet: {error}'.format_map(locals()))
+        time.sleep(1)
+
+    num_requests = len(paths) * requests
+    printer.info(
+        'Sending {num_requests} requests, {concurrency} at a time...'.format_map(locals()))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            (path, executor.submit(_fetch, base_url + path, timeout))
+            for path in paths for _ in range(requests)]
+        results = [(path,) + future.result() for (path, future) in futures]
+
+    stats = {'all': get_stats(results)}
+    for path in paths:
+        stats[path] = get_stats([r for r in results if r[0] == path])
+    return stats
+
+
+def _fetch(url, timeout):
+    """Fetch ``url``, returning its latency and error (if any)."""
+    start_time = time.monotonic()
+    try:
+        with urlopen(url, timeout=timeout, **_urlopen_kwargs) as response:
+            response.read()
+    except (HTTPError, URLError, OSError) as exc:
+        return time.monotonic() - start_time, str(exc)
+    return time.monotonic() - start_time, None
+
+
+def get_stats(results):
+    latencies = sorted(latency for (_, latency, error) in results if error is None)
+    errors = sum(1 for (_, _, error) in results if error is not None)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def percentile(values, p):
+    """Get ``p``th percentile of sorted ``values`` (nearest rank)."""
+    if not values:
+        return None
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def format_latency(value):
+    return '-' if value is None else '{0:.0f}ms'.format(value * 1000)
+
+
+def show_stats(stats):
+    longest = max(len(name) for name in stats)
+    printer.header('Probe results:')
+    print('{0:<{longest}} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}'.format(
+        'path', 'requests', 'errors', 'p50', 'p95', 'p99', longest=longest))
+    for name, item in sorted(stats.items(), key=lambda i: (i[0] != 'all', i[0])):
+        print('{name:<{longest}} {requests:>8} {error_rate:>8.1%} {p50:>8} {p95:>8} {p99:>8}'
+              .format(
+                  name=name, longest=longest, requests=item['requests'],
+                  error_rate=item['error_rate'], p50=format_latency(item['p50']),
+                  p95=format_latency(item['p95']), p99=format_latency(item['p99'])))
+
+
+def show_comparison(stats, baseline, threshold=1.5):
+    """Compare ``stats`` to ``baseline`` stats and warn on regressions.
+
+    A regression is a percentile that's more than ``threshold`` times
+    slower than the baseline or an error rate that's higher than the
+    baseline's.
+
+    Returns:
+        bool: Whether any regressions were found
+
+    """
+    version = baseline['version']
+    printer.header('Compared to {version}:'.format_map(locals()))
+    regressed = False
+    for name, item in sorted(stats.items()):
+        base_item = baseline['stats'].get(name)
+        if base_item is None:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            value, base_value = item[key], base_item[key]
+            if value is None or not base_value:
+                continue
+            ratio = value / base_value
+            message = '{name} {key}: {0} => {1} ({ratio:.2f}x)'.format(
+                format_latency(base_value), format_latency(value), **locals())
+            if ratio > threshold:
+                regressed = True
+                printer.warning(message)
+            else:
+                print(message)
+        if item['error_rate'] > base_item['error_rate']:
+            regressed = True
+            printer.warning('{name} error rate: {0:.1%} => {1:.1%}'.format(
+                base_item['error_rate'], item['error_rate'], name=name))
+    return regressed
+
+
+class ProbeHistory:
+
+    """Locally stored probe results for an env.
+
+    Args:
+        path: JSON file to store results in
+        max_entries: Max number of results to keep
+
+    """
+
+    def __init__(self, path, max_entries=20):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_entries = max_entries
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return []
+
+    def add(self, version, stats):
+        entries = self.load()
+        entries.append({'version': version, 'time': time.time(), 'stats': stats})
+        entries = entries[-self.max_entries:]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as fp:
+            json.dump(entries, fp, indent=2)
+
+    def baseline(self, version):
+        """Get most recent results for a version other than ``version``."""
+        for entry in reversed(self.load()):
+            if entry['version'] != version:
+                return entry
+        return None
@@ -1,10 +1,25 @@
+import atexit
 import os
+import posixpath
+import re
+import shlex
+import shutil
 import string
+import subprocess
 import tempfile
+import threading
+import time
+import uuid
 
 from runcommands import command
-from runcommands.commands import local, remote
-from runcommands.util import abs_path, args_to_str
+from runcommands.commands import local, remote as _remote
+from runcommands.runners.local import LocalRunner
+from runcommands.runners.remote import RemoteRunner
+from runcommands.runners.result import Result
+from runcommands.util import abort, abs_path, args_to_str, printer
+
+from .archive import get_codec, write_archive
+from .trace import remote, span
 
 
 @command
@@ -18,19 +33,198 @@ def manage(config, args):
     ))
 
 
+class RemoteBatch:
+
+    """Run a batch of remote commands in a single round trip.
+
+    Commands are queued with :meth:`add` and then combined into a single
+    script that's run with one ``remote`` call when :meth:`run` is
+    called (or when the ``with`` block exits)::
+
+        with RemoteBatch(config) as batch:
+            batch.add('rm -f {remote.pip.wheel_dir}/xyz*')
+            batch.add('{remote.build.pip} install xyz', abort_on_failure=False)
+
+    Each command is run in a subshell (so ``cd`` in one command doesn't
+    affect the others), and its exit status and output are captured
+    separately. As with ``remote``, if a command fails and its
+    ``abort_on_failure`` flag is set, the run is aborted; commands
+    queued after it are not run.
+
+    Output is shown as it's produced (unless hidden). The output of each
+    command is preceded and followed by marker lines like these, so it
+    can be attributed to the command::
+
+        arctasks-batch-1a2b3c4d5e6f begin 2/2: .../.env/bin/pip install xyz
+        ...
+        arctasks-batch-1a2b3c4d5e6f end 2/2 exit 0
+
+    Args:
+        config: Config
+        echo: Include each command in the marker line before its output
+        hide: Hide output; see ``remote``
+        remote_args: Passed through to ``remote`` (e.g., ``host``,
+            ``run_as``, ``timeout``); note that these are *not*
+            formatted with config
+
+    """
+
+    def __init__(self, config, echo=True, hide=None, **remote_args):
+        self.config = config
+        self.echo = echo
+        self.hide = hide
+        self.remote_args = remote_args
+        self.commands = []
+        self.results = []
+
+    def add(self, cmd, cd=None, abort_on_failure=True, inject_config=True):
+        """Queue ``cmd``.
+
+        Unless ``inject_config`` is ``False``, ``cmd`` and ``cd`` are
+        formatted with config.
+
+        """
+        format_kwargs = self.config if inject_config else {}
+        cmd = args_to_str(cmd, format_kwargs=format_kwargs)
+        if cd:
+            cd = cd.format_map(format_kwargs) if inject_config else cd
+            cmd = 'cd {cd} && {cmd}'.format(cd=cd, cmd=cmd)
+        self.commands.append((cmd, abort_on_failure))
+
+    def get_script(self, commands, marker):
+        # NOTE: The script has to be a single line because runcommands
+        #       runs remote commands via `eval $(cat <<'EOF' ...)`,
+        #       which collapses newlines.
+        script = []
+        count = len(commands)
+        for i, (cmd, abort_on_failure) in enumerate(commands):
+            n = i + 1
+            begin = '{marker} begin {n}/{count}'.format_map(locals())
+            if self.echo:
+                begin = '{begin}: {cmd}'.format_map(locals())
+            script.append("printf '%s\\n' {0}".format(shlex.quote(begin)))
+            script.append('( {cmd} ) 2>&1'.format_map(locals()))
+            script.append('s=$?')
+            script.append('echo "{marker} end {n}/{count} exit $s"'.format_map(locals()))
+            if abort_on_failure:
+                script.append('[ $s -eq 0 ] || exit $s')
+        return '; '.join(script)
+
+    def run(self):
+        """Run queued commands and return a list of results.
+
+        Each result is a ``runcommands`` ``Result`` with the command's
+        exit code and output. Commands that weren't run because an
+        earlier command failed have no result.
+
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+
+        marker = 'arctasks-batch-{id}'.format(id=uuid.uuid4().hex[:12])
+        script = self.get_script(commands, marker)
+
+        # The batch is traced as a whole rather than via the traced
+        # remote so the span describes the queued commands instead of
+        # the generated script.
+        description = '; '.join(cmd for (cmd, _) in commands)
+        name = 'remote batch: {description:.60}'.format_map(locals())
+        host = self.remote_args.get('host') or self.config._get_dotted('remote.host', None)
+        with span(name, 'remote', command=description, host=host) as info:
+            result = _remote(
+                self.config, script, echo=False, hide=self.hide, abort_on_failure=False,
+                inject_config=False, **self.remote_args)
+            info['status'] = result.return_code
+
+        outputs = {}
+        return_codes = {}
+        current = None
+        for line in result.stdout.splitlines(keepends=True):
+            index = line.find(marker)
+            if index == -1:
+                if current is not None:
+                    outputs[current].append(line)
+                continue
+            if index and current is not None:
+                # The end marker follows output that has no trailing
+                # newline.
+                outputs[current].append(line[:index] + '\n')
+            # {marker} begin {n}/{count}[: {cmd}]
+            # {marker} end {n}/{count} exit {return_code}
+            fields = line[index:].split(None, 3)
+            event = fields[1]
+            i = int(fields[2].split('/')[0]) - 1
+            if event == 'begin':
+                current = i
+                outputs[i] = []
+            else:
+                current = None
+                return_codes[i] = int(fields[3].split()[-1])
+
+        encoding = result.encoding
+        results = []
+
+        for i, (cmd, abort_on_failure) in enumerate(commands):
+            if i not in return_codes:
+                # Commands after one that failed with abort_on_failure
+                # set aren't run, but that aborts below, so a missing
+                # exit code means the batch itself failed (e.g., the
+                # connection was lost) or its output couldn't be parsed.
+                return_code = result.return_code
+                abort(2, 'Remote batch failed with exit code {return_code} before completing: '
+                         '{cmd}'.format_map(locals()))
+            output = ''.join(outputs[i])
+            return_code = return_codes[i]
+            results.append(Result(return_code, [output.encode(encoding)], [], encoding))
+            if return_code and abort_on_failure:
+                abort(2, 'Remote command failed with exit code {return_code}: {cmd}'
+                         .format_map(locals()))
+
+        self.results = results
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.run()
+
+
 _rsync_default_mode = 'ug=rwX,o-rwx'
 
 
 @command
 def rsync(config, local_path, remote_path, user=None, host=None, sudo=False, run_as=None,
           dry_run=False, delete=False, excludes=(), default_excludes=True, quiet=False,
-          echo=True, hide=None, mode=_rsync_default_mode, source='local'):
+          echo=True, hide=None, mode=_rsync_default_mode, source='local', checksum=False,
+          link_dest=None, files_from=None, stats=False, times=True):
     """Copy files using rsync.
 
     By default, this pushes from ``local_path`` to ``remote_path``. To
     invert this--to pull from the remote to the local path--, pass
     ``source='remote'``.
 
+    Pass ``checksum=True`` to compare files by content rather than by
+    size and modification time.
+
+    When ``link_dest`` is specified, files that are unchanged relative
+    to the corresponding files in the ``link_dest`` directory on the
+    destination host will be hard linked from there instead of being
+    transferred (see rsync's ``--link-dest`` option). Note that rsync
+    only links files whose modification times also match unless
+    ``times=False`` is passed, in which case modification times aren't
+    preserved (and files are linked when their contents match).
+
+    When ``files_from`` is specified, only the files and directories
+    listed in it (relative to ``local_path``, one per line) are copied
+    (see rsync's ``--files-from`` option).
+
+    Pass ``stats=True`` to have rsync report transfer stats; the number
+    of bytes sent can then be retrieved from the result with
+    :func:`rsync_bytes_sent`.
+
     """
     remote_path = '{user}@{host}:{remote_path}'.format_map(locals())
 
@@ -58,13 +252,27 @@ def rsync(config, local_path, remote_path, user=None, host=None, sudo=False, run
     if excludes:
         excludes = tuple("--exclude '{p}'".format(p=p) for p in excludes)
 
-    local(config, (
+    ssh_args = ssh_options(config, user, host)
+    if ssh_args:
+        ssh_args = '-e "ssh {ssh_args}"'.format(ssh_args=' '.join(ssh_args))
+
+    if stats and quiet:
+        # --quiet would suppress the stats, so hide all output instead.
+        quiet = False
+        hide = hide or 'stdout'
+
+    return local(config, (
         'rsync',
-        '-rltvz',
+        '-rltvz' if times else '-rlvz',
         '--quiet' if quiet else '',
+        '--stats' if stats else '',
         '--dry-run' if dry_run else '',
         '--delete' if delete else '',
+        '--checksum' if checksum else '',
+        ('--link-dest', link_dest) if link_dest else None,
+        ('--files-from', files_from) if files_from else None,
         rsync_path,
+        ssh_args,
         '--no-perms', '--no-group', '--chmod=%s' % mode,
         exclude_from,
         excludes,
@@ -72,6 +280,14 @@ def rsync(config, local_path, remote_path, user=None, host=None, sudo=False, run
     ), echo=echo, hide=hide)
 
 
+def rsync_bytes_sent(result):
+    """Get number of bytes sent from result of ``rsync(stats=True)``."""
+    match = re.search(r'^Total bytes sent: ([\d,.]+)', result.stdout or '', re.MULTILINE)
+    if match is None:
+        return None
+    return int(re.sub(r'\D', '', match.group(1)))
+
+
 @command
 def copy_file(config, local_path, remote_path, user=None, host=None, sudo=False, run_as=None,
               quiet=False, template=False, template_type=None, mode=_rsync_default_mode):
@@ -101,3 +317,222 @@ def copy_file(config, local_path, remote_path, user=None, host=None, sudo=False,
         os.remove(temp_path)
     else:
         rsync(config, local_path, remote_path, **rsync_args)
+
+
+@command
+def stream_tree(config, local_path, remote_path, arcname=None, user=None, host=None, run_as=None,
+                codec='gzip', quiet=False):
+    """Stream a local directory to the remote host as a tarball.
+
+    The tar stream is generated on the fly, compressed with ``codec``
+    (see :mod:`arctasks.archive`), and piped over a single SSH
+    connection into ``tar x`` on the remote host, so no archive is
+    written locally (or remotely).
+
+    ``local_path`` will be extracted into ``remote_path``, which will be
+    created if necessary, as ``arcname`` (the base name of
+    ``local_path`` by default).
+
+    """
+    codec = get_codec(codec)
+    local_path = abs_path(local_path, format_kwargs=config)
+    remote_path = remote_path.format_map(config)
+    arcname = arcname or os.path.basename(local_path.rstrip(os.sep))
+
+    extract_command = codec.extract_command()
+    cmd = 'mkdir -p {remote_path} && cd {remote_path} && {extract_command}'.format_map(locals())
+    ssh_args = ssh_command(config, cmd, user=user, host=host, run_as=run_as)
+
+    if not quiet:
+        printer.info('Streaming {local_path} to {remote_path}...'.format_map(locals()))
+
+    process = subprocess.Popen(ssh_args, stdin=subprocess.PIPE)
+
+    try:
+        compressor_return_code = write_archive(local_path, arcname, process.stdin, codec)
+    except BrokenPipeError:
+        # The remote side went away; its exit code is reported below.
+        compressor_return_code = 0
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = process.wait()
+
+    return_code = return_code or compressor_return_code
+    if return_code:
+        abort(2, 'Streaming {local_path} failed with exit code {return_code}'.format_map(locals()))
+
+
+def mark_changes(config, marker, run_as=None):
+    """Create ``marker`` on the remote host if it doesn't exist.
+
+    Paths written on the remote host after this can then be found
+    (e.g., by :func:`fix_permissions`) by comparing their status change
+    times to the marker's modification time. An existing marker is left
+    as is so that resuming a failed deployment doesn't lose track of
+    changes made before it failed.
+
+    Failure to create the marker isn't fatal (the marker's absence just
+    means all paths will be considered changed).
+
+    """
+    directory = posixpath.dirname(marker)
+    remote(config, (
+        'mkdir -p', directory, '&& (test -e', marker, '|| touch', marker, ')',
+    ), cd='/', run_as=run_as, abort_on_failure=False)
+
+
+def fix_permissions(config, paths, mode='ug=rwX,o-rwx', since=None, run_as=None):
+    """Set the permissions of ``paths`` (recursively) to ``mode``.
+
+    If ``since`` is specified, it's the path to a marker file created by
+    :func:`mark_changes`, and only paths that have been written since
+    the marker was created are updated; the marker is removed
+    afterwards. If the marker doesn't exist, all paths are updated.
+
+    Unlike ``chmod -R``, this waits for the command to complete and
+    reports how many paths were updated and how long it took.
+
+    Returns:
+        int: The number of paths that were updated
+
+    """
+    if isinstance(paths, str):
+        paths = (paths,)
+    if since:
+        newer = (
+            'if test -e', since, '; then newer="-cnewer', since, '"; else newer=""; fi;')
+    else:
+        newer = 'newer="";'
+    start_time = time.monotonic()
+    result = remote(config, (
+        newer,
+        'find', paths, '! -type l $newer -print -exec chmod', mode, '{{}} + 2>/dev/null | wc -l',
+        ('; rm -f', since) if since else None,
+    ), cd='/', run_as=run_as, hide='stdout', timeout=None)
+    elapsed = time.monotonic() - start_time
+    try:
+        count = int(result.stdout_lines[-1].strip())
+    except (IndexError, ValueError):
+        count = 0
+    printer.info(
+        'Set permissions of {count} path(s) to {mode} in {elapsed:.1f}s'.format_map(locals()))
+    return count
+
+
+def ssh_command(config, cmd, user=None, host=None, run_as=None):
+    """Get args for running ``cmd`` on the remote host via ``ssh``.
+
+    ``user``, ``host``, and ``run_as`` default to the corresponding
+    ``remote`` config values. When ``run_as`` is set (and differs from
+    ``user``), ``cmd`` will be run via ``sudo -u {run_as}``.
+
+    """
+    user = (user or config.remote.user).format_map(config)
+    host = (host or config.remote.host).format_map(config)
+    run_as = (run_as or config.remote.run_as).format_map(config)
+
+    if run_as and run_as != user:
+        cmd = 'sudo -u {run_as} sh -c {cmd}'.format(run_as=run_as, cmd=shlex.quote(cmd))
+
+    ssh_args = ['ssh', '-q']
+    ssh_args.extend(ssh_options(config, user, host))
+    ssh_args.extend(('{user}@{host}'.format_map(locals()), cmd))
+    return ssh_args
+
+
+# SSH connection sharing
+#
+# When the ``remote.strategy`` config option is set to "ssh-mux" (as it
+# is during deployments), a single multiplexed SSH connection is opened
+# per host per run (using OpenSSH's ControlMaster feature) and reused for all
+# ``remote``, ``rsync``, ``copy_file``, etc calls. The connections are
+# closed when the run exits.
+
+
+class SSHMultiplexer:
+
+    # Master connections are closed explicitly at exit; this is just a
+    # safety net in case that doesn't happen (e.g., on SIGKILL).
+    persist = 300
+
+    def __init__(self):
+        self.control_dir = None
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def options(self, user, host):
+        with self.lock:
+            if self.control_dir is None:
+                # Keep the control path short; sockets paths are limited
+                # to ~100 characters.
+                self.control_dir = tempfile.mkdtemp(prefix='arctasks-ssh-', dir='/tmp')
+            self.connections.add((user, host))
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={self.control_dir}/%C'.format_map(locals()),
+            '-o', 'ControlPersist={self.persist}'.format_map(locals()),
+        ]
+
+    def close(self):
+        with self.lock:
+            for user, host in self.connections:
+                destination = '{user}@{host}'.format_map(locals()) if user else host
+                control_path = '{self.control_dir}/%C'.format_map(locals())
+                subprocess.call(
+                    ['ssh', '-q', '-o', 'ControlPath=' + control_path, '-O', 'exit', destination],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.connections.clear()
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+                self.control_dir = None
+
+
+ssh_multiplexer = SSHMultiplexer()
+atexit.register(ssh_multiplexer.close)
+
+
+def ssh_options(config, user, host):
+    """Get extra ``ssh`` options for connecting to host.
+
+    Returns connection sharing options when the ``remote.strategy``
+    config option is "ssh-mux"; otherwise, returns an empty list.
+
+    """
+    if config._get_dotted('remote.strategy', 'ssh') != 'ssh-mux':
+        return []
+    if user:
+        user = user.format_map(config)
+    host = host.format_map(config)
+    return ssh_multiplexer.options(user, host)
+
+
+class RemoteRunnerSSHMultiplexed(RemoteRunner):
+
+    """Run remote commands via a shared SSH connection.
+
+    This is the same as the "ssh" strategy, except that SSH connections
+    are shared (see :class:`SSHMultiplexer`). To use it, pass
+    ``strategy='ssh-mux'`` to ``remote``.
+
+    """
+
+    name = 'ssh-mux'
+
+    def run(self, cmd, host, user=None, cd=None, path=None, prepend_path=None,
+            append_path=None, sudo=False, run_as=None, echo=False, hide=False, timeout=30,
+            use_pty=True, debug=False):
+        use_pty = self.use_pty(use_pty)
+        ssh_connection_str = '{user}@{host}'.format(user=user, host=host) if user else host
+        path = self.munge_path(path, prepend_path, append_path, '$PATH')
+        remote_command = self.get_remote_command(cmd, user, cd, path, sudo, run_as, use_pty)
+        ssh_cmd = ['ssh', '-q']
+        ssh_cmd.extend(ssh_multiplexer.options(user, host))
+        if use_pty:
+            ssh_cmd.append('-t')
+        ssh_cmd.extend((ssh_connection_str, remote_command))
+        local_runner = LocalRunner()
+        return local_runner.run(
+            ssh_cmd, echo=echo, hide=hide, timeout=timeout, use_pty=use_pty, debug=debug)
@@ -0,0 +1,74 @@
+"""Deployment state.
+
+The steps completed during a deployment are recorded along with a hash
+of their inputs so that a failed deployment can be resumed without
+redoing steps whose inputs haven't changed (see ``deploy --resume``).
+
+Steps are recorded per scope: "local" for local steps and the host name
+for remote steps.
+
+"""
+import json
+import os
+import threading
+
+
+__all__ = [
+    'DeployState',
+]
+
+
+class DeployState:
+
+    """Completed steps and their input hashes.
+
+    Args:
+        path: Local JSON file the state is saved to
+        data: Scope => step name => input hash
+
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data or {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Load state from ``path``; if it doesn't exist, start fresh."""
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = None
+        return cls(path, data)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = '{self.path}.tmp'.format_map(locals())
+        with open(temp_path, 'w') as fp:
+            json.dump(self.data, fp, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def is_done(self, scope, step, input_hash):
+        """Was ``step`` completed in ``scope`` with the same inputs?"""
+        if input_hash is None:
+            return False
+        with self.lock:
+            return self.data.get(scope, {}).get(step) == input_hash
+
+    def mark_done(self, scope, step, input_hash):
+        with self.lock:
+            self.data.setdefault(scope, {})[step] = input_hash
+            self.save()
+
+    def get_scope(self, scope):
+        with self.lock:
+            return dict(self.data.get(scope, {}))
+
+    def set_scope(self, scope, steps):
+        """Replace state for ``scope`` (e.g., with the state read from a
+        remote host, which is authoritative for that host)."""
+        with self.lock:
+            self.data[scope] = dict(steps)
+            self.save()
@@ -1,12 +1,19 @@
 import os
+import shlex
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from runcommands import command
-from runcommands.commands import local
 from runcommands.util import abort, abs_path, args_to_str, Hide, printer
 
+from .cssdeps import CSSBuildCache
 from .django import call_command, get_settings
+from .nodeworker import NodeWorkerPool, active_pool
 from .remote import rsync
-from .util import flatten_globs
+from .staticfiles import StaticFilesCollector
+from .trace import local
+from .util import cpu_count, flatten_globs
 
 
 # Copied from Bootstrap (from grunt/configBridge.json in the source)
@@ -25,11 +32,25 @@ _autoprefixer_browsers = ','.join((
 @command(default_env='dev')
 def build_static(config, css=True, css_sources=(), js=True, js_sources=(), collect=True,
                  optimize=True, static_root=None, default_ignore=True, ignore=(), exclude=(),
-                 include=(), echo=False, hide=None):
-    if css:
-        build_css(config, sources=css_sources, optimize=optimize, echo=echo, hide=hide)
-    if js:
-        build_js(config, sources=js_sources, optimize=optimize, echo=echo, hide=hide)
+                 include=(), force=False, jobs=0, node_worker=False, echo=False, hide=None):
+    """Build CSS and JS and collect static files.
+
+    Pass ``--node-worker`` to compile CSS and JS in persistent Node
+    processes (see :mod:`arctasks.nodeworker`) that are shared by all
+    of the sources instead of running each compiler's CLI for each
+    source. To enable this for a project, set
+    ``defaults.arctasks.static.build_static.node_worker`` to ``true``.
+
+    """
+    with _node_workers(config, node_worker, jobs):
+        if css:
+            build_css(
+                config, sources=css_sources, optimize=optimize, force=force, jobs=jobs,
+                node_worker=node_worker, echo=echo, hide=hide)
+        if js:
+            build_js(
+                config, sources=js_sources, optimize=optimize, jobs=jobs,
+                node_worker=node_worker, echo=echo, hide=hide)
     if collect:
         collectstatic(
             config, static_root=static_root, default_ignore=default_ignore, ignore=ignore,
@@ -37,56 +58,103 @@ def build_static(config, css=True, css_sources=(), js=True, js_sources=(), colle
 
 
 @command(default_env='dev')
-def build_css(config, sources=(), optimize=True, echo=False, hide=None):
+def build_css(config, sources=(), optimize=True, force=False, jobs=0, node_worker=False,
+              echo=False, hide=None):
+    """Compile LESS and SCSS sources.
+
+    Sources are only compiled when they or the files they import have
+    changed since they were last compiled (see :mod:`arctasks.cssdeps`);
+    pass ``--force`` to compile all sources. Sources are compiled
+    concurrently, up to ``--jobs`` at a time, optionally in persistent
+    Node processes (``--node-worker``).
+
+    """
     if not sources:
         sources = []
         sources.extend(lessc.get_default(config, 'sources', []))
         sources.extend(sass.get_default(config, 'sources', []))
     less_sources = [s for s in sources if s.endswith('less')]
     sass_sources = [s for s in sources if s.endswith('scss')]
-    if less_sources:
-        lessc(config, sources=less_sources, optimize=optimize, echo=echo, hide=hide)
-    if sass_sources:
-        sass(config, sources=sass_sources, optimize=optimize, echo=echo, hide=hide)
+    kwargs = dict(
+        optimize=optimize, force=force, jobs=jobs, node_worker=node_worker, echo=echo, hide=hide)
+    with _node_workers(config, node_worker, jobs):
+        if less_sources:
+            lessc(config, sources=less_sources, **kwargs)
+        if sass_sources:
+            sass(config, sources=sass_sources, **kwargs)
 
 
 @command(default_env='dev')
 def lessc(config, sources=(), optimize=True, autoprefixer_browsers=_autoprefixer_browsers,
-          echo=False, hide=None):
+          force=False, cache_file='{path.css_cache_file}', jobs=0, node_worker=False, echo=False,
+          hide=None):
     """Compile the LESS files specified by ``sources``.
 
     Each LESS file will be compiled into a CSS file with the same root
     name. E.g., "path/to/base.less" will be compiled to "path/to/base.css".
 
+    Files whose outputs are up to date are skipped unless ``--force``
+    is passed (see :mod:`arctasks.cssdeps`). Files are compiled
+    concurrently, up to ``--jobs`` at a time (by default, the number of
+    CPUs). With ``--node-worker``, files are compiled in persistent Node
+    processes when possible (see :mod:`arctasks.nodeworker`).
+
     TODO: Make destination paths configurable?
 
     """
-    which = local(config, 'which lessc', echo=False, hide='stdout', abort_on_failure=False)
-    if which.failed:
-        abort(1, 'less must be installed (via npm) and on $PATH')
-
     sources = flatten_globs(config, sources)
 
     for source in sources:
-        root, ext = os.path.splitext(source)
+        _, ext = os.path.splitext(source)
         if ext != '.less':
             abort(1, 'Expected a .less file; got "{source}"'.format(source=source))
-        destination = '{root}.css'.format(root=root)
-        local(config, (
+
+    def check(pool):
+        if pool is not None and pool.supports('less'):
+            return
+        which = local(config, 'which lessc', echo=False, hide='stdout', abort_on_failure=False)
+        if which.failed:
+            abort(1, 'less must be installed (via npm) and on $PATH')
+
+    def get_commands(source, destination, pool):
+        if pool is not None and pool.supports('less'):
+            return [pool.command(
+                'less', source, source=source, destination=destination, optimize=optimize,
+                autoprefixer_browsers=autoprefixer_browsers)]
+        return [(
             'lessc',
             '--autoprefix="%s"' % autoprefixer_browsers,
             '--clean-css' if optimize else '',
             source, destination
-        ), echo=echo, hide=hide)
+        )]
+
+    options = {'optimize': optimize, 'autoprefixer_browsers': autoprefixer_browsers}
+    with _node_workers(config, node_worker, jobs) as pool:
+        _compile_css(
+            config, sources, 'less', options, get_commands, force, cache_file, jobs, echo, hide,
+            check=check, pool=pool)
 
 
 @command(default_env='dev')
 def sass(config, sources=(), optimize=True, autoprefixer_browsers=_autoprefixer_browsers,
-         echo=False, hide=None):
+         source_map=False, force=False, cache_file='{path.css_cache_file}', jobs=0,
+         node_worker=False, echo=False, hide=None):
     """Compile the SASS files specified by ``sources``.
 
     Each SASS file will be compiled into a CSS file with the same root
     name. E.g., "path/to/base.scss" will be compiled to "path/to/base.css".
+    With ``--source-map``, a source map will be written alongside it
+    (e.g., "path/to/base.css.map").
+
+    The CSS produced by node-sass is piped directly into postcss (which
+    runs autoprefixer and, if ``--optimize``, clean-css), so the CSS
+    file is only written once.
+
+    Files whose outputs are up to date are skipped unless ``--force``
+    is passed (see :mod:`arctasks.cssdeps`). Files are compiled
+    concurrently, up to ``--jobs`` at a time (by default, the number of
+    CPUs). With ``--node-worker``, files are compiled in persistent Node
+    processes when possible (see :mod:`arctasks.nodeworker`).
 
     TODO: Make destination paths configurable?
 
@@ -95,55 +163,256 @@ def sass(config, sources=(), optimize=True, autoprefixer_browsers=_autoprefixer_
     run_postcss = bool(optimize or autoprefixer_browsers)
 
     for source in sources:
-        root, ext = os.path.splitext(source)
-        out_dir = os.path.dirname(source)
-        destination = '{root}.css'.format(root=root)
-
+        _, ext = os.path.splitext(source)
         if ext != '.scss':
             abort(1, 'Expected a .scss file; got "{source}"'.format(source=source))
 
-        local(config, ('node-sass', source, '--output', out_dir), echo=echo, hide=hide)
+    def get_commands(source, destination, pool):
+        if pool is not None and pool.supports('scss'):
+            return [pool.command(
+                'scss', source, source=source, destination=destination, optimize=optimize,
+                autoprefixer_browsers=autoprefixer_browsers, source_map=source_map)]
+
+        if not run_postcss:
+            out_dir = os.path.dirname(source)
+            return [(
+                'node-sass',
+                '--source-map true' if source_map else '',
+                source,
+                '--output', out_dir,
+            )]
+
+        sass_args = ('node-sass', '--source-map-embed' if source_map else '', source)
+        postcss_args = ('postcss', '--map' if source_map else '')
+
+        if optimize:
+            postcss_args += ('--use', 'postcss-clean')
+
+        if autoprefixer_browsers:
+            browsers = "'{autoprefixer_browsers}'".format_map(locals())
+            postcss_args += ('--use', 'autoprefixer', '--autoprefixer.browsers', browsers)
+
+        postcss_args += ('--output', destination)
+
+        # pipefail makes the pipeline fail when node-sass fails
+        pipeline = ' | '.join((args_to_str(sass_args), args_to_str(postcss_args)))
+        return [('bash', '-o', 'pipefail', '-c', shlex.quote(pipeline))]
+
+    options = {
+        'optimize': optimize,
+        'autoprefixer_browsers': autoprefixer_browsers,
+        'source_map': source_map,
+    }
+    with _node_workers(config, node_worker, jobs) as pool:
+        _compile_css(
+            config, sources, 'scss', options, get_commands, force, cache_file, jobs, echo, hide,
+            pool=pool)
+
 
-        if run_postcss:
-            args = ('postcss', destination, '--replace')
+def _compile_css(config, sources, syntax, options, get_commands, force, cache_file, jobs=0,
+                 echo=False, hide=None, check=None, pool=None):
+    """Compile ``sources`` whose outputs aren't up to date.
 
-            if optimize:
-                args += ('--use', 'postcss-clean')
+    Args:
+        syntax: "less" or "scss"
+        options: Options that affect the output
+        get_commands (callable): Called with the source and destination
+            paths and ``pool`` to get the commands that compile a source
+        check (callable): Called with ``pool`` before compiling anything
+            (e.g., to check that the compiler is installed)
+        pool (NodeWorkerPool): Node workers to compile in, if enabled
 
-            if autoprefixer_browsers:
-                browsers = "'{autoprefixer_browsers}'".format_map(locals()),
-                args += ('--use', 'autoprefixer', '--autoprefixer.browsers', browsers)
+    """
+    cache = CSSBuildCache(cache_file.format_map(config))
+    to_compile = []
+    for source in sources:
+        root, _ = os.path.splitext(source)
+        destination = '{root}.css'.format(root=root)
+        include_paths = (os.path.dirname(source), os.getcwd())
+        fingerprint = cache.fingerprint(source, syntax, options, include_paths)
+        if force or not cache.is_current(source, destination, fingerprint):
+            to_compile.append((source, destination, fingerprint))
+
+    num_skipped = len(sources) - len(to_compile)
+    if num_skipped:
+        printer.info(
+            'Skipped {num_skipped} {syntax} file(s) that are up to date'.format_map(locals()))
+    if not to_compile:
+        return
+
+    if check is not None:
+        check(pool)
+
+    tasks = [
+        (source, get_commands(source, destination, pool))
+        for (source, destination, _) in to_compile]
+    destinations = {source: (destination, fingerprint)
+                    for (source, destination, fingerprint) in to_compile}
+
+    def on_success(source):
+        destination, fingerprint = destinations[source]
+        cache.update(source, destination, fingerprint)
+
+    try:
+        run_compilers(config, tasks, jobs=jobs, echo=echo, hide=hide, on_success=on_success)
+    finally:
+        cache.save()
+
+
+def run_compilers(config, tasks, jobs=0, echo=False, hide=None, on_success=None):
+    """Run compilers for multiple sources concurrently.
+
+    Args:
+        tasks (list): ``(source, commands)`` pairs; the commands for each
+            source are run in order; a command is either a shell command
+            or a callable that returns a result (e.g., a command that
+            runs in a Node worker; see :meth:`NodeWorkerPool.command`)
+        jobs (int): Max number of sources to compile at once; 0 means
+            use the number of CPUs
+        on_success (callable): Called with each source that was compiled
+            successfully
+
+    The output of each source's commands is captured and shown (unless
+    hidden) once the source has been compiled, in the order of
+    ``tasks``, so output from different sources isn't interleaved.
+
+    If any source fails to compile, no more sources will be started.
+    Sources are started in order, so once the sources that were already
+    running are done, the first source (in the order of ``tasks``) that
+    failed is reported.
 
-            local(config, args, echo=echo, hide=hide)
+    """
+    if not tasks:
+        return
+
+    def run(commands):
+        results = []
+        for cmd in commands:
+            if callable(cmd):
+                result = cmd()
+            else:
+                result = local(
+                    config, cmd, echo=False, hide='all', use_pty=False, abort_on_failure=False)
+            results.append((cmd, result))
+            if result.failed:
+                break
+        return results
+
+    jobs = min(jobs or cpu_count(), len(tasks))
+    hide_stdout = Hide.hide_stdout(hide)
+    hide_stderr = Hide.hide_stderr(hide)
+    failure = None
+
+    def stop_on_failure(future):
+        # Exceptions raised in done callbacks are swallowed, so check
+        # for one before getting the result (it's reraised below).
+        if future.cancelled():
+            return
+        if future.exception() is not None or future.result()[-1][1].failed:
+            for other_future in futures:
+                other_future.cancel()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run, commands) for (_, commands) in tasks]
+        for future in futures:
+            future.add_done_callback(stop_on_failure)
+        for (source, _), future in zip(tasks, futures):
+            if future.cancelled():
+                continue
+            results = future.result()
+            failed = results[-1][1].failed
+            for cmd, result in results:
+                if echo:
+                    description = cmd if callable(cmd) else args_to_str(cmd, format_kwargs=config)
+                    printer.echo('RUNNING:', description)
+                if result.stdout and not (hide_stdout and not failed):
+                    print(result.stdout, end='' if result.stdout.endswith('\n') else '\n')
+                if result.stderr and not (hide_stderr and not failed):
+                    print(result.stderr, end='' if result.stderr.endswith('\n') else '\n',
+                          file=sys.stderr)
+            if failed:
+                if failure is None:
+                    failure = (source, results[-1][1].return_code)
+            elif on_success is not None:
+                on_success(source)
+
+    if failure is not None:
+        source, return_code = failure
+        abort(return_code or 1, 'Compiling {source} failed with exit code {return_code}'
+                                .format_map(locals()))
 
 
 @command(default_env='dev')
 def build_js(config, sources=(), main_config_file='{package}:static/requireConfig.js',
-             base_url='{package}:static', optimize=True, paths=(), echo=False, hide=None):
+             base_url='{package}:static', optimize=True, paths=(), jobs=0, node_worker=False,
+             echo=False, hide=None):
+    """Build the RequireJS modules specified by ``sources`` with r.js.
+
+    Each module will be built into a file with the same name plus a
+    "-built" suffix. E.g., "path/to/main.js" will be built into
+    "path/to/main-built.js". Modules are built concurrently, up to
+    ``--jobs`` at a time (by default, the number of CPUs), optionally in
+    persistent Node processes (``--node-worker``).
+
+    """
     sources = flatten_globs(config, sources)
 
     main_config_file = abs_path(main_config_file, format_kwargs=config)
     base_url = abs_path(base_url, format_kwargs=config)
     optimize = 'uglify' if optimize else 'none'
-    if paths:
-        paths = ' '.join('paths.{k}={v}'.format(k=k, v=v) for k, v in paths.items())
+    path_args = ' '.join('paths.{k}={v}'.format(k=k, v=v) for k, v in dict(paths).items())
+
+    with _node_workers(config, node_worker, jobs) as pool:
+        use_worker = pool is not None and pool.supports('rjs')
+        tasks = []
+        for source in sources:
+            name = os.path.relpath(source, base_url)
+            if name.endswith('.js'):
+                name = name[:-3]
+            base_name = os.path.basename(name)
+            out = os.path.join(os.path.dirname(source), '{}-built.js'.format(base_name))
+            if use_worker:
+                rjs_config = {
+                    'mainConfigFile': main_config_file,
+                    'baseUrl': base_url,
+                    'name': name,
+                    'optimize': optimize,
+                    'paths': dict(paths),
+                    'out': out,
+                }
+                tasks.append((source, [pool.command('rjs', source, config=rjs_config)]))
+                continue
+            cmd = args_to_str((
+                'r.js -o',
+                'mainConfigFile={main_config_file}',
+                'baseUrl={base_url}',
+                'name={name}',
+                'optimize={optimize}',
+                path_args,
+                'out={out}',
+            ), format_kwargs=locals())
+            tasks.append((source, [cmd]))
+
+        run_compilers(config, tasks, jobs=jobs, echo=echo, hide=hide)
+
+
+@contextmanager
+def _node_workers(config, node_worker, jobs=0):
+    """Start Node workers for the ``with`` block if necessary.
+
+    Yields the active :class:`NodeWorkerPool` (starting one if there
+    isn't one) if ``node_worker`` is set; otherwise, yields ``None``.
+    This lets a single pool be shared by all of the compilers run by a
+    command like :func:`build_static`.
 
-    for source in sources:
-        name = os.path.relpath(source, base_url)
-        if name.endswith('.js'):
-            name = name[:-3]
-        base_name = os.path.basename(name)
-        out = os.path.join(os.path.dirname(source), '{}-built.js'.format(base_name))
-        cmd = args_to_str((
-            'r.js -o',
-            'mainConfigFile={main_config_file}',
-            'baseUrl={base_url}',
-            'name={name}',
-            'optimize={optimize}',
-            paths or '',
-            'out={out}',
-        ), format_kwargs=locals())
-        local(config, cmd, echo=echo, hide=hide)
+    """
+    if not node_worker:
+        yield None
+    elif active_pool() is not None:
+        yield active_pool()
+    else:
+        with NodeWorkerPool(config, jobs).activate() as pool:
+            yield pool
 
 
 _collectstatic_default_ignore = (
@@ -153,7 +422,29 @@ _collectstatic_default_ignore = (
 
 @command(default_env='dev')
 def collectstatic(config, static_root=None, default_ignore=True, ignore=(), exclude=(), include=(),
-                  echo=False, hide=None):
+                  incremental=True, link=False, manifest_file=None, echo=False, hide=None):
+    """Collect static files into STATIC_ROOT.
+
+    By default, static files are collected incrementally: only files
+    that are new or have changed since the last run are copied (or,
+    with ``--link``, hard linked), and stale files are removed (see
+    :mod:`arctasks.staticfiles`). The manifest of collected files is
+    stored in ``manifest_file`` (by default, next to STATIC_ROOT; e.g.,
+    "static.manifest.json").
+
+    Pass ``--link`` to hard link files into STATIC_ROOT instead of
+    copying them. Linked files share their contents with the source
+    files, so anything that modifies files in STATIC_ROOT in place
+    (e.g., a minifier or an editor that truncates and rewrites files)
+    will modify the source files (and any other builds they're linked
+    into) too.
+
+    Pass ``--no-incremental`` to clear STATIC_ROOT and collect all files
+    with Django's collectstatic command. That command is also used when
+    ``--include`` or ``--exclude`` is passed (these are passed through
+    to it) or when the static files storage isn't local.
+
+    """
     settings = get_settings(config)
     override_static_root = bool(static_root)
 
@@ -177,17 +468,43 @@ def collectstatic(config, static_root=None, default_ignore=True, ignore=(), excl
     if echo:
         print('Collecting static files into {0.STATIC_ROOT} ...'.format(settings))
 
-    args = {
-        'interactive': False,
-        'ignore': ignore,
-        'clear': True,
-        'hide': hide,
-    }
-
-    if include or exclude:
-        args.update(exclude=exclude, include=include)
-
-    call_command(config, 'collectstatic', **args)
+    if manifest_file:
+        manifest_file = manifest_file.format_map(config)
+    else:
+        manifest_file = '{0}.manifest.json'.format(settings.STATIC_ROOT.rstrip(os.sep))
+
+    collected = False
+
+    if incremental and not (include or exclude):
+        try:
+            collector = StaticFilesCollector(manifest_file, ignore, link=link)
+            stats = collector.collect()
+        except NotImplementedError as exc:
+            printer.warning(exc)
+        else:
+            collected = True
+            if not hide_stdout:
+                printer.info(
+                    'Collected {collected} static file(s) into {root}: {copied} copied, '
+                    '{removed} removed'.format(root=settings.STATIC_ROOT, **stats))
+
+    if not collected:
+        args = {
+            'interactive': False,
+            'ignore': ignore,
+            'clear': True,
+            'hide': hide,
+        }
+
+        if include or exclude:
+            args.update(exclude=exclude, include=include)
+
+        call_command(config, 'collectstatic', **args)
+
+        # The manifest doesn't include files collected by the command,
+        # so the next incremental run will need to start from scratch
+        if os.path.isfile(manifest_file):
+            os.remove(manifest_file)
 
     if override_static_root:
         settings.STATIC_ROOT = original_static_root
@@ -0,0 +1,229 @@
+"""Incremental collection of static files.
+
+Django's collectstatic command is run with ``clear=True`` so that files
+that have been removed from the project don't linger in STATIC_ROOT,
+but that means every file is copied on every run. A
+:class:`StaticFilesCollector` instead keeps a manifest of the files it
+collected in the previous run, along with the content hash of each
+file, and only copies (or hard links) files that are new or have
+changed and removes files that are no longer found.
+
+The storage's post-processing (e.g., adding hashes to file names and
+writing ``staticfiles.json`` for ``ManifestStaticFilesStorage``) is run
+on all files just as it is by collectstatic, so its output is always
+complete. Post-processed files that aren't produced again are removed.
+
+Only storages that keep files in the local file system are supported.
+
+"""
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+from .manifest import _remove_empty_dirs
+from .util import file_hash
+
+
+__all__ = [
+    'StaticFilesCollector',
+]
+
+
+# Django's default ignore patterns for collectstatic
+_django_default_ignore = ('CVS', '.*', '*~')
+
+
+class StaticFilesCollector:
+
+    """Collects static files into STATIC_ROOT incrementally.
+
+    Args:
+        manifest_file: JSON file the manifest of collected files is
+            stored in; this should be outside of STATIC_ROOT
+        ignore_patterns: Glob patterns of files and directories to
+            ignore (in addition to Django's defaults)
+        link (bool): Hard link files into STATIC_ROOT instead of copying
+            them (files are copied when linking isn't possible); note
+            that modifying a linked file in place modifies its source
+            too
+
+    Django must be set up before this is used.
+
+    """
+
+    def __init__(self, manifest_file, ignore_patterns=(), link=False):
+        from django.contrib.staticfiles.storage import staticfiles_storage
+        self.storage = staticfiles_storage
+        self.manifest_file = os.path.abspath(os.path.expanduser(manifest_file))
+        self.ignore_patterns = list(_django_default_ignore) + list(ignore_patterns)
+        self.link = link
+        try:
+            self.static_root = os.path.abspath(self.storage.path(''))
+        except NotImplementedError:
+            raise NotImplementedError(
+                'Static files storage does not use the local file system; '
+                'incremental collection is not supported')
+        self.files = {}
+        self.processed = []
+        self.loaded = self.load()
+
+    def load(self):
+        """Load the manifest of the previous collection.
+
+        Returns:
+            bool: Whether there was a manifest for STATIC_ROOT
+
+        """
+        try:
+            with open(self.manifest_file) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = {}
+        if data.get('static_root') != self.static_root:
+            return False
+        self.files = data.get('files', {})
+        self.processed = data.get('processed', [])
+        return True
+
+    def save(self):
+        data = {
+            'static_root': self.static_root,
+            'files': self.files,
+            'processed': self.processed,
+        }
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        temp_path = '{self.manifest_file}.tmp'.format_map(locals())
+        with open(temp_path, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_file)
+
+    def find(self):
+        """Find static files the same way collectstatic does.
+
+        Returns:
+            OrderedDict: Prefixed path => (source storage, path); when
+                multiple files have the same prefixed path, the first
+                one found is used
+
+        """
+        from django.contrib.staticfiles import finders
+        found = OrderedDict()
+        for finder in finders.get_finders():
+            for path, storage in finder.list(self.ignore_patterns):
+                prefix = getattr(storage, 'prefix', None)
+                prefixed_path = os.path.join(prefix, path) if prefix else path
+                if prefixed_path not in found:
+                    found[prefixed_path] = (storage, path)
+        return found
+
+    def collect(self):
+        """Collect static files into STATIC_ROOT.
+
+        If there's no manifest for STATIC_ROOT (e.g., on the first run),
+        STATIC_ROOT is cleared first, since there's no way to tell which
+        of the files in it are stale.
+
+        Returns:
+            dict: The number of files collected, copied (or linked), and
+                removed
+
+        """
+        found = self.find()
+        sources = OrderedDict()
+        for prefixed_path, (storage, path) in found.items():
+            try:
+                sources[prefixed_path] = storage.path(path)
+            except NotImplementedError:
+                raise NotImplementedError(
+                    'Static files in {storage!r} are not in the local file system; '
+                    'incremental collection is not supported'.format_map(locals()))
+
+        if not self.loaded:
+            self.clear()
+
+        files = {}
+        copied = []
+        for prefixed_path, source in sources.items():
+            destination = self.storage.path(prefixed_path)
+            entry = self.files.get(prefixed_path)
+            st = os.stat(source)
+            if entry and entry['source'] == source and (
+                    (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime)):
+                digest = entry['sha256']
+            else:
+                digest = file_hash(source)
+            if not (entry and entry['sha256'] == digest and self.is_current(destination, entry)):
+                self.install(source, destination)
+                copied.append(prefixed_path)
+            destination_st = os.stat(destination)
+            files[prefixed_path] = {
+                'source': source,
+                'sha256': digest,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'destination_size': destination_st.st_size,
+                'destination_mtime': destination_st.st_mtime,
+            }
+
+        removed = [path for path in sorted(set(self.files) - set(files)) if self.remove(path)]
+        self.files = files
+
+        processed = set()
+        if hasattr(self.storage, 'post_process'):
+            for original_path, processed_path, result in self.storage.post_process(found):
+                if isinstance(result, Exception):
+                    raise result
+                if processed_path and processed_path != original_path:
+                    processed.add(processed_path)
+        for path in sorted(set(self.processed) - processed - set(files)):
+            if self.remove(path):
+                removed.append(path)
+        self.processed = sorted(processed)
+
+        self.save()
+        return {'collected': len(files), 'copied': len(copied), 'removed': len(removed)}
+
+    def is_current(self, destination, entry):
+        """Is ``destination`` the same as when it was collected?"""
+        try:
+            st = os.stat(destination)
+        except FileNotFoundError:
+            return False
+        return (entry['destination_size'], entry['destination_mtime']) == (st.st_size, st.st_mtime)
+
+    def install(self, source, destination):
+        directory = os.path.dirname(destination)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, '.tmp-{}'.format(os.path.basename(destination)))
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        try:
+            if not self.link:
+                raise OSError
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copy2(source, temp_path)
+        os.replace(temp_path, destination)
+        # If destination was already a link to source, rename() is a
+        # no-op that leaves the temporary link in place
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+    def remove(self, path):
+        destination = self.storage.path(path)
+        if not os.path.isfile(destination):
+            return False
+        os.remove(destination)
+        _remove_empty_dirs(self.static_root, os.path.dirname(destination))
+        return True
+
+    def clear(self):
+        if not os.path.isdir(self.static_root):
+            return
+        for name in os.listdir(self.static_root):
+            path = os.path.join(self.static_root, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
@@ -0,0 +1,149 @@
+"""Run interdependent steps concurrently.
+
+Steps are declared as a mapping of step name => names of the steps it
+depends on::
+
+    steps = {
+        'a': (),
+        'b': ('a',),
+        'c': ('a',),
+        'd': ('b', 'c'),
+    }
+
+Here, ``b`` and ``c`` both depend on ``a`` but not on each other, so
+they'll be run concurrently once ``a`` has completed. ``d`` will be run
+once both ``b`` and ``c`` have completed.
+
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from runcommands.util import printer
+
+from .util import cpu_count
+
+
+__all__ = [
+    'run_steps',
+    'show_step_timings',
+]
+
+
+def run_steps(steps, run_step, jobs=0, on_complete=None):
+    """Run ``steps`` on a pool of worker threads.
+
+    Args:
+        steps (dict): Step name => names of steps it depends on
+        run_step (callable): Called with each step's name to run the
+            step
+        jobs (int): Max number of steps to run at once; 0 means use the
+            number of CPUs
+        on_complete (callable): Called with each step's name as soon as
+            the step completes successfully (in the calling thread, so
+            it should return quickly)
+
+    Returns:
+        list: ``(name, start_time, end_time)`` for each step, in order
+            of completion; times are from :func:`time.monotonic`
+
+    If a step fails, no new steps will be started, steps that are
+    already running will be allowed to finish, and then the failure
+    will be re-raised.
+
+    """
+    check_steps(steps)
+
+    jobs = jobs or cpu_count()
+    remaining = {name: set(dependencies) for (name, dependencies) in steps.items()}
+    running = {}
+    timings = []
+    failure = None
+
+    def run(name):
+        start_time = time.monotonic()
+        run_step(name)
+        return name, start_time, time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while remaining or running:
+            if failure is None:
+                # Steps are only submitted when a worker is free so that
+                # none are started after a failure
+                ready = [name for (name, dependencies) in remaining.items() if not dependencies]
+                for name in ready[:jobs - len(running)]:
+                    del remaining[name]
+                    running[executor.submit(run, name)] = name
+            elif not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = running.pop(future)
+                exc = future.exception()
+                if exc is not None:
+                    failure = failure or exc
+                    continue
+                timings.append(future.result())
+                for dependencies in remaining.values():
+                    dependencies.discard(name)
+                if on_complete is not None:
+                    on_complete(name)
+
+    if failure is not None:
+        raise failure
+
+    return timings
+
+
+def check_steps(steps):
+    """Ensure all dependencies exist and there are no cycles."""
+    for name, dependencies in steps.items():
+        for dependency in dependencies:
+            if dependency not in steps:
+                raise ValueError(
+                    'Step {name} depends on unknown step {dependency}'.format_map(locals()))
+
+    visited = set()
+
+    def visit(name, path):
+        if name in path:
+            cycle = ' => '.join(path[path.index(name):] + (name,))
+            raise ValueError('Steps contain a cycle: {cycle}'.format_map(locals()))
+        if name not in visited:
+            for dependency in steps[name]:
+                visit(dependency, path + (name,))
+            visited.add(name)
+
+    for name in steps:
+        visit(name, ())
+
+
+def show_step_timings(timings, title='Step timings:'):
+    """Show how long each step took and how much running steps
+    concurrently saved compared to running them one after another.
+
+    Args:
+        timings: As returned by :func:`run_steps`
+
+    """
+    if not timings:
+        return
+
+    first_start = min(start for (_, start, _) in timings)
+    last_end = max(end for (_, _, end) in timings)
+    wall_time = last_end - first_start
+    serial_time = sum(end - start for (_, start, end) in timings)
+    saved = serial_time - wall_time
+    longest = max(len(name) for (name, _, _) in timings)
+
+    printer.header(title)
+    for name, start, end in sorted(timings, key=lambda item: item[1]):
+        offset = start - first_start
+        elapsed = end - start
+        print(
+            '{name:<{longest}} {elapsed:>8.3f}s (started at +{offset:.3f}s)'
+            .format_map(locals()))
+    printer.info(
+        'Serial: {serial_time:.3f}s; wall: {wall_time:.3f}s; saved: {saved:.3f}s'
+        .format_map(locals()))
@@ -0,0 +1,307 @@
+"""Deployment tracing.
+
+While a :class:`Tracer` is active, each deployment step and each local
+command, remote command, and file transfer run during the deployment
+is recorded as a span with its start and end times, its exit status,
+and, for transfers, the number of bytes sent.
+
+Modules that run commands during deployments use the traced
+:func:`local` and :func:`remote` commands defined here instead of
+importing them from ``runcommands.commands``.
+
+Traces can be written in the Chrome trace event format (which can be
+viewed at chrome://tracing or https://ui.perfetto.dev) and are added to
+a local SQLite database (see :class:`TraceHistory`) so deployments can
+be compared over time (see the ``deploy_stats`` command).
+
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from runcommands.commands import local as _local, remote as _remote
+from runcommands.util import args_to_str
+
+
+__all__ = [
+    'TraceHistory',
+    'Tracer',
+    'local',
+    'remote',
+    'span',
+    'traced',
+]
+
+
+# The active tracer (see Tracer.activate)
+_current = None
+
+
+class Tracer:
+
+    """Records spans.
+
+    Spans may be recorded from any thread.
+
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.start_time = time.monotonic()
+        self.spans = []
+        self.thread_ids = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Make this the active tracer for the ``with`` block.
+
+        Calls to :func:`traced` functions are recorded in the active
+        tracer.
+
+        """
+        global _current
+        previous, _current = _current, self
+        try:
+            yield self
+        finally:
+            _current = previous
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Record a span for the ``with`` block.
+
+        The yielded dict contains ``args``; more args can be added to it
+        (e.g., the number of bytes transferred). Its ``status`` will be
+        set to 0 if the block completes normally or to the exit code
+        (or 1) if it raises an exception, unless it's set in the block.
+
+        """
+        info = dict(args)
+        start = time.monotonic()
+        status = 0
+        try:
+            yield info
+        except SystemExit as exc:
+            status = exc.code if isinstance(exc.code, int) else 1
+            raise
+        except BaseException:
+            status = 1
+            raise
+        finally:
+            info.setdefault('status', status)
+            self.add(name, category, start, time.monotonic(), info)
+
+    def add(self, name, category, start, end, args):
+        with self.lock:
+            thread = self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids) + 1)
+            self.spans.append({
+                'name': name,
+                'category': category,
+                'start': start - self.start_time,
+                'duration': end - start,
+                'thread': thread,
+                'args': args,
+            })
+
+    def get_spans(self, category=None):
+        with self.lock:
+            spans = list(self.spans)
+        if category is not None:
+            spans = [span for span in spans if span['category'] == category]
+        return sorted(spans, key=lambda span: span['start'])
+
+    def to_chrome_trace(self):
+        events = [{
+            'name': span['name'],
+            'cat': span['category'],
+            'ph': 'X',
+            'ts': span['start'] * 1e6,
+            'dur': span['duration'] * 1e6,
+            'pid': 1,
+            'tid': span['thread'],
+            'args': span['args'],
+        } for span in self.get_spans()]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            json.dump(self.to_chrome_trace(), fp, default=str)
+
+
+@contextmanager
+def span(name, category, **args):
+    """Record a span in the active tracer for the ``with`` block.
+
+    When no tracer is active, nothing is recorded. See
+    :meth:`Tracer.span`.
+
+    """
+    tracer = _current
+    if tracer is None:
+        yield dict(args)
+    else:
+        with tracer.span(name, category, **args) as info:
+            yield info
+
+
+def traced(func, category, host=False, get_bytes=None):
+    """Wrap ``func`` so calls to it are recorded in the active tracer.
+
+    ``func`` must be called with a config object as its first arg (like
+    a command). The span will include a description of the call (i.e.,
+    its first couple of args) and, if ``host`` is set, the remote host
+    from the config.
+
+    Args:
+        get_bytes (callable): Called with the config, args, keyword
+            args, and result of each call to get the number of bytes
+            transferred (or ``None`` if unknown)
+
+    When no tracer is active, ``func`` is called directly.
+
+    """
+    def wrapper(config, *args, **kwargs):
+        tracer = _current
+        if tracer is None:
+            return func(config, *args, **kwargs)
+        description = describe_call(args)
+        span_args = {'command': description}
+        if host:
+            span_args['host'] = kwargs.get('host') or config._get_dotted('remote.host', None)
+        name = '{category}: {description:.60}'.format_map(locals()) if description else category
+        with tracer.span(name, category, **span_args) as info:
+            result = func(config, *args, **kwargs)
+            return_code = getattr(result, 'return_code', None)
+            if return_code is not None:
+                info['status'] = return_code
+            if get_bytes is not None:
+                info['bytes'] = get_bytes(config, args, kwargs, result)
+        return result
+
+    wrapper.__name__ = getattr(func, '__name__', category)
+    wrapper.__doc__ = getattr(func, '__doc__', None)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def describe_call(args):
+    parts = [args_to_str(arg) for arg in args[:2] if isinstance(arg, (str, list, tuple))]
+    return ' '.join(parts)
+
+
+local = traced(_local, 'local')
+remote = traced(_remote, 'remote', host=True)
+
+
+class TraceHistory:
+
+    """SQLite database of traces of past deployments.
+
+    Args:
+        path: Database file; will be created if necessary
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS deploys (
+            id INTEGER PRIMARY KEY,
+            project TEXT NOT NULL,
+            env TEXT NOT NULL,
+            version TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            status INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS deploys_project_env ON deploys (project, env, started);
+        CREATE TABLE IF NOT EXISTS spans (
+            deploy_id INTEGER NOT NULL REFERENCES deploys (id),
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            host TEXT,
+            start REAL NOT NULL,
+            duration REAL NOT NULL,
+            status INTEGER,
+            bytes INTEGER,
+            args TEXT
+        );
+        CREATE INDEX IF NOT EXISTS spans_deploy_id ON spans (deploy_id);
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.executescript(self.schema)
+        return connection
+
+    def add(self, tracer, project, env, version, duration, status):
+        """Add the spans recorded by ``tracer`` for a deployment."""
+        connection = self.connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    'INSERT INTO deploys (project, env, version, started, duration, status) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (project, env, version, tracer.started, duration, status))
+                deploy_id = cursor.lastrowid
+                connection.executemany(
+                    'INSERT INTO spans '
+                    '(deploy_id, name, category, host, start, duration, status, bytes, args) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(
+                        deploy_id,
+                        span['name'],
+                        span['category'],
+                        span['args'].get('host'),
+                        span['start'],
+                        span['duration'],
+                        span['args'].get('status'),
+                        span['args'].get('bytes'),
+                        json.dumps(span['args'], default=str),
+                    ) for span in tracer.get_spans()])
+        finally:
+            connection.close()
+
+    def deploys(self, project, env, limit=10):
+        """Get the most recent deployments of ``project`` to ``env``.
+
+        Pass a negative ``limit`` to get all deployments.
+
+        Returns:
+            list: Deployments, oldest first; each is a dict with the
+                deployment's version, start time, duration, status, and
+                step durations (step name => seconds); when a step was
+                run on multiple hosts, its duration on the slowest host
+                is used
+
+        """
+        connection = self.connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            rows = connection.execute(
+                'SELECT id, version, started, duration, status FROM deploys '
+                'WHERE project = ? AND env = ? ORDER BY started DESC LIMIT ?',
+                (project, env, limit)).fetchall()
+            deploys = []
+            for row in reversed(rows):
+                steps = connection.execute(
+                    'SELECT name, MAX(duration) AS duration, MIN(start) AS start FROM spans '
+                    'WHERE deploy_id = ? AND category = ? GROUP BY name ORDER BY start',
+                    (row['id'], 'step')).fetchall()
+                deploys.append({
+                    'version': row['version'],
+                    'started': row['started'],
+                    'duration': row['duration'],
+                    'status': row['status'],
+                    'steps': [(step['name'], step['duration']) for step in steps],
+                })
+            return deploys
+        finally:
+            connection.close()
@@ -1,3 +1,7 @@
+import hashlib
+import multiprocessing
+import tarfile
+import zipfile
 from glob import glob
 
 from runcommands.util import abort, abs_path
@@ -7,8 +11,54 @@ def flatten_globs(config, sources, check_exists=True):
     flattened_sources = []
     for source in sources:
         source = abs_path(source, format_kwargs=config)
-        paths = glob(source)
+        paths = sorted(glob(source))
         if not paths and check_exists:
             abort(1, 'No sources found for "{source}"'.format(source=source))
         flattened_sources.extend(paths)
     return flattened_sources
+
+
+def cpu_count():
+    """Get the number of CPUs (1 if it can't be determined)."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def file_hash(path, algorithm='sha256', chunk_size=2 ** 16):
+    """Get hex digest of the contents of the file at ``path``."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sdist_hash(path, algorithm='sha256'):
+    """Get hex digest of the contents of the sdist at ``path``.
+
+    Only the names and contents of the files in the sdist are hashed.
+    Timestamps are ignored, so rebuilding an sdist from the same source
+    produces the same hash (which isn't the case when hashing the sdist
+    file itself).
+
+    Files that aren't tarballs or zip files are hashed as is.
+
+    """
+    digest = hashlib.new(algorithm)
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as tarball:
+            members = sorted((m for m in tarball.getmembers() if m.isfile()), key=lambda m: m.name)
+            for member in members:
+                digest.update(member.name.encode('utf-8'))
+                digest.update(tarball.extractfile(member).read())
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zip_file:
+            for name in sorted(zip_file.namelist()):
+                if not name.endswith('/'):
+                    digest.update(name.encode('utf-8'))
+                    digest.update(zip_file.read(name))
+    else:
+        return file_hash(path, algorithm)
+    return digest.hexdigest()
@@ -24,6 +24,7 @@ setup(
     package_data={
         'arctasks': [
             'commands.cfg',
+            'node_worker.js',
             'rsync.excludes',
             'templates/*.template',
         ],
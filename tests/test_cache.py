@@ -0,0 +1,185 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+from urllib.error import HTTPError, URLError
+
+from arctasks.cache import ArtifactCache, BuildCache
+
+
+class FakeResponse(io.BytesIO):
+
+    def __init__(self, data, headers=None):
+        super().__init__(data)
+        self.headers = headers or {}
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    url = 'https://example.com/artifact.tar.gz'
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = temp_dir.name
+        self.cache = ArtifactCache(self.root)
+        self.requests = []
+        self.responses = []
+        patcher = mock.patch('arctasks.cache.urlopen', self.urlopen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name, kwargs in (('printer', {}), ('abort', {'side_effect': SystemExit})):
+            patcher = mock.patch('arctasks.cache.{name}'.format(name=name), **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def urlopen(self, request):
+        self.requests.append(request)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def not_modified(self):
+        return HTTPError(self.url, 304, 'Not Modified', {}, None)
+
+    def read(self, path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def test_fetch(self):
+        self.responses.append(FakeResponse(b'data', {'ETag': '"1"'}))
+        path = self.cache.fetch(self.url)
+        self.assertEqual(self.read(path), b'data')
+        self.assertEqual(len(self.requests), 1)
+        self.assertIsNone(self.requests[0].get_header('If-none-match'))
+
+    def test_revalidate_with_etag(self):
+        self.responses.append(FakeResponse(
+            b'data', {'ETag': '"1"', 'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'}))
+        path = self.cache.fetch(self.url)
+        self.responses.append(self.not_modified())
+        self.assertEqual(self.cache.fetch(self.url), path)
+        request = self.requests[-1]
+        self.assertEqual(request.get_header('If-none-match'), '"1"')
+        self.assertEqual(
+            request.get_header('If-modified-since'), 'Mon, 01 Jan 2018 00:00:00 GMT')
+        self.assertEqual(self.read(path), b'data')
+
+    def test_modified(self):
+        self.responses.append(FakeResponse(b'data', {'ETag': '"1"'}))
+        path = self.cache.fetch(self.url)
+        self.responses.append(FakeResponse(b'new data', {'ETag': '"2"'}))
+        self.assertEqual(self.cache.fetch(self.url), path)
+        self.assertEqual(self.read(path), b'new data')
+
+    def test_checksum_match_skips_revalidation(self):
+        checksum = hashlib.sha256(b'data').hexdigest()
+        self.responses.append(FakeResponse(b'data'))
+        path = self.cache.fetch(self.url, checksum=checksum)
+        self.assertEqual(self.cache.fetch(self.url, checksum=checksum), path)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_checksum_mismatch(self):
+        self.responses.append(FakeResponse(b'data'))
+        with self.assertRaises(SystemExit):
+            self.cache.fetch(self.url, checksum='0' * 64)
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_corrupt_artifact_is_refetched(self):
+        self.responses.append(FakeResponse(b'data', {'ETag': '"1"'}))
+        path = self.cache.fetch(self.url)
+        with open(path, 'wb') as fp:
+            fp.write(b'corrupt')
+        self.responses.append(FakeResponse(b'data', {'ETag': '"1"'}))
+        self.cache.fetch(self.url)
+        self.assertIsNone(self.requests[-1].get_header('If-none-match'))
+        self.assertEqual(self.read(path), b'data')
+
+    def test_unreachable(self):
+        self.responses.append(FakeResponse(b'data'))
+        path = self.cache.fetch(self.url)
+        self.responses.append(URLError('unreachable'))
+        self.assertEqual(self.cache.fetch(self.url), path)
+        self.responses.append(URLError('unreachable'))
+        with self.assertRaises(SystemExit):
+            self.cache.fetch('https://example.com/other.tar.gz')
+
+    def test_offline(self):
+        self.responses.append(FakeResponse(b'data'))
+        path = self.cache.fetch(self.url)
+        cache = ArtifactCache(self.root, offline=True)
+        self.assertEqual(cache.fetch(self.url), path)
+        self.assertEqual(len(self.requests), 1)
+        with self.assertRaises(SystemExit):
+            cache.fetch('https://example.com/other.tar.gz')
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_size = 10
+        urls = ['https://example.com/{0}'.format(i) for i in range(3)]
+        paths = []
+        for url in urls:
+            self.responses.append(FakeResponse(b'12345'))
+            paths.append(self.cache.fetch(url))
+        # Only two artifacts fit; the first one was used least recently
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(paths[2]))
+
+        # Using the second artifact makes the third the least recent
+        self.responses.append(self.not_modified())
+        self.cache.fetch(urls[1])
+        self.responses.append(FakeResponse(b'12345'))
+        self.cache.fetch(urls[0])
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[2]))
+
+
+class FakeCodec:
+
+    name = 'fake'
+    extension = 'tar'
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache = BuildCache(temp_dir.name, max_entries=2)
+        self.codec = FakeCodec()
+
+    def put(self, key, data=b'archive', failed=False):
+        def write(out_file):
+            out_file.write(data)
+            return failed
+        return self.cache.put(key, self.codec, write)
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('a', self.codec))
+        path = self.put('a')
+        self.assertEqual(self.cache.get('a', self.codec), path)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'archive')
+
+    def test_failed_write(self):
+        self.assertIsNone(self.put('a', failed=True))
+        self.assertIsNone(self.cache.get('a', self.codec))
+        self.assertEqual(os.listdir(self.cache.root), [])
+
+    def test_evict(self):
+        path_a = self.put('a')
+        os.utime(path_a, (1, 1))
+        path_b = self.put('b')
+        os.utime(path_b, (2, 2))
+        self.put('c')
+        self.assertIsNone(self.cache.get('a', self.codec))
+        self.assertIsNotNone(self.cache.get('b', self.codec))
+        self.assertIsNotNone(self.cache.get('c', self.codec))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import tempfile
+import unittest
+
+from arctasks.cssdeps import CSSBuildCache, find_imports, resolve_import
+
+
+class Base(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = self.temp_dir.name
+
+    def write(self, name, contents=''):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(contents)
+        return path
+
+
+class TestFindImports(unittest.TestCase):
+
+    def test_imports(self):
+        contents = (
+            '@import "a";\n'
+            "@import 'b.less';\n"
+            '@import url("c.css");\n'
+            '@use "d";\n'
+            '@forward "e";\n'
+            '@import "f", "g";\n'
+        )
+        self.assertEqual(find_imports(contents), ['a', 'b.less', 'c.css', 'd', 'e', 'f', 'g'])
+
+    def test_comments(self):
+        contents = (
+            '/* @import "a"; */\n'
+            '/*\n'
+            '@import "b";\n'
+            '*/\n'
+            '// @import "c";\n'
+            '@import "d"; // @import "e";\n'
+            '.x { background: url(//example.com/x.png); }\n'
+        )
+        self.assertEqual(find_imports(contents), ['d'])
+
+    def test_less_import_options(self):
+        contents = (
+            '@import (reference) "a";\n'
+            '@import (css, optional) "b";\n'
+        )
+        self.assertEqual(find_imports(contents), ['a', 'b'])
+
+    def test_interpolated_names(self):
+        contents = (
+            '@import "@{theme}/a";\n'
+            '@import "#{$theme}/b";\n'
+        )
+        self.assertEqual(find_imports(contents), ['@{theme}/a', '#{$theme}/b'])
+
+
+class TestResolveImport(Base):
+
+    def test_less(self):
+        path = self.write('styles/a.less')
+        directory = os.path.join(self.root, 'styles')
+        self.assertEqual(resolve_import('a', directory, 'less'), path)
+        self.assertEqual(resolve_import('a.less', directory, 'less'), path)
+        self.assertIsNone(resolve_import('b', directory, 'less'))
+
+    def test_partial(self):
+        path = self.write('styles/_a.scss')
+        directory = os.path.join(self.root, 'styles')
+        self.assertEqual(resolve_import('a', directory, 'scss'), path)
+        self.assertEqual(resolve_import('a.scss', directory, 'scss'), path)
+
+    def test_index(self):
+        path = self.write('styles/a/_index.scss')
+        directory = os.path.join(self.root, 'styles')
+        self.assertEqual(resolve_import('a', directory, 'scss'), path)
+
+    def test_include_paths(self):
+        path = self.write('lib/_a.scss')
+        directory = os.path.join(self.root, 'styles')
+        include_path = os.path.join(self.root, 'lib')
+        self.assertIsNone(resolve_import('a', directory, 'scss'))
+        self.assertEqual(resolve_import('a', directory, 'scss', [include_path]), path)
+
+    def test_node_modules(self):
+        path = self.write('node_modules/pkg/a.less')
+        directory = os.path.join(self.root, 'app', 'styles')
+        self.assertEqual(resolve_import('~pkg/a', directory, 'less'), path)
+        self.assertIsNone(resolve_import('pkg/a', directory, 'less'))
+
+    def test_interpolated_names(self):
+        self.write('styles/dark/a.less')
+        directory = os.path.join(self.root, 'styles')
+        self.assertIsNone(resolve_import('@{theme}/a', directory, 'less'))
+        self.assertIsNone(resolve_import('#{$theme}/a', directory, 'scss'))
+
+
+class TestCSSBuildCache(Base):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = CSSBuildCache(os.path.join(self.root, 'cache.json'))
+        self.source = self.write('main.scss', '@import "partial";\n')
+        self.partial = self.write('_partial.scss', '$x: 1;\n')
+        self.destination = os.path.join(self.root, 'main.css')
+
+    def compile(self, fingerprint):
+        with open(self.destination, 'w') as fp:
+            fp.write('compiled')
+        self.cache.update(self.source, self.destination, fingerprint)
+
+    def fingerprint(self, options=None):
+        return self.cache.fingerprint(self.source, 'scss', options or {})
+
+    def test_is_current(self):
+        fingerprint = self.fingerprint()
+        self.assertFalse(self.cache.is_current(self.source, self.destination, fingerprint))
+        self.compile(fingerprint)
+        self.assertTrue(self.cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_saved(self):
+        fingerprint = self.fingerprint()
+        self.compile(fingerprint)
+        self.cache.save()
+        cache = CSSBuildCache(self.cache.path)
+        self.assertEqual(cache.fingerprint(self.source, 'scss', {}), fingerprint)
+        self.assertTrue(cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_import_changed(self):
+        self.compile(self.fingerprint())
+        self.write('_partial.scss', '$x: 10;\n')
+        fingerprint = self.fingerprint()
+        self.assertFalse(self.cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_options_changed(self):
+        self.compile(self.fingerprint())
+        fingerprint = self.fingerprint({'optimize': True})
+        self.assertFalse(self.cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_output_modified(self):
+        fingerprint = self.fingerprint()
+        self.compile(fingerprint)
+        with open(self.destination, 'w') as fp:
+            fp.write('modified')
+        self.assertFalse(self.cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_output_missing(self):
+        fingerprint = self.fingerprint()
+        self.compile(fingerprint)
+        os.remove(self.destination)
+        self.assertFalse(self.cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_unresolved_import(self):
+        self.write('main.scss', '@import "#{$theme}/colors";\n')
+        fingerprint = self.fingerprint()
+        self.assertIsNone(fingerprint)
+        self.compile(fingerprint)
+        self.assertFalse(self.cache.is_current(self.source, self.destination, fingerprint))
+
+    def test_external_import(self):
+        self.write('main.scss', '@import url(https://example.com/a.css);\n')
+        self.assertIsNotNone(self.fingerprint())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+
+from arctasks.manifest import BuildManifest
+
+
+class TestBuildManifest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.root = os.path.join(self.temp_dir, 'build')
+        self.path = os.path.join(self.temp_dir, 'build.manifest.json')
+        self.manifest = BuildManifest(self.root, self.path)
+
+    def build_path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def read(self, path):
+        with open(path) as fp:
+            return fp.read()
+
+    def reload(self):
+        self.manifest.save()
+        self.manifest = BuildManifest(self.root, self.path)
+
+    def test_write(self):
+        outputs = self.manifest.step('a')
+        path = self.build_path('dir', 'file')
+        self.assertTrue(outputs.write(path, 'contents'))
+        self.assertEqual(self.read(path), 'contents')
+        self.assertFalse(outputs.write(path, 'contents'))
+        self.assertTrue(outputs.write(path, 'new contents'))
+        self.assertEqual(self.read(path), 'new contents')
+
+    def test_copy(self):
+        source = os.path.join(self.temp_dir, 'source')
+        with open(source, 'w') as fp:
+            fp.write('contents')
+        os.chmod(source, 0o640)
+        outputs = self.manifest.step('a')
+        path = self.build_path('file')
+        self.assertTrue(outputs.copy(source, path))
+        self.assertEqual(self.read(path), 'contents')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.reload()
+        self.assertFalse(self.manifest.step('a').copy(source, path))
+
+    def test_modified_output_is_rewritten(self):
+        path = self.build_path('file')
+        self.manifest.step('a').write(path, 'contents')
+        self.reload()
+        with open(path, 'w') as fp:
+            fp.write('modified contents')
+        self.assertTrue(self.manifest.step('a').write(path, 'contents'))
+        self.assertEqual(self.read(path), 'contents')
+
+    def test_outside_root(self):
+        with self.assertRaises(ValueError):
+            self.manifest.step('a').write(os.path.join(self.temp_dir, 'file'), 'contents')
+
+    def test_gc(self):
+        outputs = self.manifest.step('a')
+        keep = self.build_path('keep')
+        stale = self.build_path('dir', 'stale')
+        outputs.write(keep, 'keep')
+        outputs.write(stale, 'stale')
+        unmanaged = self.build_path('unmanaged')
+        with open(unmanaged, 'w') as fp:
+            fp.write('unmanaged')
+        self.reload()
+
+        self.manifest.step('a').write(keep, 'keep')
+        self.assertEqual(self.manifest.gc(), [os.path.join('dir', 'stale')])
+        self.assertTrue(os.path.isfile(keep))
+        self.assertFalse(os.path.exists(stale))
+        self.assertFalse(os.path.exists(self.build_path('dir')))
+        self.assertTrue(os.path.isfile(unmanaged))
+
+    def test_gc_trees(self):
+        tree = self.build_path('tree')
+        os.makedirs(tree)
+        with open(os.path.join(tree, 'file'), 'w') as fp:
+            fp.write('contents')
+        self.assertFalse(self.manifest.step('a').tree(tree, key='1'))
+        self.reload()
+
+        self.assertTrue(self.manifest.step('a').tree(tree, key='1'))
+        self.assertEqual(self.manifest.gc(), [])
+        self.reload()
+
+        self.assertFalse(self.manifest.step('a').tree(tree, key='2'))
+        self.reload()
+
+        self.assertEqual(self.manifest.gc(), ['tree'])
+        self.assertEqual(os.listdir(tree), [])
+
+    def test_claim_step(self):
+        outputs = self.manifest.step('a')
+        path_a = self.build_path('a')
+        path_b = self.build_path('b')
+        outputs.write(path_a, 'a')
+        self.manifest.step('b').write(path_b, 'b')
+        self.reload()
+
+        self.manifest.claim_step('a')
+        self.assertEqual(self.manifest.outputs('a'), ['a'])
+        self.assertEqual(self.manifest.outputs('b'), [])
+        self.assertEqual(self.manifest.gc(), ['b'])
+        self.assertTrue(os.path.isfile(path_a))
+        self.assertFalse(os.path.exists(path_b))
+
+    def test_reset(self):
+        self.manifest.step('a').write(self.build_path('file'), 'contents')
+        self.manifest.save()
+        self.manifest.reset()
+        self.assertFalse(self.manifest.exists())
+        self.assertEqual(self.manifest.files, {})
+        self.assertEqual(self.manifest.gc(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import unittest
+
+from arctasks.state import DeployState
+
+
+class TestDeployState(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'build', 'state.json')
+
+    def test_mark_done(self):
+        state = DeployState(self.path)
+        self.assertFalse(state.is_done('local', 'a', 'hash'))
+        state.mark_done('local', 'a', 'hash')
+        self.assertTrue(state.is_done('local', 'a', 'hash'))
+        self.assertFalse(state.is_done('local', 'a', 'other-hash'))
+        self.assertFalse(state.is_done('host', 'a', 'hash'))
+
+    def test_no_input_hash(self):
+        state = DeployState(self.path)
+        state.mark_done('local', 'a', None)
+        self.assertFalse(state.is_done('local', 'a', None))
+
+    def test_saved(self):
+        state = DeployState(self.path)
+        state.mark_done('local', 'a', 'hash')
+        state.mark_done('host', 'b', 'hash')
+        with open(self.path) as fp:
+            self.assertEqual(json.load(fp), {'local': {'a': 'hash'}, 'host': {'b': 'hash'}})
+        state = DeployState.load(self.path)
+        self.assertTrue(state.is_done('local', 'a', 'hash'))
+        self.assertTrue(state.is_done('host', 'b', 'hash'))
+
+    def test_load_missing(self):
+        state = DeployState.load(self.path)
+        self.assertEqual(state.data, {})
+
+    def test_load_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as fp:
+            fp.write('{')
+        state = DeployState.load(self.path)
+        self.assertEqual(state.data, {})
+
+    def test_set_scope(self):
+        state = DeployState(self.path)
+        state.mark_done('host', 'a', 'hash')
+        state.mark_done('local', 'b', 'hash')
+        state.set_scope('host', {'c': 'hash'})
+        self.assertEqual(state.get_scope('host'), {'c': 'hash'})
+        self.assertFalse(state.is_done('host', 'a', 'hash'))
+        self.assertTrue(state.is_done('local', 'b', 'hash'))
+        self.assertEqual(DeployState.load(self.path).get_scope('host'), {'c': 'hash'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import tempfile
+import unittest
+
+try:
+    import django
+except ImportError:
+    django = None
+else:
+    from django.test.utils import override_settings
+
+from arctasks.staticfiles import StaticFilesCollector
+
+
+def setUpModule():
+    if django is None:
+        return
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            INSTALLED_APPS=['django.contrib.staticfiles'],
+            STATIC_URL='/static/',
+        )
+        django.setup()
+
+
+class Base(unittest.TestCase):
+
+    storage = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = temp_dir.name
+        self.source_dir = os.path.join(self.root, 'source')
+        self.static_root = os.path.join(self.root, 'static')
+        self.manifest_file = os.path.join(self.root, 'static.manifest.json')
+        os.makedirs(self.source_dir)
+        settings_override = override_settings(
+            STATIC_ROOT=self.static_root,
+            STATICFILES_DIRS=[self.source_dir],
+            STATICFILES_STORAGE=self.storage,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, directory, name, contents):
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(contents)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.static_root, name)) as fp:
+            return fp.read()
+
+    def collect(self, **kwargs):
+        return StaticFilesCollector(self.manifest_file, **kwargs).collect()
+
+
+@unittest.skipIf(django is None, 'Django is not installed')
+class TestStaticFilesCollector(Base):
+
+    def test_collect(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.write(self.source_dir, 'js/b.js', 'b')
+        self.write(self.source_dir, '.hidden', 'hidden')
+        stats = self.collect()
+        self.assertEqual(stats, {'collected': 2, 'copied': 2, 'removed': 0})
+        self.assertEqual(self.read('a.css'), 'a')
+        self.assertEqual(self.read(os.path.join('js', 'b.js')), 'b')
+        self.assertFalse(os.path.exists(os.path.join(self.static_root, '.hidden')))
+
+    def test_incremental(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.write(self.source_dir, 'b.css', 'b')
+        self.collect()
+        self.write(self.source_dir, 'b.css', 'bb')
+        self.write(self.source_dir, 'c.css', 'c')
+        stats = self.collect()
+        self.assertEqual(stats, {'collected': 3, 'copied': 2, 'removed': 0})
+        self.assertEqual(self.read('b.css'), 'bb')
+        self.assertEqual(self.read('c.css'), 'c')
+
+    def test_unchanged(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        stats = self.collect()
+        self.assertEqual(stats, {'collected': 1, 'copied': 0, 'removed': 0})
+
+    def test_removed(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        path = self.write(self.source_dir, 'dir/b.css', 'b')
+        self.collect()
+        os.remove(path)
+        stats = self.collect()
+        self.assertEqual(stats, {'collected': 1, 'copied': 0, 'removed': 1})
+        self.assertFalse(os.path.exists(os.path.join(self.static_root, 'dir')))
+
+    def test_modified_destination(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        self.write(self.static_root, 'a.css', 'modified')
+        stats = self.collect()
+        self.assertEqual(stats['copied'], 1)
+        self.assertEqual(self.read('a.css'), 'a')
+
+    def test_first_run_clears_static_root(self):
+        self.write(self.static_root, 'stale.css', 'stale')
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        self.assertEqual(os.listdir(self.static_root), ['a.css'])
+
+    def test_unmanaged_files_kept(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        self.write(self.static_root, 'other.css', 'other')
+        self.collect()
+        self.assertEqual(self.read('other.css'), 'other')
+
+    def test_copy_by_default(self):
+        source = self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        destination = os.path.join(self.static_root, 'a.css')
+        self.assertFalse(os.path.samefile(source, destination))
+
+    def test_link(self):
+        source = self.write(self.source_dir, 'a.css', 'a')
+        self.collect(link=True)
+        destination = os.path.join(self.static_root, 'a.css')
+        self.assertTrue(os.path.samefile(source, destination))
+        # Relinking a file that's already linked leaves no temp file
+        os.utime(source)
+        self.write(self.static_root, 'a.css', 'aa')
+        self.collect(link=True)
+        self.assertEqual(os.listdir(self.static_root), ['a.css'])
+
+    def test_ignore_patterns(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.write(self.source_dir, 'a.less', 'a')
+        stats = self.collect(ignore_patterns=['*.less'])
+        self.assertEqual(stats['collected'], 1)
+
+
+@unittest.skipIf(django is None, 'Django is not installed')
+class TestStaticFilesCollectorManifestStorage(Base):
+
+    storage = 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
+
+    def test_collect(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        names = sorted(os.listdir(self.static_root))
+        self.assertEqual(len(names), 3)
+        self.assertIn('a.css', names)
+        self.assertIn('staticfiles.json', names)
+
+    def test_processed_files_removed(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        self.write(self.source_dir, 'a.css', 'aa')
+        stats = self.collect()
+        self.assertEqual(stats, {'collected': 1, 'copied': 1, 'removed': 1})
+        names = [name for name in os.listdir(self.static_root) if name.startswith('a.')]
+        self.assertEqual(len(names), 2)
+
+    def test_unchanged(self):
+        self.write(self.source_dir, 'a.css', 'a')
+        self.collect()
+        names = sorted(os.listdir(self.static_root))
+        stats = self.collect()
+        self.assertEqual(stats, {'collected': 1, 'copied': 0, 'removed': 0})
+        self.assertEqual(sorted(os.listdir(self.static_root)), names)
+
+
+if __name__ == '__main__':
+    unittest.main()
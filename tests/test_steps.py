@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+
+from arctasks.steps import check_steps, run_steps
+
+
+class TestRunSteps(unittest.TestCase):
+
+    def test_order(self):
+        steps = {
+            'a': (),
+            'b': ('a',),
+            'c': ('a',),
+            'd': ('b', 'c'),
+        }
+        completed = []
+        lock = threading.Lock()
+
+        def run_step(name):
+            with lock:
+                for dependency in steps[name]:
+                    self.assertIn(dependency, completed)
+                completed.append(name)
+
+        timings = run_steps(steps, run_step, jobs=4)
+        self.assertEqual(sorted(completed), ['a', 'b', 'c', 'd'])
+        self.assertEqual(completed[0], 'a')
+        self.assertEqual(completed[-1], 'd')
+        self.assertEqual(sorted(name for (name, _, _) in timings), sorted(completed))
+        for _, start, end in timings:
+            self.assertLessEqual(start, end)
+
+    def test_concurrent(self):
+        steps = {'a': (), 'b': ()}
+        barrier = threading.Barrier(2, timeout=5)
+        run_steps(steps, lambda name: barrier.wait(), jobs=2)
+
+    def test_on_complete(self):
+        steps = {'a': (), 'b': ('a',)}
+        completed = []
+        run_steps(steps, lambda name: None, jobs=2, on_complete=completed.append)
+        self.assertEqual(completed, ['a', 'b'])
+
+    def test_failure(self):
+        steps = {
+            'a': (),
+            'b': (),
+            'c': ('a',),
+        }
+        started = []
+        b_started = threading.Event()
+
+        def run_step(name):
+            started.append(name)
+            if name == 'a':
+                b_started.wait(5)
+                raise RuntimeError('a failed')
+            if name == 'b':
+                b_started.set()
+                time.sleep(0.05)
+
+        with self.assertRaisesRegex(RuntimeError, 'a failed'):
+            run_steps(steps, run_step, jobs=2)
+        # b was already running, so it was allowed to finish, but c
+        # depends on a, so it wasn't started
+        self.assertEqual(sorted(started), ['a', 'b'])
+
+    def test_failure_stops_new_steps(self):
+        steps = {
+            'a': (),
+            'b': (),
+        }
+        started = []
+
+        def run_step(name):
+            started.append(name)
+            raise RuntimeError(name)
+
+        with self.assertRaises(RuntimeError):
+            run_steps(steps, run_step, jobs=1)
+        self.assertEqual(len(started), 1)
+
+
+class TestCheckSteps(unittest.TestCase):
+
+    def test_unknown_dependency(self):
+        with self.assertRaisesRegex(ValueError, 'unknown step x'):
+            check_steps({'a': ('x',)})
+
+    def test_cycle(self):
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            check_steps({'a': ('c',), 'b': ('a',), 'c': ('b',)})
+
+    def test_valid(self):
+        check_steps({'a': (), 'b': ('a',), 'c': ('a', 'b')})
+
+
+if __name__ == '__main__':
+    unittest.main()